@@ -1,16 +1,24 @@
 import collections
+import functools
+import inspect
 import json
 import logging
+import math
+import random
 import re
 import sqlite3
 import time
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from contextlib import closing
+from datetime import datetime
 from pathlib import Path
-from typing import Callable, Optional, Union
+from typing import Callable, Iterator, Optional, Union
 
-from deepmerge import Merger
-from deepmerge_strategies import merge_counters, merge_lists_with_dict_items
+import xxhash
+from archive import ArchiveReader, is_archive
+from insert_engine import BatchedInsertEngine
+from schema_accumulator import SchemaAccumulator
 from tqdm import tqdm
 from utils import PYTHON_TO_SQLITE_DATA_TYPES, SQLITE_RESERVED_WORDS, PYTHON_TO_POSTGRESQL_DATA_TYPES
 
@@ -18,6 +26,8 @@ logging.basicConfig(level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+JSON_TREE_ARRAY_INDEX = re.compile(r"\[\d+\]")
+
 
 class JSONtoSQLAnalyzer:
     def __init__(
@@ -26,7 +36,15 @@ class JSONtoSQLAnalyzer:
         item_mutator: Optional[Callable] = None,
         auto_convert_simple_types: bool = False,
         is_postgresql: bool = False,
+        jobs: int = 1,
     ):
+        """
+        :param db_file:
+        :param item_mutator:
+        :param auto_convert_simple_types:
+        :param is_postgresql:
+        :param jobs: How many processes the schema is inferred with
+        """
         self.created_tables = {}
         # self.items_to_create = {}
         # self.rows = rows
@@ -34,33 +52,204 @@ class JSONtoSQLAnalyzer:
         self.db_file = db_file
         self.auto_convert_simple_types = auto_convert_simple_types
         self.is_postgresql: bool = is_postgresql
+        self.jobs = jobs
         self.user_was_warned_about_mutators = False
 
     def get_items_from_db(self, db_file: Optional[str] = None, limit: int = -1) -> list[dict]:
         """
-        Open a previously saved raw DB and return the top X rows
+        Open a previously saved raw DB, or an archive segment of one, and return the top X rows
 
         :param db_file: Which DB file to query, if None is specified the one from the class will be used
         :param limit: Amount of rows to fetch
         :return:
         """
+        return [json.loads(x[1]) for x in self.get_raw_items_from_db(db_file=db_file, limit=limit)]
+
+    def get_raw_items_from_db(self, db_file: Optional[str] = None, limit: int = -1) -> list[tuple[int, str]]:
+        """
+        Same as get_items_from_db but the JSON of the rows is left as it was stored
+
+        :param db_file: Which DB file to query, if None is specified the one from the class will be used
+        :param limit: Amount of rows to fetch
+        :return: The (id, raw JSON) of the rows
+        """
+        return list(self.iterate_raw_items_from_db(db_file=db_file, limit=limit))
+
+    def iterate_raw_items_from_db(
+        self,
+        db_file: Optional[str] = None,
+        limit: int = -1,
+        batch_size: int = 1000,
+        id_range: Optional[tuple[int, int]] = None,
+    ) -> Iterator[tuple[int, str]]:
+        """
+        Same as get_raw_items_from_db but the rows are read a batch at a time instead of all being loaded in memory
+
+        :param db_file: Which DB file to query, if None is specified the one from the class will be used
+        :param limit: Amount of rows to fetch
+        :param batch_size: Amount of rows read from the DB at once
+        :param id_range: Only read the rows with an id between these two, inclusively. Not supported for archives.
+        :return: The (id, raw JSON) of the rows
+        """
         db_to_open = db_file if db_file else self.db_file
         if not db_to_open or not Path(db_to_open).exists():
             raise Exception(f"Database {db_file} does not exist!")
+        if is_archive(db_to_open):
+            if id_range:
+                raise Exception(f"Archive {db_to_open} can only be read whole")
+            for listing_id, details, _ in ArchiveReader(db_to_open).iterate_listings(limit):
+                yield listing_id, details
+            return
         with closing(sqlite3.connect(db_to_open)) as connection:
             with closing(connection.cursor()) as cursor:
-                rows = cursor.execute(f"SELECT details from listings LIMIT {limit}").fetchall()
-                return [json.loads(x[0]) for x in rows]
+                if id_range:
+                    rows = cursor.execute(
+                        f"SELECT id, details from listings WHERE id BETWEEN ? AND ? LIMIT {limit}", id_range
+                    )
+                else:
+                    rows = cursor.execute(f"SELECT id, details from listings LIMIT {limit}")
+                while batch := rows.fetchmany(batch_size):
+                    yield from batch
 
-    def get_items_count_from_db(self) -> int:
+    def get_items_count_from_db(self, db_file: Optional[str] = None) -> int:
         """
         Get the number of items in the DB
+        :param db_file: Which DB file to query, if None is specified the one from the class will be used
         :return:
         """
-        with closing(sqlite3.connect(self.db_file)) as connection:
+        db_to_open = db_file if db_file else self.db_file
+        if is_archive(db_to_open):
+            return ArchiveReader(db_to_open).count_listings()
+        with closing(sqlite3.connect(db_to_open)) as connection:
             with closing(connection.cursor()) as cursor:
                 return cursor.execute(f"SELECT COUNT(*) from listings").fetchone()[0]
 
+    def get_id_ranges_from_db(self, db_file: str, range_count: int) -> list[Optional[tuple[int, int]]]:
+        """
+        Splits the rows of a DB into ranges of ids with about the same number of rows in each
+
+        :param db_file:
+        :param range_count: How many ranges to split the rows into
+        :return: The (first id, last id) of every range, or a single None for archives which can only be read whole
+        """
+        if is_archive(db_file):
+            return [None]
+        items_count = self.get_items_count_from_db(db_file)
+        with closing(sqlite3.connect(db_file)) as connection:
+            with closing(connection.cursor()) as cursor:
+                first_ids = []
+                for range_number in range(min(range_count, items_count)):
+                    first_ids.append(
+                        cursor.execute(
+                            "SELECT id FROM listings ORDER BY id LIMIT 1 OFFSET ?",
+                            [range_number * items_count // range_count],
+                        ).fetchone()[0]
+                    )
+                last_id = cursor.execute("SELECT MAX(id) FROM listings").fetchone()[0]
+        return [
+            (first_id, first_ids[i + 1] - 1 if i + 1 < len(first_ids) else last_id)
+            for i, first_id in enumerate(first_ids)
+        ]
+
+    def get_item_mutator_version(self) -> str:
+        """
+        :return: A hash of the item mutator's source code so that changing the mutator changes the version
+        """
+        if not self.item_mutator:
+            return "none"
+        try:
+            return xxhash.xxh3_64_hexdigest(inspect.getsource(self.item_mutator).encode())
+        except (OSError, TypeError):
+            return self.item_mutator.__qualname__
+
+    def get_db_fingerprint(self, db_file: Optional[str] = None, sampled_rows: int = 16) -> dict:
+        """
+        Cheaply identifies the contents of a DB from its number of rows, its last id and the hashes of rows spread
+        evenly through it
+
+        :param db_file: Which DB file to fingerprint, if None is specified the one from the class will be used
+        :param sampled_rows: How many rows are hashed
+        :return:
+        """
+        db_to_open = db_file if db_file else self.db_file
+        items_count = self.get_items_count_from_db(db_to_open)
+        offsets = sorted({x * items_count // sampled_rows for x in range(sampled_rows)}) if items_count else []
+        if is_archive(db_to_open):
+            reader = ArchiveReader(db_to_open)
+            with closing(sqlite3.connect(reader.index_file)) as connection:
+                with closing(connection.cursor()) as cursor:
+                    max_id = cursor.execute("SELECT MAX(id) FROM listings").fetchone()[0]
+                    sampled_ids = [
+                        cursor.execute("SELECT id FROM listings ORDER BY id LIMIT 1 OFFSET ?", [x]).fetchone()[0]
+                        for x in offsets
+                    ]
+            sampled_details = [reader.get_listing(x) for x in sampled_ids]
+        else:
+            with closing(sqlite3.connect(db_to_open)) as connection:
+                with closing(connection.cursor()) as cursor:
+                    max_id = cursor.execute("SELECT MAX(id) FROM listings").fetchone()[0]
+                    sampled_details = [
+                        cursor.execute("SELECT details FROM listings ORDER BY id LIMIT 1 OFFSET ?", [x]).fetchone()[0]
+                        for x in offsets
+                    ]
+        return {
+            "items_count": items_count,
+            "max_id": max_id,
+            "sampled_hashes": [xxhash.xxh3_64_hexdigest(x.encode()) for x in sampled_details],
+            "item_mutator_version": self.get_item_mutator_version(),
+            "auto_convert_simple_types": self.auto_convert_simple_types,
+            "is_postgresql": self.is_postgresql,
+        }
+
+    def get_cached_schema(self, db_name: str, fingerprint: dict) -> Optional[list[str]]:
+        """
+        :param db_name: The DB the tables were created in
+        :param fingerprint: What the schema was inferred from, see get_db_fingerprint
+        :return: The CREATE TABLE statements that were inferred for the same fingerprint or None
+        """
+        with closing(sqlite3.connect(db_name)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS SchemaCache (
+                        Fingerprint      TEXT PRIMARY KEY,
+                        RawSchema        TEXT NOT NULL,
+                        CreateStatements TEXT NOT NULL,
+                        Created          TEXT NOT NULL
+                    )
+                    """
+                )
+                connection.commit()
+                row = cursor.execute(
+                    "SELECT CreateStatements, Created FROM SchemaCache WHERE Fingerprint = ?",
+                    [json.dumps(fingerprint, sort_keys=True)],
+                ).fetchone()
+        if not row:
+            return None
+        logger.info(f"{self.db_file} has not changed, reusing the schema inferred from it on {row[1]}")
+        return json.loads(row[0])
+
+    def save_cached_schema(self, db_name: str, fingerprint: dict, raw_schema: str, create_statements: list[str]):
+        """
+        :param db_name: The DB the tables were created in, get_cached_schema must have been called on it first
+        :param fingerprint: What the schema was inferred from, see get_db_fingerprint
+        :param raw_schema: The JSON of the merged item with the value type Counters the statements were generated from
+        :param create_statements:
+        :return:
+        """
+        with closing(sqlite3.connect(db_name)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    "REPLACE INTO SchemaCache (Fingerprint, RawSchema, CreateStatements, Created) VALUES (?, ?, ?, ?)",
+                    [
+                        json.dumps(fingerprint, sort_keys=True),
+                        raw_schema,
+                        json.dumps(create_statements),
+                        datetime.now().isoformat(),
+                    ],
+                )
+            connection.commit()
+
     def get_item_from_db(self):
         with closing(sqlite3.connect(self.db_file)) as connection:
             with closing(connection.cursor()) as cursor:
@@ -207,53 +396,6 @@ class JSONtoSQLAnalyzer:
             elif self.auto_convert_simple_types and (type(value) is str or type(value) is bool):
                 item[key] = self.cast_value_to_sqlite(value)
 
-    def modify_dict_to_counter_types(
-        self,
-        item: dict,
-        item_path: Optional[list[str]] = None,
-        came_from_a_list: bool = False,
-        counter_to_string: bool = False,
-    ) -> None:
-        """
-        This function modifies the dict in place so that all values are Counters of the value types
-        This is only useful when analyzing a large dataset so that we can see the data type consistency for each column
-        If we end up with multiple types in the Counters it means the data is inconsistent
-
-        :param item:
-        :param item_path:
-        :param came_from_a_list:
-        :param counter_to_string: When True, we will convert Counter values to the most common counter string
-        :return:
-        """
-        if item_path is None:
-            item_path = ["$"]
-
-        if came_from_a_list:
-            item_path.append("[]")
-
-        # Here we check what to do based on the key's value type
-        for key, value in item.items():
-            if isinstance(value, list):
-                current_dict_path = f'{".".join(item_path + [key])}:'
-
-                if all(isinstance(x, dict) for x in value):
-                    # All the items in the list are dicts which makes life easy
-                    for dict_in_list in value:
-                        self.modify_dict_to_counter_types(dict_in_list, item_path + [key], True, counter_to_string)
-                else:
-                    # This complicates life a lot and we hope it won't happen
-                    logger.warning(
-                        f'{current_dict_path} Key "{key}" has a value of type {type(value)} which is currently unsupported'
-                    )
-
-            elif isinstance(value, dict):
-                # If it's a dict we need to go through this whole loop again
-                self.modify_dict_to_counter_types(value, item_path + [key], False, counter_to_string)
-            # elif counter_to_string and isinstance(value, Counter):
-            #     item[key] = value.most_common(1)[0][0] if len(value) else 'str'
-            else:
-                item[key] = Counter([type(value).__name__])
-
     def split_lists_from_item(
         self,
         item: dict,
@@ -349,40 +491,291 @@ class JSONtoSQLAnalyzer:
 
         return item.get(determined_item_id_key, "NO_ID_FOR_KEY")
 
-    def convert_raw_db_to_json_and_merge_to_get_raw_schema(self):
+    def add_raw_item_to_schema(self, accumulator: SchemaAccumulator, details: str):
+        item = json.loads(details)
+        # Modify the item so that it will fit into a relational db better
+        # i.e. Adding GeneratedIDs, making some list become dicts, etc...
+        # This is also where we can control whether we do simple value conversions
+        self.modify_dict(item)
+        # Add the data types of the item's values to the Counters of the merged item so we can see data consistency
+        accumulator.add_item(item)
+
+    def get_schema_for_id_range(self, db_file: str, id_range: Optional[tuple[int, int]]) -> SchemaAccumulator:
+        """
+        Runs in a worker process to infer the schema of part of a DB
+
+        :param db_file:
+        :param id_range: See get_id_ranges_from_db
+        :return:
+        """
+        accumulator = SchemaAccumulator()
+        for _, details in self.iterate_raw_items_from_db(db_file=db_file, id_range=id_range):
+            self.add_raw_item_to_schema(accumulator, details)
+        return accumulator
+
+    def convert_raw_db_to_json_and_merge_to_get_raw_schema(self, db_files: Optional[list[str]] = None):
         """
         This function process all raw JSON responses in your DB and merges them into one schema dict item
         You can then use this item to generate or execute SQL commands
+
+        The rows are streamed from the DB and folded into the merged item one by one so memory use doesn't grow with the
+        number of rows. With more than one job the rows are split into id ranges whose schemas are inferred in separate
+        processes and then merged.
+
+        :param db_files: The DBs to analyze together, defaults to the one from the class
         :return:
         """
-        items = self.get_items_from_db()
-
-        for item in tqdm(items, desc=f"Items Modified for SQL Schema Analysis of {self.db_file}", miniters=1):
-            # Modify the item so that it will fit into a relational db better
-            # i.e. Adding GeneratedIDs, making some list become dicts, etc...
-            # This is also where we can control whether we do simple value conversions
-            self.modify_dict(item)
-            # Modify the dict so that each value is a Counter with the data types
-            self.modify_dict_to_counter_types(item)
-
-        custom_merger = Merger(
-            [
-                (Counter, merge_counters),
-                (list, merge_lists_with_dict_items),
-                (dict, ["merge"]),
-                (set, ["union"]),
-            ],
-            ["override"],
-            ["override"],
-        )
+        db_files = db_files if db_files else [self.db_file]
+
+        if self.jobs > 1:
+            ranges_per_db = -(-self.jobs // len(db_files))
+            id_ranges = [(x, y) for x in db_files for y in self.get_id_ranges_from_db(x, ranges_per_db)]
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                futures = [executor.submit(self.get_schema_for_id_range, x, y) for x, y in id_ranges]
+                for _ in tqdm(as_completed(futures), desc="Id Ranges Analyzed for SQL Schema", total=len(futures)):
+                    pass
+            # Merged in order so the columns come out in the same order as when analyzing everything in one process
+            accumulator = functools.reduce(SchemaAccumulator.merge, [x.result() for x in futures], SchemaAccumulator())
+            return accumulator.schema
+
+        accumulator = SchemaAccumulator()
+        for db_file in db_files:
+            for _, details in tqdm(
+                self.iterate_raw_items_from_db(db_file=db_file),
+                desc=f"Items Analyzed for SQL Schema of {db_file}",
+                total=self.get_items_count_from_db(db_file),
+            ):
+                self.add_raw_item_to_schema(accumulator, details)
+
+        return accumulator.schema
+
+    def get_json_tree_type_name_sql(self) -> str:
+        """
+        :return: An SQL expression giving the Python type name of a json_tree node, same as the type of its value after
+            modify_dict with no item mutator would be
+        """
+        if not self.auto_convert_simple_types:
+            boolean_type_name = "bool"
+            text_type_names = "'str'"
+        else:
+            boolean_type_name = "bool" if self.is_postgresql else "int"
+            # Same as cast_value_to_sqlite
+            text_type_names = """
+                CASE
+                    WHEN atom = '' THEN 'NoneType'
+                    WHEN LOWER(atom) IN ('true', 'false') THEN 'bool'
+                    WHEN unsigned_atom <> '' AND unsigned_atom NOT GLOB '*[^0-9]*' THEN 'int'
+                    WHEN unsigned_atom GLOB '[0-9]*.*[0-9]'
+                     AND unsigned_atom NOT GLOB '*[^0-9.]*'
+                     AND unsigned_atom NOT GLOB '*.*.*' THEN 'float'
+                    ELSE 'str'
+                END
+            """
+        return f"""
+            CASE type
+                WHEN 'null' THEN 'NoneType'
+                WHEN 'true' THEN '{boolean_type_name}'
+                WHEN 'false' THEN '{boolean_type_name}'
+                WHEN 'integer' THEN 'int'
+                WHEN 'real' THEN 'float'
+                WHEN 'object' THEN 'dict'
+                WHEN 'array' THEN 'list'
+                ELSE {text_type_names}
+            END
+        """
+
+    def get_sampled_raw_schema(
+        self, sample_size: int = 1000, db_files: Optional[list[str]] = None, seed: Optional[int] = None
+    ) -> tuple[dict, int]:
+        """
+        Same as convert_raw_db_to_json_and_merge_to_get_raw_schema but only a uniform random sample of the items is
+        modified and merged, which is much quicker when iterating on the item mutator.
+        The rows still all have to be read to pick the sample but only the sampled ones are kept.
+
+        :param sample_size: How many items to sample
+        :param db_files: The DBs to sample from together, defaults to the one from the class
+        :param seed: Seed for picking the sample so it can be reproduced
+        :return: The merged item and how many items it was made from
+        """
+        db_files = db_files if db_files else [self.db_file]
+        randomizer = random.Random(seed)
+
+        # Reservoir sampling so every row has the same chance to be picked without knowing the number of rows
+        sample = []
+        items_seen = 0
+        for db_file in db_files:
+            for _, details in tqdm(
+                self.iterate_raw_items_from_db(db_file=db_file),
+                desc=f"Items Sampled for SQL Schema of {db_file}",
+                total=self.get_items_count_from_db(db_file),
+            ):
+                if len(sample) < sample_size:
+                    sample.append(details)
+                else:
+                    replaced_item = randomizer.randint(0, items_seen)
+                    if replaced_item < sample_size:
+                        sample[replaced_item] = details
+                items_seen += 1
+
+        accumulator = SchemaAccumulator()
+        for details in sample:
+            self.add_raw_item_to_schema(accumulator, details)
+        logger.info(f"Schema was inferred from a sample of {len(sample)}/{items_seen} items")
+
+        return accumulator.schema, len(sample)
+
+    @staticmethod
+    def get_null_rate_upper_bound(nulls: int, samples: int, z: float = 1.96) -> float:
+        """
+        :param nulls: How many of the sampled values were null
+        :param samples: How many values were sampled
+        :param z: 1.96 for 95% confidence
+        :return: The upper bound of the Wilson score interval for the rate of null values
+        """
+        if not samples:
+            return 1.0
+        null_rate = nulls / samples
+        center = null_rate + z**2 / (2 * samples)
+        margin = z * math.sqrt(null_rate * (1 - null_rate) / samples + z**2 / (4 * samples**2))
+        return min(1.0, (center + margin) / (1 + z**2 / samples))
+
+    def get_column_statistics(self, merged_item_results: dict, num_items: int) -> list[dict]:
+        """
+        Summarizes the value types seen for every column of the tables that would be created
+        This has to be done before get_sqlite_sql_for_merged_counter_dict which removes the NoneType counts.
+
+        :param merged_item_results: The merged item once it went through split_lists_from_item
+        :param num_items: How many items were merged
+        :return: The column, its name, its value types, how often it's null and the upper bound of that rate at 95%
+            confidence. Values that were missing count as nulls.
+        """
+        column_statistics = []
+        for item_path, items_to_create in merged_item_results.items():
+            columns = {k: v for k, v in items_to_create[0].items() if type(v) is Counter}
+            if not columns:
+                continue
+            # There can be any number of rows for items in lists so the column seen the most is used as the count
+            num_rows = num_items if item_path == "$" else max(sum(x.values()) for x in columns.values())
+            for column_name, column_type_counter in columns.items():
+                value_types = Counter({k: v for k, v in column_type_counter.items() if k != "NoneType"})
+                nulls = max(0, num_rows - sum(value_types.values()))
+                column_statistics.append(
+                    {
+                        "column": f"{item_path}.{column_name}",
+                        "name": column_name,
+                        "types": value_types,
+                        "null_rate": nulls / num_rows if num_rows else 1.0,
+                        "null_rate_upper_bound": self.get_null_rate_upper_bound(nulls, num_rows),
+                    }
+                )
+        return column_statistics
+
+    def verify_sampled_column_statistics(
+        self, sampled_statistics: list[dict], max_null_rate: float, db_files: Optional[list[str]] = None
+    ) -> list[str]:
+        """
+        Infers the schema from every item and checks it against what the sample predicted
+
+        :param sampled_statistics: See get_column_statistics
+        :param max_null_rate: The null rate upper bound under which a column was predicted to be NOT NULL
+        :param db_files: The DBs that were sampled, defaults to the one from the class
+        :return: What the sample got wrong
+        """
+        db_files = db_files if db_files else [self.db_file]
+        merged_item = self.convert_raw_db_to_json_and_merge_to_get_raw_schema(db_files)
+        results = {}
+        # WARNING: This is what flattens our dict item by default
+        self.split_lists_from_item(merged_item, items_to_create=results)
+        full_statistics = {
+            x["column"]: x
+            for x in self.get_column_statistics(results, sum(self.get_items_count_from_db(x) for x in db_files))
+        }
+
+        mismatches = []
+        for sampled in sampled_statistics:
+            full = full_statistics.pop(sampled["column"], None)
+            if not full:
+                continue
+            unseen_types = set(full["types"]) - set(sampled["types"])
+            if unseen_types:
+                mismatches.append(f"{sampled['column']} also has values of type {', '.join(sorted(unseen_types))}")
+            predicted_not_null = sampled["null_rate"] == 0 and sampled["null_rate_upper_bound"] <= max_null_rate
+            if predicted_not_null and full["null_rate"] > 0:
+                mismatches.append(
+                    f"{sampled['column']} was predicted NOT NULL but {full['null_rate']:.4%} of it is null"
+                )
+        for column in full_statistics:
+            mismatches.append(f"{column} was not in the sample")
+        return mismatches
+
+    def get_raw_schema_with_json_tree(self, db_files: Optional[list[str]] = None) -> dict:
+        """
+        Builds the same kind of merged item as convert_raw_db_to_json_and_merge_to_get_raw_schema but lets SQLite count
+        the value types of every JSON path with json_tree instead of decoding the items in Python, which is a lot faster.
 
-        merged_items = {}
+        WARNING: The item mutator can't be applied this way so the merged item describes the raw JSON. Lists of values
+        that aren't dicts are counted as a "list" type column.
 
-        # Merge all the items into one which will now have Counter of data types so that we can see data consistency
-        for item in tqdm(items, desc=f"Items Merged for SQL Schema Analysis of {self.db_file}"):
-            merged_items = custom_merger.merge(merged_items, item)
+        :param db_files: The DBs to analyze together, defaults to the one from the class
+        :return:
+        """
+        db_files = db_files if db_files else [self.db_file]
+        if self.item_mutator:
+            logger.warning("The item mutator is not applied when inferring the schema with json_tree")
+
+        type_counters = {}
+        for db_file in db_files:
+            if is_archive(db_file):
+                raise Exception(f"Archive {db_file} can't be analyzed with json_tree, convert it back to a raw DB")
+            with closing(sqlite3.connect(db_file)) as connection:
+                with closing(connection.cursor()) as cursor:
+                    rows = cursor.execute(
+                        f"""
+                        WITH nodes AS (
+                            SELECT json_tree.id,
+                                   json_tree.fullkey,
+                                   json_tree.type,
+                                   json_tree.atom,
+                                   CASE WHEN json_tree.atom LIKE '-%' THEN SUBSTR(json_tree.atom, 2) ELSE json_tree.atom END AS unsigned_atom
+                              FROM listings, json_tree(listings.details)
+                        )
+                        SELECT fullkey, {self.get_json_tree_type_name_sql()} AS type_name, COUNT(*), MIN(id)
+                          FROM nodes
+                         GROUP BY fullkey, type_name
+                        """
+                    ).fetchall()
+            # Nodes are numbered in the order they appear in an item so parents come before their children
+            for fullkey, type_name, count, _ in sorted(rows, key=lambda x: x[3]):
+                # Collapse the array indices to the same paths modify_dict uses i.e. $.Individual[0] -> $.Individual.[]
+                item_path = JSON_TREE_ARRAY_INDEX.sub(".[]", fullkey).replace('"', "")
+                type_counters.setdefault(item_path, Counter())[type_name] += count
+
+        merged_item = {}
+        for item_path, type_counter in type_counters.items():
+            if item_path == "$" or item_path.endswith(".[]"):
+                # These are the items themselves and the items in lists, they are added along with their parents
+                continue
+            *parent_keys, key = item_path.split(".")[1:]
+            try:
+                parent = merged_item
+                for parent_key in parent_keys:
+                    parent = parent[0] if parent_key == "[]" else parent[parent_key]
+                if "dict" in type_counter:
+                    parent[key] = {}
+                elif "list" in type_counter:
+                    list_items_type_counter = type_counters.get(f"{item_path}.[]", Counter())
+                    if "dict" in list_items_type_counter:
+                        parent[key] = [{}]
+                    elif list_items_type_counter:
+                        parent[key] = Counter(list=type_counter["list"])
+                    else:
+                        parent[key] = []
+                else:
+                    parent[key] = type_counter
+            except (IndexError, KeyError, TypeError):
+                logger.error(f"{item_path} is not always inside the same kind of value so it will be skipped")
 
-        return merged_items
+        return merged_item
 
     def get_sqlite_sql_for_dbschema_from_raw_items(
         self,
@@ -407,6 +800,122 @@ class JSONtoSQLAnalyzer:
 
         return tables_to_create
 
+    def get_table_columns(self, connection: sqlite3.Connection, table_name: str) -> set[str]:
+        """
+        :return: The lowercase names of the table's columns, empty if the table doesn't exist
+        """
+        with closing(connection.cursor()) as cursor:
+            return {x[1].lower() for x in cursor.execute(f"PRAGMA table_info({table_name})")}
+
+    def apply_schema_migration(
+        self, connection: sqlite3.Connection, table_name: str, column_name: Optional[str], statement: str
+    ):
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS SchemaMigrations (
+                    Version    INTEGER PRIMARY KEY,
+                    TableName  TEXT NOT NULL,
+                    ColumnName TEXT,
+                    Statement  TEXT NOT NULL,
+                    Applied    TEXT NOT NULL
+                )
+                """
+            )
+            cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO SchemaMigrations (TableName, ColumnName, Statement, Applied) VALUES (?, ?, ?, ?)",
+                [table_name, column_name, statement, datetime.now().isoformat()],
+            )
+            logger.warning(f"Migrated the schema to version {cursor.lastrowid}: {statement}")
+
+    def evolve_schema_for_split_items(
+        self,
+        connection: sqlite3.Connection,
+        split_items: dict,
+        default_table_key_name: str,
+        table_columns: dict[str, set[str]],
+        limit_to_columns: Optional[list[str]] = None,
+    ) -> None:
+        """
+        Makes sure the DB has a column for every value that is about to be inserted
+        Missing tables are created and missing columns are added with the type of the first value they get, the changes
+        are recorded in the SchemaMigrations table. Values of missing columns that are None are removed from the items
+        instead since they would be NULL anyways.
+
+        :param connection:
+        :param split_items: The items split by split_lists_from_item, they get modified
+        :param default_table_key_name: The name of the table items wil be inserted into
+        :param table_columns: The columns of every table seen so far, see get_table_columns. This is kept by the caller
+            so the tables don't have to be looked up for every item and gets updated with the new columns
+        :param limit_to_columns: If provided, only the columns in this array will be inserted
+        :return:
+        """
+        db_type_conversion = PYTHON_TO_POSTGRESQL_DATA_TYPES if self.is_postgresql else PYTHON_TO_SQLITE_DATA_TYPES
+        for item_path, items_to_create in split_items.items():
+            path_without_arrays = [x for x in item_path.split(".") if x != "[]"]
+            table_name = default_table_key_name if item_path == "$" else path_without_arrays[-1]
+            if table_name not in table_columns:
+                table_columns[table_name] = self.get_table_columns(connection, table_name)
+            known_columns = table_columns[table_name]
+
+            for dict_item in items_to_create:
+                unknown_columns = [
+                    x
+                    for x in dict_item.keys()
+                    if x.lower() not in known_columns and (not limit_to_columns or x in limit_to_columns)
+                ]
+                for column_name in [x for x in unknown_columns if dict_item[x] is None]:
+                    del dict_item[column_name]
+                unknown_columns = [x for x in unknown_columns if x in dict_item]
+                if not unknown_columns:
+                    continue
+
+                column_definitions = {}
+                for column_name in unknown_columns:
+                    sql_column_type = db_type_conversion.get(type(dict_item[column_name]).__name__, "TEXT")
+                    quoted_column_name = (
+                        f"`{column_name}`" if column_name.upper() in SQLITE_RESERVED_WORDS else column_name
+                    )
+                    column_definitions[column_name] = f"{quoted_column_name} {sql_column_type}"
+
+                if known_columns:
+                    for column_name, column_definition in column_definitions.items():
+                        statement = f"ALTER TABLE {table_name} ADD COLUMN {column_definition}"
+                        self.apply_schema_migration(connection, table_name, column_name, statement)
+                else:
+                    possible_primary_keys = JSONtoSQLAnalyzer.get_dict_id_keys(dict_item)
+                    if possible_primary_keys and possible_primary_keys[0] in column_definitions:
+                        column_definitions[possible_primary_keys[0]] += " PRIMARY KEY"
+                    statement = f"CREATE TABLE {table_name}({', '.join(column_definitions.values())})"
+                    self.apply_schema_migration(connection, table_name, None, statement)
+                known_columns.update(x.lower() for x in unknown_columns)
+
+    def get_rows_for_split_items(
+        self, split_items: dict, default_table_key_name: str, limit_to_columns: Optional[list[str]] = None
+    ) -> list[tuple[str, dict]]:
+        """
+        Same as generate_sqlite_sql_for_inserting_split_item but gives the rows to insert for a BatchedInsertEngine
+
+        :param split_items: The items split by split_lists_from_item
+        :param default_table_key_name: The name of the table items wil be inserted into
+        :param limit_to_columns: If provided, only the columns in this array will be inserted
+        :return: The table and values by column of every row
+        """
+        rows = []
+        for item_path, items_to_create in split_items.items():
+            path_without_arrays = [x for x in item_path.split(".") if x != "[]"]
+            table_name = default_table_key_name if item_path == "$" else path_without_arrays[-1]
+
+            for dict_item in items_to_create:
+                row = {
+                    key: str(value) if isinstance(value, list) else value
+                    for key, value in dict_item.items()
+                    if not limit_to_columns or key in limit_to_columns
+                }
+                rows.append((table_name, row))
+        return rows
+
     def generate_sqlite_sql_for_inserting_split_item(
         self, insert_item_sql_statements: dict, default_table_key_name: str
     ) -> list[tuple]:
@@ -452,21 +961,22 @@ class JSONtoSQLAnalyzer:
         self.create_sqlite_tables_from_statements(new_db_name, create_table_sql_statements)
 
         # Insert the listings into the table
-        with closing(sqlite3.connect(new_db_name)) as connection:
+        with closing(sqlite3.connect(new_db_name)) as connection, BatchedInsertEngine(connection) as insert_engine:
             for listing in tqdm(listings, desc="Rows Processed"):
                 self.modify_dict(listing)
                 created_items = {}
                 # WARNING: This is what flattens our dict item by default
                 self.split_lists_from_item(listing, items_to_create=created_items)
 
-                statements = self.generate_sqlite_sql_for_inserting_split_item(created_items, default_table_key_name)
-                with closing(connection.cursor()) as cursor:
-                    for template, values in statements:
-                        cursor.execute(template, values)
-            connection.commit()
+                for table_name, row in self.get_rows_for_split_items(created_items, default_table_key_name):
+                    insert_engine.add_row(table_name, row)
 
     def get_sqlite_sql_for_merged_counter_dict(
-        self, merged_item_results, default_table_key_name: str = "items", cannot_be_not_null: Optional[list[str]] = None
+        self,
+        merged_item_results,
+        default_table_key_name: str = "items",
+        cannot_be_not_null: Optional[list[str]] = None,
+        num_items_in_db: Optional[int] = None,
     ) -> list[str]:
         """
         This will return you a list of SQL statements used for creating the necessary table given your derived schema
@@ -474,9 +984,11 @@ class JSONtoSQLAnalyzer:
         :param cannot_be_not_null: A list of column names that should never be made NOT NULL, useful when sample size is small or misleading
         :param merged_item_results:
         :param default_table_key_name: The name of the default table your "items" will be placed in
+        :param num_items_in_db: How many items the schema was derived from, defaults to the number in the class' DB
         :return:
         """
-        num_items_in_db = self.get_items_count_from_db()
+        if num_items_in_db is None:
+            num_items_in_db = self.get_items_count_from_db()
 
         schemas = []
         created_paths = set()
@@ -503,6 +1015,9 @@ class JSONtoSQLAnalyzer:
                             f"Column {item_path}.{column_name} has no data type and thus is messing up data and needs to be dealt with"
                         )
                         continue
+                    if type(column_type_counter) is int:
+                        # How many times the dict this column was flattened from was a value of this type instead
+                        continue
                     # This is hell
                     could_be_non_null = False if cannot_be_not_null and column_name in cannot_be_not_null else True
                     if type(column_type_counter) is Counter and "NoneType" in column_type_counter:
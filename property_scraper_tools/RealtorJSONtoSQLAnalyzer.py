@@ -3,14 +3,18 @@ import json
 import logging
 import re
 import sqlite3
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import closing
 from datetime import datetime
+from itertools import repeat
 from pathlib import Path
 from pprint import pprint
-from typing import Callable, Optional
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
 
 import xxhash
+from delta_store import get_body_hash
+from insert_engine import BatchedInsertEngine
 from JSONtoSQLAnalyzer import JSONtoSQLAnalyzer
 from sortedcontainers import SortedDict
 from tqdm import tqdm
@@ -29,12 +33,14 @@ class RealtorJSONtoSQLAnalyzer(JSONtoSQLAnalyzer):
         item_mutator: Optional[Callable] = None,
         auto_convert_simple_types: bool = False,
         is_postgresql: bool = None,
+        jobs: int = 1,
     ):
         super().__init__(
             db_file,
             item_mutator=item_mutator,
             auto_convert_simple_types=auto_convert_simple_types,
             is_postgresql=is_postgresql,
+            jobs=jobs,
         )
         self.city = city
         self.minimal_columns = [
@@ -220,6 +226,7 @@ class RealtorJSONtoSQLAnalyzer(JSONtoSQLAnalyzer):
         columns_to_keep: Optional[list[str]] = None,
         add_computed_columns: bool = False,
         keep_only_main_item: bool = False,
+        merged_item: Optional[dict] = None,
     ) -> list[str]:
         """
         Returns SQL statements to create the necessary tables determined by looking at all DB items and merging them
@@ -235,9 +242,11 @@ class RealtorJSONtoSQLAnalyzer(JSONtoSQLAnalyzer):
         :param columns_to_keep: Only the columns in this list will created and have data inserted into them
         :param add_computed_columns: Add the following columns to the DB table schema
         :param keep_only_main_item:
+        :param merged_item: The merged item of the DB if it was already inferred, it gets modified
         :return:
         """
-        merged_item = self.convert_raw_db_to_json_and_merge_to_get_raw_schema()
+        if merged_item is None:
+            merged_item = self.convert_raw_db_to_json_and_merge_to_get_raw_schema()
 
         results = {}
         # WARNING: This is what flattens our dict item by default
@@ -305,14 +314,37 @@ class RealtorJSONtoSQLAnalyzer(JSONtoSQLAnalyzer):
 
         return statements
 
-    def create_initial_tables(self, new_db_name: str, add_computed_columns: bool, minimal_config: bool):
-        create_table_sql_statements = self.get_sqlite_sql_for_dbschema_from_raw_items(
-            columns_to_keep=self.minimal_columns if minimal_config else None,
-            default_table_key_name="Listings",
-            keep_only_main_item=minimal_config,
-            # Only applicable for this custom class
-            add_computed_columns=add_computed_columns,
-        )
+    def create_initial_tables(
+        self, new_db_name: str, add_computed_columns: bool, minimal_config: bool, use_schema_cache: bool = True
+    ):
+        """
+        :param new_db_name:
+        :param add_computed_columns:
+        :param minimal_config:
+        :param use_schema_cache: Reuse the schema saved in the new DB when the raw DB and the settings haven't changed
+            since it was inferred, instead of inferring it again
+        :return:
+        """
+        create_table_sql_statements = None
+        if use_schema_cache:
+            fingerprint = self.get_db_fingerprint()
+            fingerprint.update(add_computed_columns=add_computed_columns, minimal_config=minimal_config)
+            create_table_sql_statements = self.get_cached_schema(new_db_name, fingerprint)
+
+        if create_table_sql_statements is None:
+            merged_item = self.convert_raw_db_to_json_and_merge_to_get_raw_schema()
+            # Serialized now since generating the statements modifies the Counters
+            raw_schema = json.dumps(merged_item)
+            create_table_sql_statements = self.get_sqlite_sql_for_dbschema_from_raw_items(
+                columns_to_keep=self.minimal_columns if minimal_config else None,
+                default_table_key_name="Listings",
+                keep_only_main_item=minimal_config,
+                # Only applicable for this custom class
+                add_computed_columns=add_computed_columns,
+                merged_item=merged_item,
+            )
+            if use_schema_cache:
+                self.save_cached_schema(new_db_name, fingerprint, raw_schema, create_table_sql_statements)
         self.create_sqlite_tables_from_statements(new_db_name, create_table_sql_statements)
 
         price_history_table_sql = """
@@ -356,101 +388,338 @@ class RealtorJSONtoSQLAnalyzer(JSONtoSQLAnalyzer):
                 if row:
                     return datetime.strptime(row[0], "%Y-%m-%d")
 
+    def get_existing_raw_hashes(self, db_name: str) -> dict[int, int]:
+        with closing(sqlite3.connect(db_name)) as connection:
+            with closing(connection.cursor()) as cursor:
+                # The hash of the raw JSON each listing was last inserted from, so listings that didn't change can be
+                # skipped. This is created here since output DBs from before the hashes were kept won't have the table.
+                cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS ListingRawHashes (Id INTEGER PRIMARY KEY, RawHash INTEGER NOT NULL)"
+                )
+                connection.commit()
+                return dict(cursor.execute("SELECT Id, RawHash FROM ListingRawHashes").fetchall())
+
+    def update_unchanged_listings(self, db_name: str, listing_ids: list[int], parsed_date: datetime):
+        """
+        Marks listings whose raw JSON is the same as when they were last inserted as seen on the given date, with one
+        UPDATE instead of parsing and replacing every one of them
+
+        :param db_name:
+        :param listing_ids:
+        :param parsed_date:
+        :return:
+        """
+        with closing(sqlite3.connect(db_name)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("CREATE TEMP TABLE UnchangedListings (Id INTEGER PRIMARY KEY)")
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO UnchangedListings (Id) VALUES (?)", [(x,) for x in listing_ids]
+                )
+                cursor.execute(
+                    "UPDATE Listings SET ComputedLastUpdated = ? WHERE Id IN (SELECT Id FROM UnchangedListings)",
+                    [parsed_date.isoformat()],
+                )
+            connection.commit()
+
     # FIXME: Variables need to be changed not to reflect a db file but a grouping of listings
-    def insert_listings_into_db(
+    @staticmethod
+    def get_computed_columns(parsed_date: datetime) -> dict:
+        return {
+            "ComputedSQFT": None,
+            "ComputedPricePerSQFT": None,
+            "ComputedLastUpdated": parsed_date.isoformat(),
+            "ComputedNewBuild": False,
+        }
+
+    def transform_listing(
         self,
-        listings: list,
-        db_name: str,
+        listing: Union[dict, str],
         parsed_date: datetime,
-        price_data: dict,
         add_computed_columns: bool = True,
         minimal_config: bool = False,
-    ):
-        with closing(sqlite3.connect(db_name)) as connection:
-            for listing in tqdm(listings, desc=f"Rows inserted into {db_name}"):
-                self.modify_dict(listing)
-                computed_columns = {
-                    "ComputedSQFT": None,
-                    "ComputedPricePerSQFT": None,
-                    "ComputedLastUpdated": parsed_date.isoformat(),
-                    "ComputedNewBuild": False,
-                }
-
-                listing_is_new_build = "GST +  QST" in listing.get("Property", {}).get("Price", "")
-                if listing_is_new_build:
-                    computed_columns["ComputedNewBuild"] = True
-                    # If it's a new build it will have 15% taxes which we want to auto add cuz that's just a hidden fee
-                    if listing.get("Property", {}).get("PriceUnformattedValue"):
-                        listing["Property"]["PriceUnformattedValue"] = round(
-                            listing["Property"]["PriceUnformattedValue"] * 1.14975
-                        )
+    ) -> tuple[int, str, Any, dict]:
+        """
+        Does everything needed to insert a listing that doesn't need the output DB
 
-                listing_interior_size = listing.get("Building", {}).get("SizeInterior")
-                if listing_interior_size:
-                    computed_sqft = round(RealtorJSONtoSQLAnalyzer.convert_interior_size_to_sqft(listing_interior_size))
-                    if computed_sqft > 0:
-                        computed_columns["ComputedSQFT"] = computed_sqft
-                        listing_price = listing.get("Property", {}).get("PriceUnformattedValue")
-                        if listing_price:
-                            computed_columns["ComputedPricePerSQFT"] = round(
-                                float(listing_price) / computed_columns["ComputedSQFT"]
-                            )
+        :param listing: The listing or its raw JSON, the listing gets modified
+        :param parsed_date:
+        :param add_computed_columns:
+        :param minimal_config:
+        :return: The Id, MlsNumber and price of the listing and its items split by split_lists_from_item
+        """
+        if isinstance(listing, str):
+            listing = json.loads(listing)
+
+        self.modify_dict(listing)
+        computed_columns = self.get_computed_columns(parsed_date)
+
+        listing_is_new_build = "GST +  QST" in listing.get("Property", {}).get("Price", "")
+        if listing_is_new_build:
+            computed_columns["ComputedNewBuild"] = True
+            # If it's a new build it will have 15% taxes which we want to auto add cuz that's just a hidden fee
+            if listing.get("Property", {}).get("PriceUnformattedValue"):
+                listing["Property"]["PriceUnformattedValue"] = round(
+                    listing["Property"]["PriceUnformattedValue"] * 1.14975
+                )
 
-                if add_computed_columns:
-                    listing.update(computed_columns)
+        listing_interior_size = listing.get("Building", {}).get("SizeInterior")
+        if listing_interior_size:
+            computed_sqft = round(RealtorJSONtoSQLAnalyzer.convert_interior_size_to_sqft(listing_interior_size))
+            if computed_sqft > 0:
+                computed_columns["ComputedSQFT"] = computed_sqft
+                listing_price = listing.get("Property", {}).get("PriceUnformattedValue")
+                if listing_price:
+                    computed_columns["ComputedPricePerSQFT"] = round(
+                        float(listing_price) / computed_columns["ComputedSQFT"]
+                    )
+
+        if add_computed_columns:
+            listing.update(computed_columns)
+
+        results = {}
+        # WARNING: This is what flattens our dict item by default
+        self.split_lists_from_item(listing, items_to_create=results)
 
-                results = {}
-                # WARNING: This is what flattens our dict item by default
-                self.split_lists_from_item(listing, items_to_create=results)
+        # Remove all data but the main Listings/$ object
+        if minimal_config:
+            for keyname in list(results.keys()):
+                if keyname != "$":
+                    del results[keyname]
+
+        return int(listing["Id"]), listing["MlsNumber"], listing["Property"]["PriceUnformattedValue"], results
+
+    def transform_listings(
+        self, listings: list[Union[dict, str]], parsed_date: datetime, add_computed_columns: bool, minimal_config: bool
+    ) -> list[tuple[int, str, Any, dict]]:
+        return [self.transform_listing(x, parsed_date, add_computed_columns, minimal_config) for x in listings]
+
+    def iterate_transformed_listings(
+        self,
+        listings: list[Union[dict, str]],
+        parsed_date: datetime,
+        add_computed_columns: bool = True,
+        minimal_config: bool = False,
+        chunk_size: int = 256,
+    ) -> Iterator[tuple[int, str, Any, dict]]:
+        """
+        Transforms the listings with transform_listing, with more than one job the listings are transformed in chunks by
+        separate processes
+
+        :param listings: The listings or their raw JSON, the raw JSON is better with multiple jobs since it's smaller to
+            send and the parsing is done by the other processes too
+        :param parsed_date:
+        :param add_computed_columns:
+        :param minimal_config:
+        :param chunk_size: How many listings are sent to a process at a time
+        :return: The transformed listings in the same order as they were given
+        """
+        if self.jobs <= 1 or len(listings) <= chunk_size:
+            for listing in listings:
+                yield self.transform_listing(listing, parsed_date, add_computed_columns, minimal_config)
+            return
+
+        chunks = [listings[x : x + chunk_size] for x in range(0, len(listings), chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            # map gives back the chunks in order so the listings are inserted in the same order as with a single job
+            for transformed_listings in executor.map(
+                self.transform_listings,
+                chunks,
+                repeat(parsed_date),
+                repeat(add_computed_columns),
+                repeat(minimal_config),
+            ):
+                yield from transformed_listings
+
+    def transform_raw_db(
+        self,
+        db_file: str,
+        parsed_date: datetime,
+        add_computed_columns: bool = True,
+        minimal_config: bool = False,
+        previous_db_file: Optional[str] = None,
+    ) -> list[tuple[int, int, Union[tuple[int, str, Any, dict], str]]]:
+        """
+        Reads and transforms all the listings of a raw DB so it can be done for many DBs at once during a backfill
+
+        :param db_file:
+        :param parsed_date:
+        :param add_computed_columns:
+        :param minimal_config:
+        :param previous_db_file: The raw DB from before this one, listings that are the same as in it are left as raw
+            JSON since they will be skipped as unchanged unless they failed to be inserted
+        :return: The Id, raw hash and transformed listing or raw JSON of every listing in the DB
+        """
+        previous_raw_hashes = {}
+        if previous_db_file:
+            previous_raw_hashes = {x: get_body_hash(y) for x, y in self.get_raw_items_from_db(db_file=previous_db_file)}
+
+        results = []
+        for listing_id, details in self.get_raw_items_from_db(db_file=db_file):
+            raw_hash = get_body_hash(details)
+            if previous_raw_hashes.get(listing_id) != raw_hash:
+                details = self.transform_listing(details, parsed_date, add_computed_columns, minimal_config)
+            results.append((listing_id, raw_hash, details))
+        return results
+
+    def iterate_transformed_raw_dbs(
+        self,
+        dated_raw_dbs: list[tuple[str, datetime]],
+        add_computed_columns: bool = True,
+        minimal_config: bool = False,
+        skip_unchanged_listings: bool = True,
+    ) -> Iterator[tuple[str, datetime, list]]:
+        """
+        Transforms the raw DBs with transform_raw_db in separate processes, only a few DBs ahead of the one being
+        consumed are transformed at a time so they don't all end up in memory
+
+        :param dated_raw_dbs: The raw DBs and their dates, in the order they should be given back
+        :param add_computed_columns:
+        :param minimal_config:
+        :param skip_unchanged_listings: If the listings that didn't change since the previous DB can be left as raw JSON
+        :return: The DB, its date and what transform_raw_db gave for it
+        """
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            pending = deque()
+            for index, (db_file, db_date) in enumerate(dated_raw_dbs):
+                previous_db_file = dated_raw_dbs[index - 1][0] if skip_unchanged_listings and index > 0 else None
+                future = executor.submit(
+                    self.transform_raw_db, db_file, db_date, add_computed_columns, minimal_config, previous_db_file
+                )
+                pending.append((db_file, db_date, future))
+                if len(pending) > self.jobs:
+                    db_file, db_date, future = pending.popleft()
+                    yield db_file, db_date, future.result()
 
-                # Remove all data but the main Listings/$ object
-                if minimal_config:
-                    for keyname in list(results.keys()):
-                        if keyname != "$":
-                            del results[keyname]
+            while pending:
+                db_file, db_date, future = pending.popleft()
+                yield db_file, db_date, future.result()
 
-                # TODO: Make function below support config for keeping only columns and keys
-                # NOTE: With current setup there will only ever be one statement since we're only inserting the main item
-                statements = self.generate_sqlite_sql_for_inserting_split_item(
+    def insert_listings_into_db(
+        self,
+        listings: list[Union[dict, str]],
+        db_name: str,
+        parsed_date: datetime,
+        price_data: dict,
+        add_computed_columns: bool = True,
+        minimal_config: bool = False,
+        raw_hashes: Optional[dict[int, int]] = None,
+        batch_size: int = 1000,
+    ) -> set[int]:
+        """
+        The listings are transformed by iterate_transformed_listings, possibly in other processes, while this process
+        is the only one writing to the DB
+
+        :param listings: The listings or their raw JSON
+        :param db_name:
+        :param parsed_date:
+        :param price_data:
+        :param add_computed_columns:
+        :param minimal_config:
+        :param raw_hashes: The hash of the raw JSON of the listings by Id, the ones that are inserted without errors are
+            saved so they can be skipped next time if they haven't changed. Without them the saved hashes of the
+            listings are removed so they are parsed again next time.
+        :param batch_size: How many rows are written and committed together
+        :return: The Ids of the listings that had rows which could not be inserted
+        """
+        return self.insert_transformed_listings_into_db(
+            self.iterate_transformed_listings(listings, parsed_date, add_computed_columns, minimal_config),
+            db_name=db_name,
+            parsed_date=parsed_date,
+            price_data=price_data,
+            minimal_config=minimal_config,
+            raw_hashes=raw_hashes,
+            batch_size=batch_size,
+            total=len(listings),
+        )
+
+    def insert_transformed_listings_into_db(
+        self,
+        transformed_listings: Iterable[tuple[int, str, Any, dict]],
+        db_name: str,
+        parsed_date: datetime,
+        price_data: dict,
+        minimal_config: bool = False,
+        raw_hashes: Optional[dict[int, int]] = None,
+        batch_size: int = 1000,
+        total: Optional[int] = None,
+    ) -> set[int]:
+        """
+        Writes listings transformed by transform_listing in the order they are given
+
+        :param transformed_listings:
+        :param db_name:
+        :param parsed_date:
+        :param price_data:
+        :param minimal_config:
+        :param raw_hashes: See insert_listings_into_db
+        :param batch_size: How many rows are written and committed together
+        :param total: How many listings there are, only used for the progress bar
+        :return: The Ids of the listings that had rows which could not be inserted
+        """
+        limit_to_columns = (
+            self.minimal_columns + list(self.get_computed_columns(parsed_date)) if minimal_config else None
+        )
+        with closing(sqlite3.connect(db_name)) as connection:
+            insert_engine = BatchedInsertEngine(connection, batch_size=batch_size)
+            table_columns = {}
+            inserted_listing_ids = []
+            for listing_id, mls_number, price, results in tqdm(
+                transformed_listings, desc=f"Rows inserted into {db_name}", total=total
+            ):
+                # Realtor.ca adds fields every now and then, make room for them instead of failing to insert the rows
+                self.evolve_schema_for_split_items(
+                    connection,
                     results,
-                    # FIXME: This needs to be baked into argparse
                     default_table_key_name="Listings",
-                    limit_to_columns=(self.minimal_columns + list(computed_columns.keys()) if minimal_config else None),
+                    table_columns=table_columns,
+                    limit_to_columns=limit_to_columns,
                 )
-                with closing(connection.cursor()) as cursor:
-                    # Insert the items
-                    for statement in statements:
-                        try:
-                            cursor.execute(statement[0], statement[1])
-                        except sqlite3.OperationalError:
-                            logger.error(f'Failed to insert row:\n{statement[0]}\n{statement[1]}')
-
-                    # only insert price history if we don't have data for the current listing OR
-                    # the price differs and the db date is greater than what the last saved price was
-                    # WARNING: This of course assumes that we're parsing databases by oldest to newest
-                    # I'm doing this just so that I only have to store the latest price
-                    if listing["MlsNumber"] not in price_data or (
-                        price_data[listing["MlsNumber"]]["price"] != listing["Property"]["PriceUnformattedValue"]
-                        and parsed_date > price_data[listing["MlsNumber"]]["date"]
-                    ):
-                        price_data[listing["MlsNumber"]] = {
-                            "price": listing["Property"]["PriceUnformattedValue"],
-                            "date": parsed_date,
-                        }
-                        sql = """
-                        INSERT INTO PriceHistory (MlsNumber, Price, Date) VALUES (?, ?, ?);
-                        """
-                        price_history_values = [
-                            listing["MlsNumber"],
-                            listing["Property"]["PriceUnformattedValue"],
-                            parsed_date.isoformat(),
-                        ]
-                        cursor.execute(
-                            sql,
-                            price_history_values,
-                        )
-            # Need to commit after every db?
+
+                # The rows are buffered and written in batches, the ones going into the same table together
+                for table_name, row in self.get_rows_for_split_items(
+                    results,
+                    # FIXME: This needs to be baked into argparse
+                    default_table_key_name="Listings",
+                    limit_to_columns=limit_to_columns,
+                ):
+                    insert_engine.add_row(table_name, row, owner=listing_id)
+
+                inserted_listing_ids.append(listing_id)
+
+                # only insert price history if we don't have data for the current listing OR
+                # the price differs and the db date is greater than what the last saved price was
+                # WARNING: This of course assumes that we're parsing databases by oldest to newest
+                # I'm doing this just so that I only have to store the latest price
+                if mls_number not in price_data or (
+                    price_data[mls_number]["price"] != price and parsed_date > price_data[mls_number]["date"]
+                ):
+                    price_data[mls_number] = {
+                        "price": price,
+                        "date": parsed_date,
+                    }
+                    price_history_row = {
+                        "MlsNumber": mls_number,
+                        "Price": price,
+                        "Date": parsed_date.isoformat(),
+                    }
+                    insert_engine.add_row("PriceHistory", price_history_row, verb="INSERT")
+            insert_engine.flush()
+
+            with closing(connection.cursor()) as cursor:
+                if raw_hashes is not None:
+                    # Only the listings that were inserted without errors are skipped next time, the others will be
+                    # tried again
+                    cursor.executemany(
+                        "REPLACE INTO ListingRawHashes (Id, RawHash) VALUES (?, ?)",
+                        [(x, raw_hashes[x]) for x in inserted_listing_ids if x not in insert_engine.failed_owners],
+                    )
+                elif self.get_table_columns(connection, "ListingRawHashes"):
+                    # The saved hashes no longer match what the listings were last inserted from
+                    cursor.executemany(
+                        "DELETE FROM ListingRawHashes WHERE Id = ?", [(x,) for x in inserted_listing_ids]
+                    )
             connection.commit()
+            return insert_engine.failed_owners
 
     def merge_multiple_raw_dbs_into_single_db(
         self,
@@ -461,20 +730,46 @@ class RealtorJSONtoSQLAnalyzer(JSONtoSQLAnalyzer):
         add_computed_columns: bool = True,
         minimal_config: bool = False,
         skip_existing_dates: bool = False,
+        skip_unchanged_listings: bool = True,
+        use_schema_cache: bool = True,
+        insert_batch_size: int = 1000,
+        backfill: bool = False,
     ) -> None:
+        """
+        Inserts the listings of raw DBs into a single output DB, the raw DBs should be given from oldest to newest
+
+        :param new_db_name:
+        :param raw_dbs:
+        :param create_new_tables:
+        :param db_date:
+        :param add_computed_columns:
+        :param minimal_config:
+        :param skip_existing_dates:
+        :param skip_unchanged_listings: Listings whose raw JSON is the same as when they were last inserted are not parsed
+            again, only their ComputedLastUpdated is bumped. This should be turned off when the data_mutator changes.
+        :param use_schema_cache: See create_initial_tables
+        :param insert_batch_size: How many rows are written and committed together
+        :param backfill: Read and transform as many raw DBs at once as there are jobs instead of going through the
+            listings of one DB at a time, the DBs are still inserted from oldest to newest
+        :return:
+        """
 
         if create_new_tables:
-            self.create_initial_tables(new_db_name, add_computed_columns, minimal_config)
+            self.create_initial_tables(new_db_name, add_computed_columns, minimal_config, use_schema_cache)
 
         # FIXME: This could be a memory hog and should be done in SQL but all my attempts have sucked and didn't
         #  work or were super slow. The memory thing is only an issue when dealing with a whole DB and not prominent
         #  with live scraping which only has about 200 listings at a time
         price_data = self.get_existing_price_data(new_db_name)
 
+        # The hashes are always kept up to date, even when not skipping, so they can be trusted the next time we skip
+        existing_raw_hashes = self.get_existing_raw_hashes(new_db_name)
+
         latest_date_from_db = None
         if skip_existing_dates:
             latest_date_from_db = self.find_latest_price_date_from_db(new_db_name)
 
+        dated_raw_dbs = []
         for old_db_name in raw_dbs:
             # WARN: This is hacky and no guarantee on actual dates
             # If were merging multiple tables then we can't really rely on user input
@@ -495,17 +790,65 @@ class RealtorJSONtoSQLAnalyzer(JSONtoSQLAnalyzer):
                 logger.info(
                     f'Processing "{old_db_name}" because its date "{db_date}" is after the latest date "{latest_date_from_db}" found in the db'
                 )
+            dated_raw_dbs.append((old_db_name, db_date))
 
-            listings = self.get_items_from_db(db_file=old_db_name)
-            self.insert_listings_into_db(
-                listings,
-                db_name=new_db_name,
-                parsed_date=db_date,
-                price_data=price_data,
-                add_computed_columns=add_computed_columns,
-                minimal_config=minimal_config,
+        if backfill:
+            # The DBs are transformed out of order by other processes but always applied from oldest to newest
+            dated_raw_dbs.sort(key=lambda x: x[1])
+            raw_dbs_listings = self.iterate_transformed_raw_dbs(
+                dated_raw_dbs, add_computed_columns, minimal_config, skip_unchanged_listings
+            )
+        else:
+            raw_dbs_listings = (
+                (x, y, [(z[0], get_body_hash(z[1]), z[1]) for z in self.get_raw_items_from_db(db_file=x)])
+                for x, y in dated_raw_dbs
             )
 
+        for old_db_name, db_date, raw_listings in raw_dbs_listings:
+            raw_hashes = {}
+            unchanged_listing_ids = []
+            listings = []
+            for listing_id, raw_hash, listing in raw_listings:
+                if skip_unchanged_listings and existing_raw_hashes.get(listing_id) == raw_hash:
+                    unchanged_listing_ids.append(listing_id)
+                    continue
+                raw_hashes[listing_id] = raw_hash
+                # Left as JSON so it's parsed by whichever process transforms it
+                listings.append(listing)
+
+            if unchanged_listing_ids:
+                logger.info(f"{len(unchanged_listing_ids)}/{len(raw_listings)} listings did not change since last time")
+                if add_computed_columns:
+                    self.update_unchanged_listings(new_db_name, unchanged_listing_ids, db_date)
+
+            if backfill:
+                for index, listing in enumerate(listings):
+                    # The listings that were the same in the previous DB weren't transformed but still need to be inserted
+                    if isinstance(listing, str):
+                        listings[index] = self.transform_listing(listing, db_date, add_computed_columns, minimal_config)
+                failed_listing_ids = self.insert_transformed_listings_into_db(
+                    listings,
+                    db_name=new_db_name,
+                    parsed_date=db_date,
+                    price_data=price_data,
+                    minimal_config=minimal_config,
+                    raw_hashes=raw_hashes,
+                    batch_size=insert_batch_size,
+                    total=len(listings),
+                )
+            else:
+                failed_listing_ids = self.insert_listings_into_db(
+                    listings,
+                    db_name=new_db_name,
+                    parsed_date=db_date,
+                    price_data=price_data,
+                    add_computed_columns=add_computed_columns,
+                    minimal_config=minimal_config,
+                    raw_hashes=raw_hashes,
+                    batch_size=insert_batch_size,
+                )
+            existing_raw_hashes.update({x: y for x, y in raw_hashes.items() if x not in failed_listing_ids})
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -522,7 +865,7 @@ if __name__ == "__main__":
         nargs="+",
         type=Path,
         help="""The raw database file to perform analysis on. It must have a table named "Listings" and column "details".
-             Multiple tables can be provided for extra actions but analysis will only be perform on the first one""",
+             Multiple tables can be provided, analysis is performed on all of them together while conversion infers its schema from the first one""",
     )
 
     parser.add_argument(
@@ -557,6 +900,35 @@ if __name__ == "__main__":
         """,
     )
 
+    parser.add_argument(
+        "--json-tree",
+        action="store_true",
+        help="""Count the value types of the raw JSON in SQLite with json_tree instead of decoding every item in Python, which is much faster.
+        Your "data_mutator" is not applied this way so the results describe the raw data, not what would be converted.
+        """,
+    )
+
+    parser.add_argument(
+        "--sample",
+        type=int,
+        help="""Only analyze a random sample of this many items, which is much faster when working on your "data_mutator".
+        Statistics are printed for every column with the null rate's upper bound at 95% confidence.
+        """,
+    )
+
+    parser.add_argument(
+        "--max-null-rate",
+        type=float,
+        default=0.01,
+        help="When sampling, columns are only made NOT NULL if the upper bound of their null rate is under this",
+    )
+
+    parser.add_argument(
+        "--verify-sample",
+        action="store_true",
+        help="After sampling, analyze every item and print the columns whose types or nullability the sample got wrong",
+    )
+
     # TODO: Option to print minimal dict
     # TODO: Option to print the flattened version
     # TODO: Option to decided to flatten or not (default is flatten)
@@ -635,6 +1007,45 @@ if __name__ == "__main__":
         help="When multiple databases are provided, with this option we will skip any databases that appear to already have been parsed",
     )
 
+    parser.add_argument(
+        "--skip-unchanged-listings",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="""When converting, listings whose raw JSON is the same as when they were last inserted into the output database are not parsed again.
+        Only their ComputedLastUpdated is updated. Turn this off after changing the "data_mutator" so every listing is converted again.
+        """,
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="How many processes to infer the schema and transform the listings with, the rows of the databases are split between them",
+    )
+
+    parser.add_argument(
+        "--schema-cache",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="""When converting, reuse the schema saved in the output database if the first database and the settings haven't changed since it was inferred.
+        A change to the "data_mutator" is detected but not a change to the rest of the code.
+        """,
+    )
+
+    parser.add_argument(
+        "--insert-batch-size",
+        type=int,
+        default=1000,
+        help="When converting, how many rows are written to the output database and committed together",
+    )
+
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="When converting many databases, read and transform as many of them at once as there are jobs, they are still inserted by date",
+    )
+
     args = parser.parse_args()
 
     analyzer = RealtorJSONtoSQLAnalyzer(
@@ -642,22 +1053,54 @@ if __name__ == "__main__":
         city=args.city,
         item_mutator=RealtorJSONtoSQLAnalyzer.data_mutator,
         auto_convert_simple_types=args.auto_cast_value_types,
+        jobs=args.jobs,
     )
 
     if args.analyze:
-        merged_items = analyzer.convert_raw_db_to_json_and_merge_to_get_raw_schema()
+        num_items_in_db = None
+        if args.json_tree:
+            merged_items = analyzer.get_raw_schema_with_json_tree(args.database)
+        elif args.sample:
+            merged_items, num_items_in_db = analyzer.get_sampled_raw_schema(args.sample, args.database)
+        else:
+            merged_items = analyzer.convert_raw_db_to_json_and_merge_to_get_raw_schema(args.database)
         print(json.dumps(merged_items, indent=2))
-        if args.print_sql:
+        if num_items_in_db is None:
+            num_items_in_db = sum(analyzer.get_items_count_from_db(x) for x in args.database)
+
+        if args.print_sql or args.sample:
             results = {}
             # WARNING: This is what flattens our dict item by default
             analyzer.split_lists_from_item(merged_items, items_to_create=results)
 
+        cannot_be_not_null = None
+        if args.sample:
+            column_statistics = analyzer.get_column_statistics(results, num_items_in_db)
+            for column in column_statistics:
+                print(
+                    f'{column["column"]}: {dict(column["types"])}, {column["null_rate"]:.2%} null '
+                    f'(at most {column["null_rate_upper_bound"]:.2%} with 95% confidence)'
+                )
+            # Only trust the sample to make a column NOT NULL when it was seen enough times
+            cannot_be_not_null = [
+                x["name"] for x in column_statistics if x["null_rate_upper_bound"] > args.max_null_rate
+            ]
+
+        if args.print_sql:
             tables_to_create = analyzer.get_sqlite_sql_for_merged_counter_dict(
                 results,
                 default_table_key_name=args.new_table_name,
+                cannot_be_not_null=cannot_be_not_null,
+                num_items_in_db=num_items_in_db,
             )
             for table in tables_to_create:
                 print(table)
+
+        if args.sample and args.verify_sample:
+            mismatches = analyzer.verify_sampled_column_statistics(column_statistics, args.max_null_rate, args.database)
+            print(f"The sample got {len(mismatches)} columns wrong")
+            for mismatch in mismatches:
+                print(mismatch)
     elif args.convert:
         analyzer.merge_multiple_raw_dbs_into_single_db(
             new_db_name=args.output_database,
@@ -666,4 +1109,8 @@ if __name__ == "__main__":
             db_date=args.db_date,
             minimal_config=args.minimal,
             skip_existing_dates=args.skip_existing_db_dates,
+            skip_unchanged_listings=args.skip_unchanged_listings,
+            use_schema_cache=args.schema_cache,
+            insert_batch_size=args.insert_batch_size,
+            backfill=args.backfill,
         )
@@ -1,19 +1,37 @@
 import argparse
+import asyncio
 import json
 import logging
 import re
 import sqlite3
+import tempfile
 from contextlib import closing
-from datetime import datetime
-from math import ceil
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from random import randint
 from time import sleep
 from typing import Optional
 
-from queries import RealtorAPI
+from queries import REALTOR_API_URL, AsyncRealtorAPI, RealtorAPI
+from rate_governor import RateGovernor, UnlimitedRateGovernor
+from scrape_planner import (
+    MAX_PAGES_PER_QUERY,
+    ScrapePlanner,
+    build_price_histogram,
+    build_price_histogram_from_db,
+    get_bounds,
+    get_boxes_containing,
+    get_price_params,
+    get_total_pages,
+    get_union_tiles,
+    get_work_unit_key,
+    summarize_probe,
+)
+from cassette import Cassette
+from scrape_state import ScrapeState
+from job_queue import ScrapeJobQueue
+from page_store import RawPage, create_page_tables, write_page_to_db
+from delta_store import create_delta_tables, write_snapshot_to_db
 from RealtorJSONtoSQLAnalyzer import RealtorJSONtoSQLAnalyzer
-from requests import HTTPError
 from tqdm import tqdm
 from utils import CITIES, SORT_VALUES
 
@@ -26,9 +44,25 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# When any of these are newer than the details we have for a listing, the details need to be fetched again
+LISTING_CHANGE_DATE_COLUMNS = ["PriceChangeDateUTC", "PhotoChangeDateUTC", "OpenHouseInsertDateUTC"]
+
+# How long workers wait before checking again for jobs that other workers might still add or give up on
+WORKER_POLL_SECONDS = 5
+
 
 class RealtorRawScraper:
-    def __init__(self, city_name: str, db_type: str, database_file: Optional[Path] = None, create_db: bool = False):
+    def __init__(
+        self,
+        city_name: str,
+        db_type: str,
+        database_file: Optional[Path] = None,
+        create_db: bool = False,
+        governor: Optional[RateGovernor] = None,
+        state: Optional[ScrapeState] = None,
+        jobs: Optional[ScrapeJobQueue] = None,
+        api: Optional[RealtorAPI] = None,
+    ):
         self.city = city_name
         self.create_db = create_db
         self.db_type = db_type
@@ -36,14 +70,22 @@ class RealtorRawScraper:
         self.database_file = (
             database_file if database_file else f"{city_name}_{db_type}_{self.parse_date.date()}.sqlite"
         )
+        if db_type == "delta" and not database_file:
+            # Every day goes into the same delta store
+            self.database_file = f"{city_name}_delta.sqlite"
 
         self.parsed_mls_numbers = []
+        self.parsed_prices = []
+        # The cities listings are assigned to when scraping several cities at once
+        self.cities = {}
 
         self.connection = sqlite3.connect(self.database_file)
-        self.min_sleep_time = 100
         self.total_parsed = 0
 
-        self.api = RealtorAPI()
+        self.api = api if api else RealtorAPI()
+        self.governor = governor if governor else RateGovernor()
+        self.state = state if state else ScrapeState()
+        self.jobs = jobs if jobs else ScrapeJobQueue()
 
         if create_db and db_type == "raw":
             with closing(self.connection.cursor()) as cursor:
@@ -51,18 +93,40 @@ class RealtorRawScraper:
                     "CREATE TABLE IF NOT EXISTS listings (id INTEGER PRIMARY KEY, details TEXT NOT NULL, last_updated TEXT NOT NULL)"
                 )
                 self.connection.commit()
+        elif create_db and db_type == "pages":
+            create_page_tables(self.connection)
+        elif db_type == "delta":
+            create_delta_tables(self.connection)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.connection.close()
 
-    def cooldown(self, success: bool = True):
-        sleep_time = randint(
-            # WARN: If you set cookies from the browser this can be pretty low at 100s/page
-            self.min_sleep_time if success else self.min_sleep_time * 7,
-            self.min_sleep_time * 2 if success else self.min_sleep_time * 9,
-        )
-        logger.debug(f"Sleeping {sleep_time} seconds")
-        sleep(sleep_time)
+    def get_property_list(self, *args, **kwargs) -> dict:
+        """
+        Queries a page of listings once the rate governor allows it and reports back how the request went
+
+        :return: The raw response from realtor.ca
+        """
+        self.governor.acquire()
+        try:
+            if self.db_type == "pages":
+                # Keep the raw body so that the page can be stored as it came
+                response = RawPage(self.api.get_property_list_body(*args, **kwargs))
+            else:
+                response = self.api.get_property_list(*args, **kwargs)
+        except Exception as e:
+            self.governor.record_failure(RateGovernor.status_code_from_exception(e))
+            raise
+        self.governor.record_success()
+        return response
+
+    def get_lease_seconds(self, requests: int) -> float:
+        """
+        :param requests: How many requests have to go through the rate governor before the job is done or renewed
+        :return: How long to lease a job for so that the lease doesn't run out while waiting on the rate governor, with
+            room for the rate to be cut in half along the way
+        """
+        return max(self.jobs.lease_seconds, 2 * requests * 60 / self.governor.rate_per_minute)
 
     def write_response_results_to_raw_db(self, response: dict):
         """
@@ -96,6 +160,55 @@ class RealtorRawScraper:
 
         logger.info(f'Parsed {self.total_parsed}/{response["Paging"]["TotalRecords"]}')
 
+    def write_response_results_to_delta_db(self, response: dict):
+        """
+        Records the listings of a page in today's snapshot of the delta store, only the listings that changed since
+        they were last seen have their JSON stored again
+
+        :param response: The raw response from realtor.ca
+        :return:
+        """
+        logger.info(response["Paging"])
+
+        batch_of_parsed_mls_numbers = [x.get("MlsNumber") for x in response["Results"]]
+        self.parsed_mls_numbers.extend(batch_of_parsed_mls_numbers)
+
+        if not response["Results"]:
+            logger.error(f"Response data had 0 listings")
+        new_bodies = write_snapshot_to_db(
+            self.connection, str(self.parse_date.date()), [(x["Id"], json.dumps(x)) for x in response["Results"]]
+        )
+        self.total_parsed += len(response["Results"])
+
+        logger.info(
+            f'Parsed {self.total_parsed}/{response["Paging"]["TotalRecords"]}, {new_bodies} of the page\'s listings changed'
+        )
+
+    def write_response_page_to_raw_db(self, response: RawPage):
+        """
+        Stores the raw body of a page once along with where each listing is in it, the listings can still be read as
+        JSON strings through the listings view
+
+        :param response: The page as returned by get_property_list in "pages" mode
+        :return:
+        """
+        logger.info(response["Paging"])
+
+        batch_of_parsed_mls_numbers = [x.get("MlsNumber") for x in response["Results"]]
+        number_already_parsed = len(set(self.parsed_mls_numbers).intersection(batch_of_parsed_mls_numbers))
+        if number_already_parsed > 2:
+            logger.info(
+                f"{number_already_parsed} of the {len(batch_of_parsed_mls_numbers)} items we parsed this batch had already been parsed"
+            )
+
+        self.parsed_mls_numbers.extend(batch_of_parsed_mls_numbers)
+
+        if not response["Results"]:
+            logger.error(f"Response data had 0 listings")
+        self.total_parsed += write_page_to_db(self.connection, response, str(self.parse_date.date()))
+
+        logger.info(f'Parsed {self.total_parsed}/{response["Paging"]["TotalRecords"]}')
+
     def parse_responses_and_update_db(self, response: dict):
         """
         Converts the raw responses and appends them to either a minimal or full db
@@ -139,25 +252,128 @@ class RealtorRawScraper:
 
         logger.info(f'Parsed {self.total_parsed}/{response["Paging"]["TotalRecords"]}')
 
+    def store_response(self, response: dict):
+        """
+        Stores a page of listings in whichever format the scraper DB uses
+
+        :param response: The raw response from realtor.ca
+        :return:
+        """
+        for listing in response["Results"]:
+            try:
+                self.parsed_prices.append(round(float(listing["Property"]["PriceUnformattedValue"])))
+            except (KeyError, ValueError):
+                pass
+
+        if self.db_type == "raw":
+            self.write_response_results_to_raw_db(response)
+        elif self.db_type == "pages":
+            self.write_response_page_to_raw_db(response)
+        elif self.db_type == "delta":
+            self.write_response_results_to_delta_db(response)
+        else:
+            # TODO: Support parsing the whole db and then analyzing responses to create a DB
+            if self.create_db:
+                raise Exception("Currently analyzing all responses and creating a new DB is not supported")
+            else:
+                self.parse_responses_and_update_db(response)
+
+        if self.cities:
+            self.write_listing_cities_to_db(response)
+
+    def write_listing_cities_to_db(self, response: dict):
+        """
+        Records which of the scraped cities every listing is in
+
+        :param response: The raw response from realtor.ca
+        :return:
+        """
+        scraped_date_str = str(self.parse_date.date())
+        listing_cities = []
+        for listing in response["Results"]:
+            try:
+                latitude = float(listing["Property"]["Address"]["Latitude"])
+                longitude = float(listing["Property"]["Address"]["Longitude"])
+            except (KeyError, ValueError):
+                logger.warning(f"Listing {listing.get('Id')} has no coordinates, it can't be assigned to a city")
+                continue
+            listing_cities.extend(
+                (listing["Id"], city, scraped_date_str)
+                for city in get_boxes_containing(latitude, longitude, self.cities)
+            )
+
+        with closing(self.connection.cursor()) as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO listing_cities (id, city, last_updated) VALUES(?, ?, ?)", listing_cities
+            )
+            self.connection.commit()
+
+    def parse_cities(self, city_names: list[str], **parse_options):
+        """
+        Scrapes several cities at once, where the city boxes overlap the listings are only requested once
+
+        The union of the city boxes is scraped as boxes that don't overlap and every listing is assigned to the cities
+        whose box it is in through the listing_cities table.
+
+        :param city_names: Names of CITIES entries
+        :param parse_options: Passed on to parse_listings for every box, such as prices or tiling
+        :return:
+        """
+        self.cities = {x: CITIES[x] for x in city_names}
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS listing_cities (id INTEGER NOT NULL, city TEXT NOT NULL, last_updated TEXT NOT NULL, PRIMARY KEY (id, city))"
+            )
+            self.connection.commit()
+
+        union_tiles = get_union_tiles(list(self.cities.values()))
+        union_area = sum((x[1] - x[0]) * (x[3] - x[2]) for x in map(get_bounds, union_tiles))
+        total_area = sum((x[1] - x[0]) * (x[3] - x[2]) for x in map(get_bounds, self.cities.values()))
+        logger.info(
+            f"Scraping {len(city_names)} cities as {len(union_tiles)} boxes covering {union_area / total_area:.0%} of the area of the city boxes"
+        )
+        for union_tile in union_tiles:
+            self.parse_listings(coordinates=union_tile, **parse_options)
+
     def parse_listings(
         self,
         min_price: Optional[int] = None,
         max_price: Optional[int] = None,
         min_bedrooms: Optional[int] = None,
         coordinates: Optional[dict[str, str]] = None,
+        tiled: bool = False,
+        price_banded: bool = False,
+        skip_unchanged: Optional[str] = None,
+        full_sweep_days: Optional[int] = None,
+        resume: bool = True,
+        worker: bool = False,
     ):
-        if coordinates:
-            latitude_min = coordinates["LatitudeMin"]
-            latitude_max = coordinates["LatitudeMax"]
-            longitude_min = coordinates["LongitudeMin"]
-            longitude_max = coordinates["LongitudeMax"]
-        else:
-            latitude_min = CITIES[self.city]["LatitudeMin"]
-            latitude_max = CITIES[self.city]["LatitudeMax"]
-            longitude_min = CITIES[self.city]["LongitudeMin"]
-            longitude_max = CITIES[self.city]["LongitudeMax"]
-
-        raw_responses = []
+        """
+        Scrapes all the listings in the city or the given coordinates
+
+        The tiles and pages to parse are kept as jobs so that if the scrape crashes, running it again on the same day
+        continues from where it stopped instead of starting over. The same jobs let several workers share a scrape,
+        whoever starts first plans the tiles and everyone then leases tiles, and pages of other workers' tiles, until
+        there is nothing left.
+
+        :param min_price:
+        :param max_price:
+        :param min_bedrooms:
+        :param coordinates: The box to scrape listings in, defaults to the city's box
+        :param tiled: Split the box into tiles small enough that every listing can be reached going by "Newest" order
+        :param price_banded: Split the price range into bands small enough that every listing can be reached going by
+            "Newest" order, the bands are cut using the price histogram of the previous scrapes
+        :param skip_unchanged: Probe every tile with a single small request first and reuse the tiles planned by the
+            previous scrape. Tiles that look the same as last time are either skipped with "skip" or only have their
+            first page parsed with "first-page"
+        :param full_sweep_days: Scrape incrementally by stopping at the first page of listings we've already seen.
+            Every tile is still fully paged through if it hasn't been in this many days.
+        :param resume: Continue today's scrape of the same area if it was interrupted, otherwise start it over
+        :param worker: Other processes are scraping the same area with the same job queue
+        :return:
+        """
+        if not coordinates:
+            coordinates = CITIES[self.city]
 
         query_params = {"current_page": 1}
         if min_price:
@@ -167,95 +383,419 @@ class RealtorRawScraper:
         if min_bedrooms:
             query_params["bed_range"] = min_bedrooms
 
-        total_pages = 1
+        planner = ScrapePlanner(self.get_property_list)
+        plan_type = "price-banded" if price_banded else "tiled" if tiled else "whole"
+        plan_key = f"{self.city}|{plan_type}|{get_work_unit_key(coordinates, query_params)}"
+        run_key = f"{self.parse_date.date()}|{self.db_type}|{self.database_file}|{plan_key}"
+
+        if not resume:
+            self.jobs.delete_run(run_key)
+        if not worker:
+            # Nobody else works on our run so anything still leased was left behind by a scrape that crashed
+            self.jobs.release_leases(run_key)
+            self.jobs.reset_failed_jobs(run_key)
+
+        first_page_responses = {}
+        resumed = True
+        self.jobs.add_jobs(run_key, "plan", [(plan_key, {})])
+        while self.jobs.has_unfinished_jobs(run_key, "plan"):
+            # Renewed after every probe so that no other worker plans the scrape again while we wait on the governor
+            plan_job = self.jobs.lease_job(run_key, "plan", lease_seconds=self.get_lease_seconds(2))
+            if not plan_job:
+                logger.info("Waiting for another worker to finish planning the scrape")
+                sleep(WORKER_POLL_SECONDS)
+                continue
+
+            resumed = False
+            saved_tiles = self.state.get_work_units(plan_key) if skip_unchanged else []
+
+            def renew_plan_lease():
+                self.jobs.renew_lease(plan_job["JobId"], self.get_lease_seconds(2))
+
+            try:
+                if saved_tiles:
+                    logger.info(f"Reusing the {len(saved_tiles)} tiles planned by the previous scrape")
+                    tiles = [(tile, None) for tile in saved_tiles]
+                elif price_banded:
+                    tiles = planner.plan_price_bands(
+                        coordinates, query_params, self.get_price_histogram(coordinates), after_probe=renew_plan_lease
+                    )
+                elif tiled:
+                    tiles = planner.plan_tiles(coordinates, query_params, after_probe=renew_plan_lease)
+                else:
+                    # Parse the first page because it contains details about how many pages there are
+                    tiles = [(coordinates, self.get_property_list(*get_bounds(coordinates), **query_params))]
+
+            except Exception:
+                logger.error(f"Failed planning the scrape of {self.city} ({get_bounds(coordinates)})")
+                # Give the plan back right away instead of holding it until the lease runs out
+                self.jobs.fail_job(plan_job["JobId"])
+                self.connection.close()
+                raise
+
+            first_page_responses = {get_work_unit_key(tile, query_params): response for tile, response in tiles}
+            self.jobs.add_jobs(run_key, "tile", [(get_work_unit_key(tile, query_params), tile) for tile, _ in tiles])
+            self.jobs.complete_job(plan_job["JobId"])
+
+        if resumed:
+            logger.info(f"Continuing the scrape, jobs so far: {dict(self.jobs.get_run_progress(run_key))}")
+
+        total_pages = 0
+        while self.jobs.has_unfinished_jobs(run_key):
+            # Enough for probing the tile and getting its first page, parse_tile renews it after every page
+            tile_job = self.jobs.lease_job(run_key, "tile", lease_seconds=self.get_lease_seconds(3))
+            if not tile_job:
+                if not worker:
+                    break
+                # Help the workers that are still paging through their tiles
+                if page_job := self.jobs.lease_job(run_key, "page", lease_seconds=self.get_lease_seconds(1)):
+                    self.parse_page_job(run_key, page_job, query_params, full_sweep_days=full_sweep_days)
+                    total_pages += 1
+                else:
+                    sleep(WORKER_POLL_SECONDS)
+                continue
+
+            tile = tile_job["Payload"]
+            tile_key = tile_job["JobKey"]
+            first_page_response = first_page_responses.pop(tile_key, None)
+            logger.info(f"Parsing tile {get_bounds(tile)}, jobs so far: {dict(self.jobs.get_run_progress(run_key))}")
+
+            probe_summary = None
+            if skip_unchanged:
+                if first_page_response is None:
+                    probe_summary = summarize_probe(planner.probe_work_unit(tile, query_params))
+                    if probe_summary["TotalRecords"] > planner.max_listings:
+                        logger.info(f"Tile {get_bounds(tile)} has grown past the page cap and will be planned again")
+                        split_tile_jobs = []
+                        split_tiles = planner.plan_work_units(
+                            [tile],
+                            query_params,
+                            after_probe=lambda: self.jobs.renew_lease(tile_job["JobId"], self.get_lease_seconds(2)),
+                        )
+                        for split_tile, response in split_tiles:
+                            split_tile_key = get_work_unit_key(split_tile, query_params)
+                            first_page_responses[split_tile_key] = response
+                            split_tile_jobs.append((split_tile_key, split_tile))
+                        self.jobs.add_jobs(run_key, "tile", split_tile_jobs)
+                        self.jobs.complete_job(tile_job["JobId"], result="split")
+                        continue
+                else:
+                    probe_summary = summarize_probe(first_page_response)
+
+                if probe_summary == self.state.get_tile_probe(tile_key):
+                    if skip_unchanged == "skip":
+                        logger.info(f"Skipping tile {get_bounds(tile)} since nothing changed since the last scrape")
+                    else:
+                        logger.info(
+                            f"Only parsing the first page of {get_bounds(tile)} since nothing seems to have changed"
+                        )
+                        self.store_response(first_page_response or self.get_first_page(tile, query_params))
+                        total_pages += 1
+                    self.jobs.complete_job(tile_job["JobId"], result="unchanged")
+                    continue
 
-        try:
-            # Parse the first page because it contains details about how many pages there are
-            response = self.api.get_property_list(
-                latitude_min, latitude_max, longitude_min, longitude_max, **query_params
+            total_pages += self.parse_tile(
+                tile,
+                query_params,
+                first_page_response,
+                full_sweep_days=full_sweep_days,
+                run_key=run_key,
+                tile_job_id=tile_job["JobId"],
             )
+            self.jobs.complete_job(tile_job["JobId"])
+
+            if probe_summary:
+                self.state.save_tile_probe(tile_key, probe_summary)
 
-        except HTTPError:
-            logger.error(
-                f"Failed retrieving response for first page of {self.city} ({latitude_min}, {latitude_max}, {longitude_min}, {longitude_max})"
+        tile_jobs = self.jobs.get_jobs(run_key, "tile")
+        planned_tiles = [x["Payload"] for x in tile_jobs if x["Result"] != "split"]
+        skipped_tiles = len([x for x in tile_jobs if x["Result"] == "unchanged"])
+
+        if skip_unchanged:
+            self.state.save_work_units(plan_key, planned_tiles)
+
+        logger.info(f"Completed while parsing {total_pages} pages and {len(self.parsed_mls_numbers)} listings")
+        if skipped_tiles:
+            logger.info(f"{skipped_tiles} tiles were unchanged since the last scrape")
+
+        # The histogram is only trustworthy if we've seen every listing in the city during this run
+        full_city = coordinates is CITIES.get(self.city) and (price_banded or tiled)
+        if full_city and not skipped_tiles and not resumed and not worker:
+            self.state.save_price_histogram(
+                self.city,
+                build_price_histogram(self.parsed_prices),
+                query_params.get("price_min", 0),
+                query_params.get("price_max", 50000000),
             )
-            self.connection.close()
-            raise
 
-        total_pages = ceil(response["Paging"]["TotalRecords"] / response["Paging"]["RecordsPerPage"])
+        self.api.save_cookies()
 
-        # Insert the date for the first page
-        if self.db_type == "raw":
-            self.write_response_results_to_raw_db(response)
+    def get_first_page(self, coordinates: dict, query_params: dict) -> dict:
+        return self.get_property_list(
+            *get_bounds(coordinates),
+            **{**query_params, **get_price_params(coordinates), "current_page": 1, "sort": SORT_VALUES["Newest"]},
+        )
+
+    def get_price_histogram(self, coordinates: dict) -> list[tuple[int, int, int]]:
+        """
+        Gets the price histogram saved by the previous scrape of the city, if there is none and we're storing listings
+        in a full or minimal DB we can build one from the listings already in it
+
+        :param coordinates: The box being scraped
+        :return: The (price min, price max, number of listings) buckets ordered by price
+        """
+        price_histogram = self.state.get_price_histogram(self.city)
+        if not price_histogram and self.db_type not in ["raw", "pages", "delta"]:
+            logger.info(f"No saved price histogram for {self.city}, building one from {self.database_file}")
+            price_histogram = build_price_histogram_from_db(self.database_file, coordinates)
+        return price_histogram
+
+    def parse_tile(
+        self,
+        coordinates: dict,
+        query_params: dict,
+        first_page_response: Optional[dict],
+        full_sweep_days: Optional[int] = None,
+        run_key: Optional[str] = None,
+        tile_job_id: Optional[int] = None,
+    ) -> int:
+        """
+        Pages through all the listings in a box
+
+        Every page is a job in the given run, if the tile was already started by a scrape that crashed only the pages
+        that weren't parsed yet are requested.
+
+        :param coordinates: The box to scrape listings in, optionally limited to a PriceMin and PriceMax
+        :param query_params: Extra query parameters such as prices or bedrooms
+        :param first_page_response: The already retrieved first page going by "Newest" order, if there is one
+        :param full_sweep_days: When provided, stop paging once we reach a page of listings that are all older than
+            the previous scrape's watermark and that we have already seen without any changes. Every box still gets
+            fully paged through if it hasn't been in this many days.
+        :param run_key: The run the page jobs belong to, defaults to a run for this tile alone
+        :param tile_job_id: The leased tile job the tile is being paged through for, its lease is renewed after every
+            page so other workers don't page through the tile too
+        :return: The number of pages that were parsed
+        """
+        query_params = {**query_params, **get_price_params(coordinates)}
+        tile_key = get_work_unit_key(coordinates, query_params)
+        run_key = run_key if run_key else f"{self.parse_date.date()}|{self.db_type}|{self.database_file}|{tile_key}"
+        page_job_prefix = f"{tile_key}|"
+
+        watermark = None
+        if full_sweep_days is not None:
+            watermark = self.state.get_watermark(tile_key, full_sweep_days)
+            if not watermark:
+                logger.info(f"Fully paging through {get_bounds(coordinates)} since it is due for a full sweep")
+
+        parsed_pages = 0
+        reached_watermark = False
+        if self.jobs.has_jobs(run_key, "page", page_job_prefix):
+            logger.info(f"Resuming the pages of {get_bounds(coordinates)} that were not parsed yet")
+            # The first page is only needed to count the pages and it was already parsed
+            first_page_response = None
         else:
-            # TODO: Support parsing the whole db and then analyzing responses to create a DB
-            if self.create_db:
-                raise Exception("Currently analyzing all responses and creating a new DB is not supported")
-                # raw_responses.extend(response["Results"])
-            else:
-                self.parse_responses_and_update_db(response)
+            if first_page_response is None:
+                first_page_response = self.get_first_page(coordinates, query_params)
 
-        if total_pages > 50:
-            logger.info(
-                f"There are {total_pages} pages listed and we can only parse 50 so we will need to parse forwards and backwards"
+            total_pages = get_total_pages(first_page_response)
+
+            # Insert the date for the first page
+            reached_watermark = self.store_response_and_check_watermark(
+                first_page_response, watermark, remember_listings=full_sweep_days is not None
             )
-        if total_pages > 100:
-            logger.warning(f"There are {total_pages} pages listed but we can only parse 100 so data will be missed")
+            parsed_pages += 1
 
-        parse_forward = 50 if total_pages > 50 else total_pages
-        parse_backward = total_pages - 50 if total_pages > 50 else 0
+            if total_pages > MAX_PAGES_PER_QUERY:
+                logger.info(
+                    f"There are {total_pages} pages listed and we can only parse {MAX_PAGES_PER_QUERY} so we will need to parse forwards and backwards"
+                )
+            if total_pages > MAX_PAGES_PER_QUERY * 2:
+                logger.warning(
+                    f"There are {total_pages} pages listed but we can only parse {MAX_PAGES_PER_QUERY * 2} so data will be missed"
+                )
 
-        pages_to_parse = [(page_number, "Newest") for page_number in range(2, parse_forward + 1)] + [
-            (page_number, "Oldest") for page_number in range(1, parse_backward + 1)
-        ]
+            parse_forward = min(total_pages, MAX_PAGES_PER_QUERY)
+            parse_backward = max(total_pages - MAX_PAGES_PER_QUERY, 0)
 
-        self.cooldown()
+            pages_to_parse = [(page_number, "Newest") for page_number in range(2, parse_forward + 1)] + [
+                (page_number, "Oldest") for page_number in range(1, parse_backward + 1)
+            ]
+            self.jobs.add_jobs(
+                run_key,
+                "page",
+                [
+                    (
+                        f"{page_job_prefix}{sort_name}|{page_number}",
+                        {"page": page_number, "sort": sort_name, "tile": coordinates, "tile_key": tile_key},
+                    )
+                    for page_number, sort_name in pages_to_parse
+                ],
+            )
 
+        progress = tqdm()
         # WARN: We can't seem to go past 50 pages, when this happens we get back zero results
-        for page_number, sort_name in tqdm(pages_to_parse):
-            query_params["sort"] = SORT_VALUES[sort_name]
-            query_params["current_page"] = page_number
+        while not reached_watermark and (
+            page_job := self.jobs.lease_job(run_key, "page", page_job_prefix, lease_seconds=self.get_lease_seconds(1))
+        ):
+            reached_watermark = self.parse_page_job(run_key, page_job, query_params, full_sweep_days=full_sweep_days)
+            parsed_pages += 1
+            progress.update()
+            if tile_job_id is not None:
+                self.jobs.renew_lease(tile_job_id, self.get_lease_seconds(2))
+        progress.close()
+
+        if reached_watermark:
+            # Everything past this page, including the "Oldest" pages, was already seen by a previous scrape
+            logger.info(f"Stopping at page #{parsed_pages} since it only had listings we have already seen")
+            self.jobs.complete_jobs_with_prefix(run_key, "page", page_job_prefix, result="watermark")
+
+        if full_sweep_days is not None and first_page_response:
+            newest_inserted_date = max(
+                (x["InsertedDateUTC"] for x in first_page_response["Results"] if "InsertedDateUTC" in x), default=None
+            )
+            self.state.save_watermark(tile_key, newest_inserted_date, full_sweep=not reached_watermark)
 
-            logger.info(f"Parsing page #{page_number} going by {sort_name} order")
-            success = False
-            attempts = 1
+        return parsed_pages
 
-            while not success:
-                try:
-                    response = self.api.get_property_list(
-                        latitude_min, latitude_max, longitude_min, longitude_max, **query_params
-                    )
+    def parse_page_job(
+        self, run_key: str, page_job: dict, query_params: dict, full_sweep_days: Optional[int] = None
+    ) -> bool:
+        """
+        Retrieves and stores a page of a tile, the page may belong to a tile another worker is paging through
 
-                    # Insert the date for the current page
-                    if self.db_type == "raw":
-                        self.write_response_results_to_raw_db(response)
-                    else:
-                        # TODO: Support parsing the whole db and then analyzing responses to create a DB
-                        if self.create_db:
-                            raise Exception("Currently analyzing all responses and creating a new DB is not supported")
-                            # raw_responses.extend(response["Results"])
-                        else:
-                            self.parse_responses_and_update_db(response)
-
-                    success = True
-                # Too many damn errors to handle
-                except Exception:
-                    logger.error(f"Attempt #{attempts}: Error occurred on city: {self.city}")
-                    attempts += 1
-                    if attempts > 4:
-                        raise Exception("Too many failed attempts. Refresh cookies and try again")
-                finally:
-                    self.cooldown(success)
+        :param run_key: The run the page job belongs to
+        :param page_job: A leased page job added by parse_tile
+        :param query_params: Extra query parameters such as prices or bedrooms
+        :param full_sweep_days: See parse_tile
+        :return: If the page reached the previous scrape's watermark, the rest of the tile's pages are then marked done
+        """
+        tile = page_job["Payload"]["tile"]
+        tile_key = page_job["Payload"]["tile_key"]
+        page_number = page_job["Payload"]["page"]
+        sort_name = page_job["Payload"]["sort"]
+        query_params = {
+            **query_params,
+            **get_price_params(tile),
+            "sort": SORT_VALUES[sort_name],
+            "current_page": page_number,
+        }
+        watermark = self.state.get_watermark(tile_key, full_sweep_days) if full_sweep_days is not None else None
 
-        logger.info(f"Completed while parsing {total_pages} pages and {len(self.parsed_mls_numbers)} listings")
+        logger.info(f"Parsing page #{page_number} of {get_bounds(tile)} going by {sort_name} order")
+        success = False
+        attempts = 1
 
-        if self.create_db:
-            logger.info(f"Analyzing {len(raw_responses)} listings in order to create a new DB")
+        # WARN: We can't seem to go past 50 pages, when this happens we get back zero results
+        while not success:
+            try:
+                response = self.get_property_list(*get_bounds(tile), **query_params)
 
-        self.api.save_cookies()
+                # Insert the date for the current page
+                page_reached_watermark = self.store_response_and_check_watermark(
+                    response, watermark, remember_listings=full_sweep_days is not None
+                )
+                reached_watermark = sort_name == "Newest" and page_reached_watermark
+
+                success = True
+            # Too many damn errors to handle
+            except Exception:
+                logger.error(f"Attempt #{attempts}: Error occurred on city: {self.city}")
+                attempts += 1
+                if attempts > 4:
+                    # Only one failed attempt is recorded for all the retries of a lease
+                    self.jobs.fail_job(page_job["JobId"])
+                    raise Exception("Too many failed attempts. Refresh cookies and try again")
+                # Keep the page while retrying it so no other worker picks it up, the governor may have slowed down
+                self.jobs.renew_lease(page_job["JobId"], self.get_lease_seconds(1))
+        self.jobs.complete_job(page_job["JobId"])
+
+        if reached_watermark:
+            self.jobs.complete_jobs_with_prefix(run_key, "page", f"{tile_key}|", result="watermark")
+        return reached_watermark
+
+    def store_response_and_check_watermark(
+        self, response: dict, watermark: Optional[str], remember_listings: bool = False
+    ) -> bool:
+        """
+        Stores a page of listings and checks if it's past the previous scrape's watermark
+
+        :param response: The raw response from realtor.ca
+        :param watermark: The newest InsertedDateUTC of the previous scrape, None if we can't stop early
+        :param remember_listings: Save the listings as seen so that the next scrapes can stop when they reach them
+        :return: If every listing on the page is older than the watermark and was already seen without any changes
+        """
+        reached_watermark = (
+            watermark is not None
+            and len(response["Results"]) > 0
+            and all(x.get("InsertedDateUTC", "") <= watermark for x in response["Results"])
+            and self.state.all_listings_seen(response["Results"])
+        )
+        self.store_response(response)
+        if remember_listings:
+            self.state.mark_listings_seen(response["Results"])
+        return reached_watermark
+
+    def parse_raw_listings_details(
+        self,
+        listings: list[dict],
+        details_db: Path,
+        max_in_flight: int = 4,
+        max_age_days: Optional[int] = 30,
+        worker: bool = False,
+    ):
+        """
+        Fetches the details of every listing that changed since we last fetched them and stores the raw responses in
+        the details DB
+
+        Listings are fed through a queue to a pool of consumers so that several requests can be waiting on the server
+        at once while the request rate is still set by the scraper's rate governor. Every listing is also a job so that
+        failed listings are retried and an interrupted run continues with the listings it didn't get to. The jobs are
+        shared by every city scraped that day so a listing that falls in several cities only has its details fetched
+        once, even when the cities are handled by different workers.
+
+        :param listings: The listings to retrieve details for, must have an Id and MlsNumber
+        :param details_db: The DB that raw detail responses are stored in
+        :param max_in_flight: The maximum number of requests waiting on a response at the same time
+        :param max_age_days: Details older than this many days are fetched again even if the listing didn't change,
+            None to only fetch them again when the listing changes
+        :param worker: Other processes are fetching details with the same job queue
+        :return:
+        """
+        asyncio.run(
+            self.parse_raw_listings_details_async(
+                listings, details_db, max_in_flight=max_in_flight, max_age_days=max_age_days, worker=worker
+            )
+        )
 
-    def parse_raw_listings_details(self, listings: list[dict], details_db: Path):
-        previously_parsed_ids = []
+    @staticmethod
+    def listing_details_are_stale(listing: dict, details_last_updated: str, max_age_days: Optional[int]) -> bool:
+        """
+        :param listing: A listing from get_listings_from_db, the change dates are used when they were selected
+        :param details_last_updated: When the stored details were fetched, in local time
+        :param max_age_days: Details older than this many days are always stale
+        :return: If the listing changed after its details were fetched or the details are too old
+        """
+        last_updated = datetime.fromisoformat(details_last_updated)
+        if max_age_days is not None and datetime.now() - last_updated > timedelta(days=max_age_days):
+            return True
+
+        # The change dates are in UTC while we saved the details in local time
+        last_updated_utc = last_updated.astimezone(timezone.utc).replace(tzinfo=None)
+        for change_date_column in LISTING_CHANGE_DATE_COLUMNS:
+            change_date = listing.get(change_date_column)
+            if change_date and datetime.fromisoformat(change_date) > last_updated_utc:
+                return True
+        return False
+
+    async def parse_raw_listings_details_async(
+        self,
+        listings: list[dict],
+        details_db: Path,
+        max_in_flight: int = 4,
+        max_age_days: Optional[int] = 30,
+        worker: bool = False,
+    ):
+        previously_parsed_dates = {}
         with closing(sqlite3.connect(details_db)) as connection:
             with closing(connection.cursor()) as cursor:
                 cursor.execute(
@@ -264,34 +804,85 @@ class RealtorRawScraper:
                 connection.commit()
 
             with closing(connection.cursor()) as cursor:
-                results = cursor.execute("SELECT id FROM listings").fetchall()
+                results = cursor.execute("SELECT id, last_updated FROM listings").fetchall()
                 if results:
-                    previously_parsed_ids = [x[0] for x in results]
-
-        with closing(sqlite3.connect(details_db)) as connection:
-            for listing in tqdm(listings):
-                if listing["Id"] in previously_parsed_ids:
-                    logger.debug(f"Already parsed {listing['Id']}")
+                    previously_parsed_dates = {x[0]: x[1] for x in results}
+
+        listings_to_parse = []
+        for listing in listings:
+            if listing["Id"] in previously_parsed_dates and not self.listing_details_are_stale(
+                listing, previously_parsed_dates[listing["Id"]], max_age_days
+            ):
+                logger.debug(f"Already parsed {listing['Id']} and it hasn't changed since")
+                continue
+            listings_to_parse.append(listing)
+        logger.info(f"{len(listings_to_parse)} of {len(listings)} listings need their details fetched")
+
+        run_key = f"{self.parse_date.date()}|details|{details_db}"
+        self.jobs.add_jobs(run_key, "details", [(str(x["Id"]), x) for x in listings_to_parse])
+        if not worker:
+            # Nobody else works on our run so anything still leased was left behind by a run that crashed
+            self.jobs.release_leases(run_key)
+            self.jobs.reset_failed_jobs(run_key)
+
+        async_api = AsyncRealtorAPI(self.api, max_in_flight=max_in_flight, governor=self.governor)
+        listing_queue = asyncio.Queue(maxsize=max_in_flight * 2)
+        progress = tqdm()
+
+        async def produce_listings():
+            # Failed listings go back to pending so they get leased again until they run out of attempts
+            while True:
+                # The job may have to wait for everything in the queue and in flight to be sent before it is dequeued
+                lease_seconds = self.get_lease_seconds(max_in_flight * 3)
+                if job := self.jobs.lease_job(run_key, "details", lease_seconds=lease_seconds):
+                    await listing_queue.put(job)
+                elif not listing_queue.empty() or any(x is not None for x in consumer_jobs):
+                    # Wait for the listings being worked on in case some of them fail and need to be retried
+                    await asyncio.sleep(0.1)
+                elif worker and self.jobs.has_unfinished_jobs(run_key):
+                    # Same for the listings other workers are working on, their leases could run out
+                    await asyncio.sleep(WORKER_POLL_SECONDS)
+                else:
+                    break
+            for _ in range(max_in_flight):
+                await listing_queue.put(None)
+
+        # The job each consumer is working on, so the producer knows when there is nothing left that could be retried
+        consumer_jobs = [None] * max_in_flight
+
+        async def consume_listings(connection: sqlite3.Connection, consumer_number: int):
+            while (job := await listing_queue.get()) is not None:
+                # Then it only has to wait for the requests in flight, if the lease ran out someone else is on it
+                if not self.jobs.renew_lease(job["JobId"], self.get_lease_seconds(max_in_flight)):
+                    logger.info(f"Another worker took over the details of {job['Payload']['Id']}")
                     continue
-                # TODO: Retry mechanism
-                # TODO: Remove listings which we already have recent data for withing x days, likely via other function
+                consumer_jobs[consumer_number] = job
+                listing = job["Payload"]
                 try:
-                    # Parse the first page because it contains details about how many pages there are
-                    response = self.api.get_property_details(
+                    response = await async_api.get_property_details(
                         property_id=listing["Id"], mls_reference_number=listing["MlsNumber"]
                     )
+                    # All consumers run on the event loop thread so they can share the connection
                     with closing(connection.cursor()) as cursor:
                         cursor.execute(
                             "INSERT OR REPLACE INTO listings (id, details, last_updated) VALUES(?, ?, ?)",
                             [listing["Id"], json.dumps(response), datetime.now().isoformat()],
                         )
                         connection.commit()
+                    self.jobs.complete_job(job["JobId"])
 
                 except Exception:
+                    # The rate governor has already been told about the failure and will slow everyone down
                     logger.error(f"Failed retrieving details for Mls Number {listing['MlsNumber']} ({listing['Id']})")
-                    self.cooldown(success=False)
+                    self.jobs.fail_job(job["JobId"])
                 finally:
-                    sleep(randint(7, 17))
+                    consumer_jobs[consumer_number] = None
+                    progress.update()
+
+        with closing(sqlite3.connect(details_db)) as connection:
+            await asyncio.gather(produce_listings(), *[consume_listings(connection, x) for x in range(max_in_flight)])
+        progress.close()
+        logger.info(f"Details jobs: {dict(self.jobs.get_run_progress(run_key))}")
 
 
 def get_listings_from_db(
@@ -356,6 +947,9 @@ def get_listings_from_db(
                 "Property_Address_Longitude",
                 "Property_Address_AddressText",
             ]
+            # Minimal DBs don't have all of these
+            existing_columns = [x["name"] for x in cursor.execute("PRAGMA table_info(Listings)").fetchall()]
+            columns_to_select.extend([x for x in LISTING_CHANGE_DATE_COLUMNS if x in existing_columns])
 
             where_clause = f"""
                 Property_PriceUnformattedValue > {min_price} AND 
@@ -477,11 +1071,18 @@ if __name__ == "__main__":
         help="Which city should be data be parsed for. Also affects the name of the output DB.",
     )
 
+    parser.add_argument(
+        "--cities",
+        nargs="+",
+        choices=list(CITIES.keys()),
+        help="Scrape several cities at once, listings in overlapping parts of the cities are only requested once and assigned to every city they're in. Overrides --city",
+    )
+
     parser.add_argument(
         "--store",
         default="full",
-        choices=["raw", "full", "minimal"],
-        help="What data format the JSON should be stored in the SQWLite DB. Raw unprocessed JSON, Processed JSON, or a minimal subset of Processed JSON",
+        choices=["raw", "pages", "delta", "full", "minimal"],
+        help="What data format the JSON should be stored in the SQWLite DB. Raw unprocessed JSON, raw response pages stored as they came with a listings view over them, raw JSON only stored again when a listing changes from one day to the next, Processed JSON, or a minimal subset of Processed JSON",
     )
 
     parser.add_argument(
@@ -536,8 +1137,104 @@ if __name__ == "__main__":
         help="When scraping listings, limit to these coordinates in the form of lat-min,lat-max,long-min,long-max. Example: 45.32822,45.78688,-74.48068,-72.96525",
     )
 
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=4,
+        help="When retrieving individual listing details, how many requests can be waiting on a response at once",
+    )
+
+    parser.add_argument(
+        "--max-requests-per-minute",
+        type=float,
+        default=6,
+        help="The maximum number of requests per minute the rate governor is allowed to ramp up to",
+    )
+
+    parser.add_argument(
+        "--tiled",
+        action="store_true",
+        help="When scraping listings, split the area into tiles small enough that every listing can be reached instead of sweeping the whole area forwards and backwards",
+    )
+
+    parser.add_argument(
+        "--price-banded",
+        action="store_true",
+        help="When scraping listings, split the price range into bands small enough that every listing can be reached, using the price histogram of previous scrapes",
+    )
+
+    parser.add_argument(
+        "--skip-unchanged",
+        choices=["skip", "first-page"],
+        help="When scraping listings, reuse the previous scrape's tiles and probe each one with a single small request first. Tiles that have not changed are skipped or only have their first page parsed",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="When scraping listings, stop paging through an area once we reach a page of listings that were already seen by a previous scrape",
+    )
+
+    parser.add_argument(
+        "--full-sweep-days",
+        type=int,
+        default=7,
+        help="When scraping incrementally, still page through every listing of an area if it hasn't been done in this many days",
+    )
+
+    parser.add_argument(
+        "--details-max-age-days",
+        type=int,
+        default=30,
+        help="When retrieving individual listing details, fetch them again if they're older than this many days even if the listing didn't change",
+    )
+
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="When scraping listings, start today's scrape of the area over instead of continuing it if it was interrupted",
+    )
+
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Share the scrape with other processes running the same command, they split the tiles, pages and listing details between them through the job queue. Every worker has its own rate governor",
+    )
+
+    parser.add_argument(
+        "--jobs-db",
+        type=Path,
+        default=Path("scrape_jobs.sqlite"),
+        help="The SQLite DB the scrape jobs are kept in, workers sharing a scrape need to use the same one",
+    )
+
+    parser.add_argument(
+        "--api-url",
+        default=REALTOR_API_URL,
+        help="Where the Realtor.ca API is, point this to a fake_realtor_server.py to benchmark without hitting realtor.ca",
+    )
+
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+        "--record-cassette",
+        type=Path,
+        help="Save every API response in this directory so the run can be replayed with --replay-cassette",
+    )
+    cassette_group.add_argument(
+        "--replay-cassette",
+        type=Path,
+        help="Answer every API request with the response recorded in this directory instead of sending it, without waiting between requests. The replay keeps its jobs, scrape state and details in a new temporary directory instead of --jobs-db and the working directory",
+    )
+
     args = parser.parse_args()
 
+    if args.cities and args.coordinates:
+        parser.error("--cities scrapes the boxes of the cities, it can't be used with --coordinates")
+    if args.worker and args.no_resume:
+        parser.error("--no-resume would delete the jobs of the other workers")
+    if args.worker and args.replay_cassette:
+        parser.error("--replay-cassette keeps its jobs in its own temporary directory, it can't be shared by workers")
+
     if not args.database.exists():
         raise Exception("Existing database does not exist")
 
@@ -551,8 +1248,37 @@ if __name__ == "__main__":
     #     "new_table_name": args,
     # }
 
+    cassette = None
+    jobs_db = args.jobs_db
+    state_db = Path("scrape_state.sqlite")
+    details_db = Path("listing_details_raw.sqlite")
+    governor = RateGovernor(max_rate_per_minute=args.max_requests_per_minute)
+    if args.record_cassette:
+        cassette = Cassette(args.record_cassette, mode="record")
+        # What was already scraped decides what gets requested, the saved tiles, watermarks, seen listings and
+        # histograms for listings and the details that are still fresh for details
+        cassette.save_snapshot(details_db if args.raw_details else state_db)
+    elif args.replay_cassette:
+        cassette = Cassette(args.replay_cassette, mode="replay")
+        governor = UnlimitedRateGovernor()
+        # The recorded run has finished its jobs in --jobs-db under the same run keys and has moved the scrape state
+        # and the details on since, so the replay starts over from its own copies of them as they were when recording
+        replay_dir = Path(tempfile.mkdtemp(prefix="replay_"))
+        jobs_db = replay_dir / jobs_db.name
+        state_db = replay_dir / state_db.name
+        details_db = replay_dir / details_db.name
+        cassette.restore_snapshot(details_db if args.raw_details else state_db)
+        logger.info(f"Replaying {args.replay_cassette} with the jobs, scrape state and details in {replay_dir}")
+
     scraper = RealtorRawScraper(
-        city_name=args.city, db_type=args.store, database_file=args.database, create_db=args.new_db
+        city_name="+".join(args.cities) if args.cities else args.city,
+        db_type=args.store,
+        database_file=args.database,
+        create_db=args.new_db,
+        governor=governor,
+        state=ScrapeState(state_db),
+        jobs=ScrapeJobQueue(jobs_db),
+        api=RealtorAPI(base_url=args.api_url, cassette=cassette),
     )
 
     parse_options = {}
@@ -570,6 +1296,18 @@ if __name__ == "__main__":
             "LongitudeMin": coordinates[2],
             "LongitudeMax": coordinates[3],
         }
+    if args.tiled:
+        parse_options["tiled"] = True
+    if args.price_banded:
+        parse_options["price_banded"] = True
+    if args.skip_unchanged:
+        parse_options["skip_unchanged"] = args.skip_unchanged
+    if args.incremental:
+        parse_options["full_sweep_days"] = args.full_sweep_days
+    if args.no_resume:
+        parse_options["resume"] = False
+    if args.worker:
+        parse_options["worker"] = True
 
     if args.raw_details:
         points_of_interest = None
@@ -619,6 +1357,14 @@ if __name__ == "__main__":
             # has_garage=True,
             # limit=5,
         )
-        scraper.parse_raw_listings_details(relevant_listings, details_db=Path("listing_details_raw.sqlite"))
+        scraper.parse_raw_listings_details(
+            relevant_listings,
+            details_db=details_db,
+            max_in_flight=args.max_in_flight,
+            max_age_days=args.details_max_age_days,
+            worker=args.worker,
+        )
+    elif args.cities:
+        scraper.parse_cities(args.cities, **parse_options)
     else:
         scraper.parse_listings(**parse_options)
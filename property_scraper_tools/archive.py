@@ -0,0 +1,237 @@
+""" Packs raw listing DBs into compressed archive segments that can still be read by listing Id or in one pass."""
+
+import argparse
+import logging
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Iterator, Optional
+
+import zstandard
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIX = ".segment"
+INDEX_SUFFIX = ".index"
+
+
+def is_archive(file: Path) -> bool:
+    return Path(file).suffix == ARCHIVE_SUFFIX
+
+
+def get_index_file(segment_file: Path) -> Path:
+    return Path(f"{segment_file}{INDEX_SUFFIX}")
+
+
+def write_archive(
+    raw_db: Path,
+    segment_file: Optional[Path] = None,
+    listings_per_block: int = 256,
+    dictionary_size: int = 112640,
+    compression_level: int = 10,
+) -> Path:
+    """
+    Packs the listings of a raw DB into a segment file of zstd frames with a sidecar SQLite index
+
+    Listings are compressed in blocks so that looking up one listing only needs its block decompressed, every block is
+    compressed with a dictionary trained on the listings so that even small blocks compress well.
+
+    :param raw_db: A DB with a listings table (id, details, last_updated), such as the raw or pages stores
+    :param segment_file: Where to write the segment, defaults to the raw DB's name with the archive suffix
+    :param listings_per_block: How many listings are compressed together
+    :param dictionary_size: Maximum size in bytes of the trained dictionary
+    :param compression_level:
+    :return: The segment file that was written
+    """
+    segment_file = Path(segment_file) if segment_file else Path(raw_db).with_suffix(ARCHIVE_SUFFIX)
+    index_file = get_index_file(segment_file)
+    if segment_file.exists() or index_file.exists():
+        raise Exception(f"Archive {segment_file} already exists")
+
+    with closing(sqlite3.connect(raw_db)) as connection:
+        with closing(connection.cursor()) as cursor:
+            total_listings = cursor.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+            samples = [
+                x[0].encode() for x in cursor.execute("SELECT details FROM listings ORDER BY RANDOM() LIMIT 5000")
+            ]
+        if not samples:
+            raise Exception(f"There are no listings in {raw_db} to archive")
+
+        try:
+            dictionary = zstandard.train_dictionary(dictionary_size, samples).as_bytes()
+            compressor = zstandard.ZstdCompressor(
+                level=compression_level, dict_data=zstandard.ZstdCompressionDict(dictionary)
+            )
+        except zstandard.ZstdError:
+            logger.warning(f"Not enough listings in {raw_db} to train a dictionary, compressing without one")
+            dictionary = b""
+            compressor = zstandard.ZstdCompressor(level=compression_level)
+
+        with closing(sqlite3.connect(index_file)) as index_connection:
+            with closing(index_connection.cursor()) as index_cursor:
+                index_cursor.execute("CREATE TABLE dictionary (data BLOB NOT NULL)")
+                index_cursor.execute(
+                    "CREATE TABLE blocks (id INTEGER PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL)"
+                )
+                index_cursor.execute(
+                    """
+                    CREATE TABLE listings (
+                        id           INTEGER PRIMARY KEY,
+                        block_id     INTEGER NOT NULL,
+                        offset       INTEGER NOT NULL,
+                        length       INTEGER NOT NULL,
+                        last_updated TEXT    NOT NULL
+                    )
+                    """
+                )
+                index_cursor.execute("INSERT INTO dictionary (data) VALUES(?)", [dictionary])
+
+                with open(segment_file, "wb") as segment, closing(connection.cursor()) as cursor:
+                    # Keep the listings in the order of the raw DB so a full scan reads them back the same way
+                    rows = cursor.execute("SELECT id, details, last_updated FROM listings")
+                    progress = tqdm(total=total_listings)
+                    block_id = 0
+                    while block_rows := rows.fetchmany(listings_per_block):
+                        block = bytearray()
+                        block_listings = []
+                        for listing_id, details, last_updated in block_rows:
+                            encoded_details = details.encode()
+                            block_listings.append(
+                                (listing_id, block_id, len(block), len(encoded_details), last_updated)
+                            )
+                            block.extend(encoded_details)
+
+                        compressed_block = compressor.compress(bytes(block))
+                        index_cursor.execute(
+                            "INSERT INTO blocks (id, offset, length) VALUES(?, ?, ?)",
+                            [block_id, segment.tell(), len(compressed_block)],
+                        )
+                        index_cursor.executemany(
+                            "INSERT OR IGNORE INTO listings (id, block_id, offset, length, last_updated) VALUES(?, ?, ?, ?, ?)",
+                            block_listings,
+                        )
+                        segment.write(compressed_block)
+                        block_id += 1
+                        progress.update(len(block_rows))
+                    progress.close()
+            index_connection.commit()
+
+    raw_size = Path(raw_db).stat().st_size
+    archive_size = segment_file.stat().st_size + index_file.stat().st_size
+    logger.info(f"Archived {raw_db} into {segment_file}, {raw_size / archive_size:.1f}x smaller")
+    return segment_file
+
+
+class ArchiveReader:
+    """Reads the listings of an archive segment written by write_archive"""
+
+    def __init__(self, segment_file: Path):
+        self.segment_file = Path(segment_file)
+        self.index_file = get_index_file(segment_file)
+        if not self.segment_file.exists() or not self.index_file.exists():
+            raise Exception(f"Archive {segment_file} or its index does not exist!")
+
+        with closing(sqlite3.connect(self.index_file)) as connection:
+            with closing(connection.cursor()) as cursor:
+                dictionary = cursor.execute("SELECT data FROM dictionary").fetchone()[0]
+        if dictionary:
+            self.decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictionary))
+        else:
+            self.decompressor = zstandard.ZstdDecompressor()
+
+    def read_block(self, segment, offset: int, length: int) -> bytes:
+        segment.seek(offset)
+        return self.decompressor.decompress(segment.read(length))
+
+    def get_listing(self, listing_id: int) -> Optional[str]:
+        """
+        :param listing_id:
+        :return: The raw JSON of the listing or None if it isn't in the archive
+        """
+        with closing(sqlite3.connect(self.index_file)) as connection:
+            with closing(connection.cursor()) as cursor:
+                row = cursor.execute(
+                    """
+                    SELECT blocks.offset, blocks.length, listings.offset, listings.length
+                      FROM listings
+                      JOIN blocks ON blocks.id = listings.block_id
+                     WHERE listings.id = ?
+                    """,
+                    [listing_id],
+                ).fetchone()
+        if not row:
+            return None
+
+        block_offset, block_length, listing_offset, listing_length = row
+        with open(self.segment_file, "rb") as segment:
+            block = self.read_block(segment, block_offset, block_length)
+        return block[listing_offset : listing_offset + listing_length].decode()
+
+    def iterate_listings(self, limit: int = -1) -> Iterator[tuple[int, str, str]]:
+        """
+        Reads the whole archive block by block in the order it was written
+
+        :param limit: Stop after this many listings, -1 for all of them
+        :return: The (id, details, last_updated) of every listing, same as the rows of a raw DB
+        """
+        with closing(sqlite3.connect(self.index_file)) as connection:
+            with closing(connection.cursor()) as cursor:
+                listing_rows = cursor.execute(
+                    f"""
+                    SELECT listings.id, listings.block_id, listings.offset, listings.length, listings.last_updated
+                      FROM listings
+                     ORDER BY listings.block_id, listings.offset
+                     LIMIT {limit}
+                    """
+                ).fetchall()
+                blocks = {x[0]: (x[1], x[2]) for x in cursor.execute("SELECT id, offset, length FROM blocks")}
+
+        with open(self.segment_file, "rb") as segment:
+            current_block_id = None
+            block = b""
+            for listing_id, block_id, listing_offset, listing_length, last_updated in listing_rows:
+                if block_id != current_block_id:
+                    block = self.read_block(segment, *blocks[block_id])
+                    current_block_id = block_id
+                yield listing_id, block[listing_offset : listing_offset + listing_length].decode(), last_updated
+
+    def count_listings(self) -> int:
+        with closing(sqlite3.connect(self.index_file)) as connection:
+            with closing(connection.cursor()) as cursor:
+                return cursor.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Raw DB Archiver",
+        description="Packs raw listing DBs into zstd compressed archive segments that JSONtoSQLAnalyzer can read directly",
+    )
+
+    parser.add_argument(
+        "raw_dbs",
+        type=Path,
+        nargs="+",
+        help="The raw DBs to archive, each one is written to a segment with the same name",
+    )
+
+    parser.add_argument(
+        "--listings-per-block",
+        type=int,
+        default=256,
+        help="How many listings are compressed together, bigger blocks compress better but make single lookups slower",
+    )
+
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=10,
+        help="zstd compression level",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for raw_db in args.raw_dbs:
+        write_archive(raw_db, listings_per_block=args.listings_per_block, compression_level=args.compression_level)
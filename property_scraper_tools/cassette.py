@@ -0,0 +1,143 @@
+""" Records Realtor.ca API responses so that a scrape can be replayed later without sending any requests."""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+CASSETTE_MODES = ["record", "replay"]
+
+
+class Cassette:
+    """
+    Response bodies are stored gzipped under their SHA-256 so identical responses are only stored once, an SQLite index
+    maps every request to the body it got back. Only successful responses are recorded.
+    """
+
+    def __init__(self, cassette_dir: Path = Path("cassette"), mode: str = "record"):
+        """
+        :param cassette_dir: The directory the bodies and the index are kept in
+        :param mode: Either "record" to save the responses of requests that are sent or "replay" to answer requests
+            with the recorded responses instead of sending them
+        """
+        if mode not in CASSETTE_MODES:
+            raise Exception(f"Cassette mode has to be one of {CASSETTE_MODES}, not {mode}")
+        self.mode = mode
+        self.cassette_dir = Path(cassette_dir)
+        self.bodies_dir = self.cassette_dir / "bodies"
+        self.index_db = self.cassette_dir / "index.sqlite"
+
+        if mode == "replay" and not self.index_db.exists():
+            raise Exception(f"There is no cassette to replay in {self.cassette_dir}")
+
+        self.bodies_dir.mkdir(parents=True, exist_ok=True)
+        with closing(sqlite3.connect(self.index_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS Requests (
+                        RequestKey TEXT PRIMARY KEY,
+                        Method     TEXT NOT NULL,
+                        Path       TEXT NOT NULL,
+                        Params     TEXT NOT NULL,
+                        BodyHash   TEXT NOT NULL,
+                        Recorded   TEXT NOT NULL
+                    )
+                    """
+                )
+            connection.commit()
+
+    @property
+    def is_replaying(self) -> bool:
+        return self.mode == "replay"
+
+    @staticmethod
+    def get_request_key(method: str, path: str, params: dict) -> str:
+        # Values are compared as strings since that's how they're sent
+        request = [method, path, {k: str(v) for k, v in params.items()}]
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def get_body_file(self, body_hash: str) -> Path:
+        return self.bodies_dir / body_hash[:2] / f"{body_hash}.gz"
+
+    def record(self, method: str, path: str, params: dict, body: bytes):
+        """
+        :param method: The HTTP method of the request
+        :param path: The path of the request, without the base URL so a cassette works with any host
+        :param params: The query parameters or form of the request
+        :param body: The raw response body
+        :return:
+        """
+        body_hash = hashlib.sha256(body).hexdigest()
+        body_file = self.get_body_file(body_hash)
+        if not body_file.exists():
+            body_file.parent.mkdir(exist_ok=True)
+            # Write then rename so that a crash or another thread never leaves a partial body behind
+            partial_body_file = body_file.with_suffix(f".{os.getpid()}-{threading.get_ident()}.partial")
+            with gzip.open(partial_body_file, "wb") as f:
+                f.write(body)
+            partial_body_file.replace(body_file)
+
+        with closing(sqlite3.connect(self.index_db, timeout=30)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    "REPLACE INTO Requests (RequestKey, Method, Path, Params, BodyHash, Recorded) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        self.get_request_key(method, path, params),
+                        method,
+                        path,
+                        json.dumps(params),
+                        body_hash,
+                        datetime.now().isoformat(),
+                    ],
+                )
+            connection.commit()
+
+    def replay(self, method: str, path: str, params: dict) -> bytes:
+        """
+        :return: The raw body recorded for the same request
+        """
+        with closing(sqlite3.connect(self.index_db, timeout=30)) as connection:
+            with closing(connection.cursor()) as cursor:
+                row = cursor.execute(
+                    "SELECT BodyHash FROM Requests WHERE RequestKey = ?",
+                    [self.get_request_key(method, path, params)],
+                ).fetchone()
+        if not row:
+            raise Exception(f"No response was recorded for {method} {path} {params}")
+
+        with gzip.open(self.get_body_file(row[0]), "rb") as f:
+            return f.read()
+
+    def get_snapshot_file(self, db_file: Path) -> Path:
+        return self.cassette_dir / "snapshots" / Path(db_file).name
+
+    def save_snapshot(self, db_file: Path):
+        """
+        Keeps a copy of a DB the scrape decides what to request from, as it was before recording. The replay starts
+        from the same copy so it sends the same requests instead of ones that were never recorded.
+
+        :param db_file: The DB to copy, a DB that doesn't exist yet is replayed from an empty one
+        """
+        snapshot_file = self.get_snapshot_file(db_file)
+        snapshot_file.parent.mkdir(exist_ok=True)
+        # Don't leave the snapshot of a previous recording behind
+        snapshot_file.unlink(missing_ok=True)
+        if Path(db_file).exists():
+            with closing(sqlite3.connect(db_file)) as source, closing(sqlite3.connect(snapshot_file)) as destination:
+                source.backup(destination)
+
+    def restore_snapshot(self, db_file: Path):
+        """
+        :param db_file: Where to copy the snapshot saved for the DB with the same name, nothing is copied if there isn't
+            one
+        """
+        snapshot_file = self.get_snapshot_file(db_file)
+        if snapshot_file.exists():
+            shutil.copyfile(snapshot_file, db_file)
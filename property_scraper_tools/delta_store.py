@@ -0,0 +1,183 @@
+""" Keeps daily raw listing snapshots as references to bodies that are only stored again when a listing changes."""
+
+import argparse
+import logging
+import re
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import xxhash
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def get_body_hash(details: str) -> int:
+    """
+    :param details: The raw JSON of a listing
+    :return: The 64 bit xxhash of the listing, shifted into SQLite's signed integer range
+    """
+    return xxhash.xxh3_64_intdigest(details.encode()) - (1 << 63)
+
+
+def create_delta_tables(connection: sqlite3.Connection):
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS bodies (hash INTEGER PRIMARY KEY, details TEXT NOT NULL)")
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS snapshots (
+                date TEXT    NOT NULL,
+                id   INTEGER NOT NULL,
+                hash INTEGER NOT NULL,
+                PRIMARY KEY (date, id)
+            ) WITHOUT ROWID
+            """
+        )
+        connection.commit()
+
+
+def write_snapshot_to_db(connection: sqlite3.Connection, date: str, listings: Iterable[tuple[int, str]]) -> int:
+    """
+    Records the listings seen on a day, only the bodies that were never seen before are stored
+
+    :param connection: A delta store DB, see create_delta_tables
+    :param date: The day the listings were scraped
+    :param listings: The (id, raw JSON) of the listings, a listing already recorded for the day is kept as it was
+    :return: How many new bodies had to be stored
+    """
+    bodies = {}
+    references = []
+    for listing_id, details in listings:
+        body_hash = get_body_hash(details)
+        bodies[body_hash] = details
+        references.append((date, listing_id, body_hash))
+
+    with closing(connection.cursor()) as cursor:
+        cursor.executemany("INSERT OR IGNORE INTO bodies (hash, details) VALUES(?, ?)", bodies.items())
+        new_bodies = cursor.rowcount
+        cursor.executemany("INSERT OR IGNORE INTO snapshots (date, id, hash) VALUES(?, ?, ?)", references)
+        connection.commit()
+    return new_bodies
+
+
+def iterate_snapshot(connection: sqlite3.Connection, date: str) -> Iterator[tuple[int, str, str]]:
+    """
+    :param connection: A delta store DB
+    :param date: The day to reconstruct
+    :return: The (id, details, last_updated) of every listing seen on the day, same as the rows of a raw DB
+    """
+    with closing(connection.cursor()) as cursor:
+        yield from cursor.execute(
+            """
+            SELECT snapshots.id, bodies.details, snapshots.date
+              FROM snapshots
+              JOIN bodies ON bodies.hash = snapshots.hash
+             WHERE snapshots.date = ?
+            """,
+            [date],
+        )
+
+
+def get_snapshot_dates(connection: sqlite3.Connection) -> list[str]:
+    with closing(connection.cursor()) as cursor:
+        return [x[0] for x in cursor.execute("SELECT DISTINCT date FROM snapshots ORDER BY date")]
+
+
+def import_raw_db(delta_db: Path, raw_db: Path, date: Optional[str] = None) -> int:
+    """
+    Adds a daily raw DB to a delta store
+
+    :param delta_db:
+    :param raw_db: A DB with a listings table (id, details, last_updated), such as the raw or pages stores
+    :param date: The day the raw DB was scraped, defaults to the date in its name
+    :return: How many new bodies had to be stored
+    """
+    if not date:
+        date_in_file_name = re.search(r"\d{4}-\d{2}-\d{2}", str(raw_db))
+        if not date_in_file_name:
+            raise Exception(f"Could not figure out the date of {raw_db}, it needs to be given")
+        date = date_in_file_name.group()
+
+    with closing(sqlite3.connect(delta_db)) as connection, closing(sqlite3.connect(raw_db)) as raw_connection:
+        create_delta_tables(connection)
+        with closing(raw_connection.cursor()) as raw_cursor:
+            total_listings = raw_cursor.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+            rows = raw_cursor.execute("SELECT id, details FROM listings")
+            new_bodies = 0
+            progress = tqdm(total=total_listings)
+            while batch := rows.fetchmany(1000):
+                new_bodies += write_snapshot_to_db(connection, date, batch)
+                progress.update(len(batch))
+            progress.close()
+
+    logger.info(f"Imported {raw_db} as {date}, {new_bodies} of its {total_listings} listings changed or were new")
+    return new_bodies
+
+
+def export_raw_db(delta_db: Path, date: str, raw_db: Path):
+    """
+    Reconstructs the raw DB of a day from a delta store
+
+    :param delta_db:
+    :param date:
+    :param raw_db: The raw DB to create, it must not exist yet
+    :return:
+    """
+    if Path(raw_db).exists():
+        raise Exception(f"{raw_db} already exists")
+
+    with closing(sqlite3.connect(delta_db)) as connection, closing(sqlite3.connect(raw_db)) as raw_connection:
+        with closing(raw_connection.cursor()) as raw_cursor:
+            raw_cursor.execute(
+                "CREATE TABLE IF NOT EXISTS listings (id INTEGER PRIMARY KEY, details TEXT NOT NULL, last_updated TEXT NOT NULL)"
+            )
+            raw_cursor.executemany(
+                "INSERT INTO listings (id, details, last_updated) VALUES(?, ?, ?)", iterate_snapshot(connection, date)
+            )
+            raw_connection.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Raw Delta Store",
+        description="Imports daily raw DBs into a delta store which only keeps the listings that changed between days, or exports a day back out as a raw DB",
+    )
+
+    parser.add_argument(
+        "delta_db",
+        type=Path,
+        help="The delta store DB",
+    )
+
+    parser.add_argument(
+        "--import-raw-dbs",
+        type=Path,
+        nargs="+",
+        help="Raw DBs to add to the delta store, named with the date they were scraped",
+    )
+
+    parser.add_argument(
+        "--export-date",
+        help="The day to export as a raw DB",
+    )
+
+    parser.add_argument(
+        "--export-raw-db",
+        type=Path,
+        help="The raw DB to export the day to",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.import_raw_dbs:
+        for raw_db in args.import_raw_dbs:
+            import_raw_db(args.delta_db, raw_db)
+
+    if args.export_date:
+        if not args.export_raw_db:
+            parser.error("--export-date needs --export-raw-db")
+        export_raw_db(args.delta_db, args.export_date, args.export_raw_db)
@@ -0,0 +1,336 @@
+""" Local stand-in for the Realtor.ca API that serves synthetic listings, used to benchmark scraping offline."""
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from utils import CITIES, SORT_VALUES
+
+logger = logging.getLogger(__name__)
+
+# Realtor.ca returns empty results for any page past this
+MAX_PAGES_PER_QUERY = 50
+
+# The API gives the inserted date in C# DateTime ticks, which are 100 nanoseconds since this date
+C_TICKS_EPOCH = datetime(1, 1, 1)
+
+
+def generate_listings(coordinates: dict, count: int, seed: int = 0) -> list[dict]:
+    """
+    Generates listings shaped like the ones in PropertySearch_Post responses, scattered over a box
+
+    :param coordinates: A dict in the same format as the CITIES entries
+    :param count: How many listings to generate
+    :param seed: Seed for the random generator so the same listings are generated every time
+    :return: The listings from newest to oldest
+    """
+    generator = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    listings = []
+    for listing_number in range(count):
+        inserted_date = now - timedelta(minutes=listing_number * 7)
+        price_change_date = inserted_date + (now - inserted_date) * generator.random()
+        price = round(generator.lognormvariate(13.2, 0.5), -3)
+        bedrooms = generator.randint(0, 5)
+        postal_code = f"H{generator.randint(0, 9)}X{generator.randint(0, 9)}Y{generator.randint(0, 9)}"
+        listings.append(
+            {
+                "Id": str(20000000 + listing_number),
+                "MlsNumber": str(10000000 + listing_number),
+                "PublicRemarks": f"Synthetic listing #{listing_number}",
+                "Building": {
+                    "BathroomTotal": str(max(1, bedrooms - 1)),
+                    "Bedrooms": str(bedrooms),
+                    "SizeInterior": f"{generator.randint(400, 3000)} sqft",
+                    "Type": generator.choice(["Apartment", "House", "Row / Townhouse"]),
+                },
+                "Property": {
+                    "Price": f"${price:,.0f}",
+                    "PriceUnformattedValue": f"{price:.0f}",
+                    "Type": "Single Family",
+                    "Address": {
+                        "AddressText": f"{listing_number} Synthetic Street|Somewhere {postal_code}",
+                        "Latitude": f"{generator.uniform(float(coordinates['LatitudeMin']), float(coordinates['LatitudeMax'])):.7f}",
+                        "Longitude": f"{generator.uniform(float(coordinates['LongitudeMin']), float(coordinates['LongitudeMax'])):.7f}",
+                    },
+                },
+                "PostalCode": postal_code,
+                "InsertedDateUTC": str(int((inserted_date - C_TICKS_EPOCH).total_seconds()) * 10_000_000),
+                "PriceChangeDateUTC": price_change_date.strftime("%Y-%m-%d %I:%M:%S %p"),
+                "RelativeDetailsURL": f"/real-estate/{20000000 + listing_number}/synthetic-street",
+            }
+        )
+    return listings
+
+
+class FakeRealtorServer:
+    """
+    Serves PropertySearch_Post and PropertyDetails for synthetic listings with the same paging as realtor.ca, including
+    returning nothing past page 50
+
+    Every request is delayed by a random latency, requests over the rate limit get a 403 and a share of the others
+    randomly fail with a 500 so that the scraper can be measured under the sort of conditions it sees for real.
+    """
+
+    def __init__(
+        self,
+        listings: list[dict],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.2,
+        error_rate: float = 0,
+        rate_limit_per_minute: Optional[float] = None,
+        seed: int = 0,
+    ):
+        """
+        :param listings: The listings to serve, see generate_listings
+        :param host:
+        :param port: The port to listen on, 0 picks a free one
+        :param latency: Average number of seconds before a response is sent, the actual latency varies by +/- 50%
+        :param error_rate: Share of requests that fail with a 500
+        :param rate_limit_per_minute: Requests above this rate get a 403, None to never rate limit
+        :param seed: Seed for the latency, errors and rate limiting
+        """
+        self.listings = listings
+        self.listings_by_id = {x["Id"]: x for x in listings}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_per_minute = rate_limit_per_minute
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_counts = Counter()
+
+        # Token bucket of the rate limiter, allows a burst of a single request
+        self.tokens = 1
+        self.last_refill = time.monotonic()
+
+        self.http_server = ThreadingHTTPServer((host, port), FakeRealtorRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.fake_realtor = self
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.http_server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Serving {len(self.listings)} synthetic listings on {self.url}")
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        logger.info(f"Responses sent: {dict(self.request_counts)}")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def get_fault_status(self) -> Optional[int]:
+        """
+        Waits for the request's latency and decides if the request fails
+
+        :return: The status code to fail the request with or None if it succeeds
+        """
+        with self.lock:
+            latency = self.latency * self.random.uniform(0.5, 1.5)
+            is_error = self.random.random() < self.error_rate
+
+            is_rate_limited = False
+            if self.rate_limit_per_minute:
+                now = time.monotonic()
+                self.tokens = min(1, self.tokens + (now - self.last_refill) * self.rate_limit_per_minute / 60)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                else:
+                    is_rate_limited = True
+
+        time.sleep(latency)
+        if is_rate_limited:
+            return 403
+        if is_error:
+            return 500
+        return None
+
+    def search_listings(self, form: dict) -> dict:
+        """
+        :param form: The PropertySearch_Post form, see RealtorAPI.get_property_list
+        :return: The page of listings that realtor.ca would return
+        """
+        latitude_min, latitude_max = float(form["LatitudeMin"]), float(form["LatitudeMax"])
+        longitude_min, longitude_max = float(form["LongitudeMin"]), float(form["LongitudeMax"])
+        price_min, price_max = float(form.get("PriceMin", 0)), float(form.get("PriceMax", 50000000))
+        bedrooms_min, bedrooms_max = [int(x) for x in form.get("BedRange", "0-0").split("-")]
+        records_per_page = int(form.get("RecordsPerPage", 200))
+        current_page = int(form.get("CurrentPage", 1))
+
+        results = [
+            x
+            for x in self.listings
+            if latitude_min <= float(x["Property"]["Address"]["Latitude"]) <= latitude_max
+            and longitude_min <= float(x["Property"]["Address"]["Longitude"]) <= longitude_max
+            and price_min <= float(x["Property"]["PriceUnformattedValue"]) <= price_max
+            and bedrooms_min <= int(x["Building"]["Bedrooms"])
+            and (not bedrooms_max or int(x["Building"]["Bedrooms"]) <= bedrooms_max)
+        ]
+        if form.get("Sort") == SORT_VALUES["Oldest"]:
+            results.reverse()
+
+        total_records = len(results)
+        page_results = []
+        if current_page <= MAX_PAGES_PER_QUERY:
+            page_results = results[(current_page - 1) * records_per_page : current_page * records_per_page]
+
+        return {
+            "ErrorCode": {"Id": 200, "Description": "Success - OK", "ProductName": "Fake Realtor API"},
+            "Paging": {
+                "RecordsPerPage": records_per_page,
+                "CurrentPage": current_page,
+                "TotalRecords": total_records,
+                "MaxRecords": records_per_page * MAX_PAGES_PER_QUERY,
+                "TotalPages": -(-total_records // records_per_page),
+                "RecordsShowing": len(page_results),
+                "Pins": 0,
+            },
+            "Results": page_results,
+            "Pins": [],
+        }
+
+    def get_listing_details(self, query: dict) -> Optional[dict]:
+        """
+        :param query: The PropertyDetails query parameters, see RealtorAPI.get_property_details
+        :return: The details of the listing or None if there is no such listing
+        """
+        listing = self.listings_by_id.get(query.get("PropertyID"))
+        if not listing or listing["MlsNumber"] != query.get("ReferenceNumber"):
+            return None
+        return {
+            **listing,
+            "Land": {"SizeTotal": f"{len(listing['PublicRemarks']) * 100} sqft"},
+            "ErrorCode": {"Id": 200, "Description": "Success - OK", "ProductName": "Fake Realtor API"},
+        }
+
+
+class FakeRealtorRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/Listing.svc/PropertyDetails":
+            self.send_json(404, {"ErrorCode": {"Id": 404, "Description": "Not Found"}})
+            return
+
+        fake_realtor = self.server.fake_realtor
+        if status := fake_realtor.get_fault_status():
+            self.send_json(status, {"ErrorCode": {"Id": status}})
+            return
+
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        details = fake_realtor.get_listing_details(query)
+        if details is None:
+            self.send_json(404, {"ErrorCode": {"Id": 404, "Description": "Listing not found"}})
+        else:
+            self.send_json(200, details)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        if urlparse(self.path).path != "/Listing.svc/PropertySearch_Post":
+            self.send_json(404, {"ErrorCode": {"Id": 404, "Description": "Not Found"}})
+            return
+
+        fake_realtor = self.server.fake_realtor
+        if status := fake_realtor.get_fault_status():
+            self.send_json(status, {"ErrorCode": {"Id": status}})
+            return
+
+        form = {k: v[0] for k, v in parse_qs(body).items()}
+        self.send_json(200, fake_realtor.search_listings(form))
+
+    def send_json(self, status: int, data: dict):
+        self.server.fake_realtor.request_counts[status] += 1
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Fake Realtor Server",
+        description="Serves synthetic listings the same way the Realtor.ca API does, use with ScrapeRealtorCLI --api-url",
+    )
+
+    parser.add_argument(
+        "--city",
+        default="montreal",
+        choices=list(CITIES.keys()),
+        help="Which city the synthetic listings are scattered over",
+    )
+
+    parser.add_argument(
+        "--listings",
+        type=int,
+        default=30000,
+        help="How many synthetic listings to serve",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="The port to listen on",
+    )
+
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.2,
+        help="Average number of seconds before a response is sent",
+    )
+
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.01,
+        help="Share of requests that fail with a 500",
+    )
+
+    parser.add_argument(
+        "--rate-limit-per-minute",
+        type=float,
+        help="Requests above this rate get a 403",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = FakeRealtorServer(
+        generate_listings(CITIES[args.city], args.listings),
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_per_minute=args.rate_limit_per_minute,
+    )
+    logger.info(f"Serving {len(server.listings)} synthetic listings on {server.url}")
+    try:
+        server.http_server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
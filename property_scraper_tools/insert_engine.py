@@ -0,0 +1,109 @@
+""" Buffers rows going into SQLite so that rows of the same shape are written together with executemany."""
+
+import logging
+import sqlite3
+from contextlib import closing
+from typing import Any, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedInsertEngine:
+    """
+    Rows are grouped by their table, every group is written with a single executemany over the columns of all its rows
+    and every flush is one transaction. The statements are only built once for every set of columns.
+
+    A row that doesn't have some of its group's columns gets NULLs for them, which is the same as leaving them out as
+    long as the table has no column DEFAULTs, none of the generated tables have any. Rows of a table are written in the
+    order they were added so REPLACE gives the same results as inserting the rows one by one.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, batch_size: int = 1000):
+        """
+        :param connection:
+        :param batch_size: How many rows are buffered before they're all written and committed
+        """
+        self.connection = connection
+        self.batch_size = batch_size
+        self.statements = {}
+        self.pending_rows = {}
+        self.pending_columns = {}
+        self.pending_verb_by_table = {}
+        self.pending_rows_count = 0
+        # The owners of the rows that could not be written
+        self.failed_owners = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def get_statement(self, verb: str, table_name: str, columns: tuple[str, ...]) -> str:
+        statement_key = (verb, table_name, columns)
+        if statement_key not in self.statements:
+            self.statements[statement_key] = (
+                f"{verb} INTO {table_name} ({', '.join(f'`{x}`' for x in columns)}) "
+                f"VALUES ({', '.join(['?'] * len(columns))})"
+            )
+        return self.statements[statement_key]
+
+    def add_row(self, table_name: str, row: dict[str, Any], verb: str = "REPLACE", owner: Optional[Hashable] = None):
+        """
+        :param table_name:
+        :param row: The values of the row by column
+        :param verb: REPLACE or INSERT
+        :param owner: What the row belongs to, it's added to failed_owners if the row can't be written
+        :return:
+        """
+        group_key = (verb, table_name)
+        # Keep the order of the rows of a table when it's written to in different ways
+        pending_verb = self.pending_verb_by_table.get(table_name)
+        if pending_verb is not None and pending_verb != verb:
+            self.write_group((pending_verb, table_name))
+        self.pending_verb_by_table[table_name] = verb
+
+        self.pending_rows.setdefault(group_key, []).append((row, owner))
+        self.pending_columns.setdefault(group_key, {}).update(dict.fromkeys(row))
+        self.pending_rows_count += 1
+        if self.pending_rows_count >= self.batch_size:
+            self.flush()
+
+    def write_group(self, group_key: tuple[str, str]):
+        rows = self.pending_rows.pop(group_key, [])
+        columns = tuple(self.pending_columns.pop(group_key, {}))
+        self.pending_rows_count -= len(rows)
+        if not rows:
+            return
+
+        statement = self.get_statement(*group_key, columns)
+        values = [[row.get(x) for x in columns] for row, _ in rows]
+        with closing(self.connection.cursor()) as cursor:
+            # The savepoint has to be inside a transaction otherwise releasing it would commit every group on its own
+            if not self.connection.in_transaction:
+                cursor.execute("BEGIN")
+            cursor.execute("SAVEPOINT insert_group")
+            try:
+                cursor.executemany(statement, values)
+                cursor.execute("RELEASE insert_group")
+                return
+            except (sqlite3.OperationalError, sqlite3.IntegrityError):
+                cursor.execute("ROLLBACK TO insert_group")
+                cursor.execute("RELEASE insert_group")
+
+            # Go row by row with only their own columns to only lose the rows that are actually bad
+            for row, owner in rows:
+                row_statement = self.get_statement(*group_key, tuple(row))
+                try:
+                    cursor.execute(row_statement, list(row.values()))
+                except (sqlite3.OperationalError, sqlite3.IntegrityError):
+                    logger.error(f"Failed to insert row:\n{row_statement}\n{list(row.values())}")
+                    if owner is not None:
+                        self.failed_owners.add(owner)
+
+    def flush(self):
+        for group_key in list(self.pending_rows.keys()):
+            self.write_group(group_key)
+        self.pending_verb_by_table = {}
+        self.connection.commit()
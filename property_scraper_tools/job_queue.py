@@ -0,0 +1,299 @@
+""" Keeps the jobs of a scrape in SQLite so that a scrape that crashed can continue where it stopped."""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+from collections import Counter
+from contextlib import closing
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ScrapeJobQueue:
+    """
+    Jobs are grouped in runs, a run being one scrape of an area or one batch of listing details. Every job has a key
+    that's unique within its run so adding the same jobs again when a run is restarted does nothing.
+
+    Jobs have to be leased before they're worked on, a lease expires after a while so that jobs held by a process that
+    died can be picked up again. Jobs that take long have to renew their lease while they're worked on.
+    """
+
+    def __init__(self, queue_db: str = "scrape_jobs.sqlite", lease_seconds: int = 300, max_attempts: int = 4):
+        """
+        :param queue_db: The SQLite DB the jobs are kept in
+        :param lease_seconds: How long a job can be worked on before someone else is allowed to lease it
+        :param max_attempts: Jobs that failed this many times are not leased again
+        """
+        self.queue_db = queue_db
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS Jobs (
+                        JobId        INTEGER PRIMARY KEY AUTOINCREMENT,
+                        RunKey       TEXT    NOT NULL,
+                        Kind         TEXT    NOT NULL,
+                        JobKey       TEXT    NOT NULL,
+                        Payload      TEXT    NOT NULL,
+                        State        TEXT    NOT NULL DEFAULT 'pending',
+                        Result       TEXT,
+                        Attempts     INTEGER NOT NULL DEFAULT 0,
+                        LeasedBy     TEXT,
+                        LeaseExpires REAL,
+                        Updated      REAL    NOT NULL,
+                        UNIQUE (RunKey, JobKey)
+                    )
+                    """
+                )
+                cursor.execute("CREATE INDEX IF NOT EXISTS JobsByState ON Jobs (RunKey, Kind, State)")
+            connection.commit()
+
+    def connect(self) -> sqlite3.Connection:
+        # Transactions are handled by hand so that leasing a job can't race with another process
+        connection = sqlite3.connect(self.queue_db, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def add_jobs(self, run_key: str, kind: str, jobs: list[tuple[str, dict]]) -> int:
+        """
+        :param run_key: The run the jobs belong to
+        :param kind: What sort of job it is, such as "tile" or "page"
+        :param jobs: The (job key, payload) of each job, jobs with a key already in the run are ignored
+        :return: How many jobs were actually added
+        """
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO Jobs (RunKey, Kind, JobKey, Payload, Updated) VALUES (?, ?, ?, ?, ?)",
+                    [(run_key, kind, job_key, json.dumps(payload), time.time()) for job_key, payload in jobs],
+                )
+                added_jobs = cursor.rowcount
+                cursor.execute("COMMIT")
+        return added_jobs
+
+    def has_jobs(self, run_key: str, kind: Optional[str] = None, job_key_prefix: str = "") -> bool:
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                row = cursor.execute(
+                    "SELECT 1 FROM Jobs WHERE RunKey = ? AND (? IS NULL OR Kind = ?) AND JobKey LIKE ? ESCAPE '\\' LIMIT 1",
+                    [run_key, kind, kind, self.escape_like(job_key_prefix) + "%"],
+                ).fetchone()
+                return row is not None
+
+    def has_unfinished_jobs(self, run_key: str, kind: Optional[str] = None) -> bool:
+        """
+        :return: If the run has jobs that are pending or leased and haven't failed too many times
+        """
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                row = cursor.execute(
+                    """
+                    SELECT 1
+                      FROM Jobs
+                     WHERE RunKey = ? AND (? IS NULL OR Kind = ?) AND State IN ('pending', 'leased') AND Attempts < ?
+                     LIMIT 1
+                    """,
+                    [run_key, kind, kind, self.max_attempts],
+                ).fetchone()
+                return row is not None
+
+    def get_jobs(self, run_key: str, kind: str) -> list[dict]:
+        """
+        :return: All the jobs of a kind in the run, in the order they were added
+        """
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                rows = cursor.execute(
+                    "SELECT * FROM Jobs WHERE RunKey = ? AND Kind = ? ORDER BY JobId", [run_key, kind]
+                ).fetchall()
+                return [self.row_to_job(x) for x in rows]
+
+    def lease_job(
+        self, run_key: str, kind: str, job_key_prefix: str = "", lease_seconds: Optional[float] = None
+    ) -> Optional[dict]:
+        """
+        Leases the oldest job that is pending, or whose lease expired, and that hasn't failed too many times
+
+        Expired leases of this process are never given back to it, it could still be working on those jobs or have them
+        waiting in a queue.
+
+        :param run_key: The run to lease a job from
+        :param kind: What sort of job to lease
+        :param job_key_prefix: Only lease jobs whose key starts with this
+        :param lease_seconds: How long the lease lasts, defaults to the queue's
+        :return: The leased job or None if there are no jobs left to lease
+        """
+        now = time.time()
+        lease_seconds = lease_seconds if lease_seconds else self.lease_seconds
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("BEGIN IMMEDIATE")
+                row = cursor.execute(
+                    """
+                    SELECT *
+                      FROM Jobs
+                     WHERE RunKey = ? AND
+                           Kind = ? AND
+                           JobKey LIKE ? ESCAPE '\\' AND
+                           Attempts < ? AND
+                           (State = 'pending' OR (State = 'leased' AND LeaseExpires < ? AND LeasedBy IS NOT ?))
+                     ORDER BY JobId
+                     LIMIT 1
+                    """,
+                    [run_key, kind, self.escape_like(job_key_prefix) + "%", self.max_attempts, now, self.worker_id],
+                ).fetchone()
+                if row:
+                    cursor.execute(
+                        "UPDATE Jobs SET State = 'leased', LeasedBy = ?, LeaseExpires = ?, Updated = ? WHERE JobId = ?",
+                        [self.worker_id, now + lease_seconds, now, row["JobId"]],
+                    )
+                cursor.execute("COMMIT")
+        return self.row_to_job(row) if row else None
+
+    def renew_lease(self, job_id: int, lease_seconds: Optional[float] = None) -> bool:
+        """
+        Extends the lease of a job this process is working on so nobody else picks it up in the meantime
+
+        :param job_id:
+        :param lease_seconds: How long the lease lasts from now, defaults to the queue's
+        :return: If the job is still leased by this process, it could have been leased by someone else if it expired
+        """
+        now = time.time()
+        lease_seconds = lease_seconds if lease_seconds else self.lease_seconds
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    UPDATE Jobs
+                       SET LeaseExpires = ?, Updated = ?
+                     WHERE JobId = ? AND State = 'leased' AND LeasedBy = ?
+                    """,
+                    [now + lease_seconds, now, job_id, self.worker_id],
+                )
+                return cursor.rowcount > 0
+
+    def complete_job(self, job_id: int, result: Optional[str] = None):
+        """
+        :param job_id:
+        :param result: A short note on how the job went that can be looked up later
+        :return:
+        """
+        self.set_job_state(job_id, "done", result=result)
+
+    def fail_job(self, job_id: int):
+        """
+        Gives a job back so it can be tried again, unless it already failed too many times
+
+        :param job_id:
+        :return:
+        """
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    UPDATE Jobs
+                       SET Attempts = Attempts + 1,
+                           State = CASE WHEN Attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+                           LeasedBy = NULL,
+                           LeaseExpires = NULL,
+                           Updated = ?
+                     WHERE JobId = ?
+                    """,
+                    [self.max_attempts, time.time(), job_id],
+                )
+
+    def complete_jobs_with_prefix(self, run_key: str, kind: str, job_key_prefix: str, result: str):
+        """
+        Marks every job that hasn't been done yet as done without working on it, such as when we don't need the rest
+        of a tile's pages
+
+        :param run_key:
+        :param kind:
+        :param job_key_prefix:
+        :param result: A short note on why the jobs were not needed
+        :return:
+        """
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    UPDATE Jobs
+                       SET State = 'done', Result = ?, LeasedBy = NULL, LeaseExpires = NULL, Updated = ?
+                     WHERE RunKey = ? AND Kind = ? AND JobKey LIKE ? ESCAPE '\\' AND State IN ('pending', 'leased')
+                    """,
+                    [result, time.time(), run_key, kind, self.escape_like(job_key_prefix) + "%"],
+                )
+
+    def set_job_state(self, job_id: int, state: str, result: Optional[str] = None):
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    "UPDATE Jobs SET State = ?, Result = ?, LeasedBy = NULL, LeaseExpires = NULL, Updated = ? WHERE JobId = ?",
+                    [state, result, time.time(), job_id],
+                )
+
+    def release_leases(self, run_key: str):
+        """
+        Gives back all the leased jobs of a run, only safe to use when nobody else is working on the run
+
+        :param run_key:
+        :return:
+        """
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    "UPDATE Jobs SET State = 'pending', LeasedBy = NULL, LeaseExpires = NULL WHERE RunKey = ? AND State = 'leased'",
+                    [run_key],
+                )
+
+    def reset_failed_jobs(self, run_key: str):
+        """
+        Gives the jobs of a run that failed too many times another round of attempts, such as when a scrape is started
+        again after refreshing the cookies
+
+        :param run_key:
+        :return:
+        """
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    "UPDATE Jobs SET State = 'pending', Attempts = 0, Updated = ? WHERE RunKey = ? AND State = 'failed'",
+                    [time.time(), run_key],
+                )
+                if cursor.rowcount:
+                    logger.info(f"Trying the {cursor.rowcount} jobs that had failed too many times again")
+
+    def delete_run(self, run_key: str):
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("DELETE FROM Jobs WHERE RunKey = ?", [run_key])
+
+    def get_run_progress(self, run_key: str) -> Counter:
+        """
+        :return: How many jobs of the run are in each state
+        """
+        with closing(self.connect()) as connection:
+            with closing(connection.cursor()) as cursor:
+                rows = cursor.execute(
+                    "SELECT State, COUNT(*) FROM Jobs WHERE RunKey = ? GROUP BY State", [run_key]
+                ).fetchall()
+                return Counter({x[0]: x[1] for x in rows})
+
+    @staticmethod
+    def escape_like(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    @staticmethod
+    def row_to_job(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["Payload"] = json.loads(job["Payload"])
+        return job
@@ -0,0 +1,141 @@
+""" Stores the raw PropertySearch_Post responses as they came so listings don't have to be encoded again one by one."""
+
+import json
+import re
+import sqlite3
+from contextlib import closing
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+JSON_DECODER = json.JSONDecoder()
+
+
+def decode_page_with_offsets(body: bytes) -> tuple[dict, list[tuple[int, int, int]]]:
+    """
+    Decodes a PropertySearch_Post response while keeping track of where every listing is in the raw body
+
+    The top level object is walked key by key with raw_decode so that the position of every listing in "Results" is
+    known without a second pass over the body.
+
+    :param body: The raw response body
+    :return: The decoded response and the (listing Id, byte offset, byte length) of every listing in its Results
+    """
+    text = body.decode()
+    response = {}
+    character_spans = []
+
+    def skip_whitespace(position: int) -> int:
+        return WHITESPACE.match(text, position).end()
+
+    def expect(position: int, characters: str) -> int:
+        if text[position] not in characters:
+            raise ValueError(f"Expected one of {characters!r} at position {position} but found {text[position]!r}")
+        return skip_whitespace(position + 1)
+
+    position = expect(skip_whitespace(0), "{")
+    while text[position] != "}":
+        key, position = JSON_DECODER.raw_decode(text, position)
+        position = expect(skip_whitespace(position), ":")
+
+        if key == "Results":
+            response[key] = []
+            position = expect(position, "[")
+            while text[position] != "]":
+                listing, end = JSON_DECODER.raw_decode(text, position)
+                response[key].append(listing)
+                character_spans.append((int(listing["Id"]), position, end))
+                position = skip_whitespace(end)
+                if text[position] == ",":
+                    position = skip_whitespace(position + 1)
+            position = skip_whitespace(position + 1)
+        else:
+            response[key], position = JSON_DECODER.raw_decode(text, position)
+            position = skip_whitespace(position)
+
+        if text[position] == ",":
+            position = skip_whitespace(position + 1)
+
+    if body.isascii():
+        return response, [(x, start, end - start) for x, start, end in character_spans]
+
+    # Characters and bytes only line up for ASCII, otherwise count the bytes between the listings as we go
+    listing_offsets = []
+    byte_position = 0
+    character_position = 0
+    for listing_id, start, end in character_spans:
+        byte_position += len(text[character_position:start].encode())
+        listing_length = len(text[start:end].encode())
+        listing_offsets.append((listing_id, byte_position, listing_length))
+        byte_position += listing_length
+        character_position = end
+    return response, listing_offsets
+
+
+class RawPage(dict):
+    """A decoded PropertySearch_Post response that keeps the raw body it came from and where its listings are in it"""
+
+    def __init__(self, body: bytes):
+        response, self.listing_offsets = decode_page_with_offsets(body)
+        super().__init__(response)
+        self.body = body
+
+
+def create_page_tables(connection: sqlite3.Connection):
+    """
+    Creates the tables of the page store along with a listings view that slices every listing out of its page, so
+    anything that reads the raw listings table can read a page store the same way
+
+    :param connection:
+    :return:
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS pages (id INTEGER PRIMARY KEY, body BLOB NOT NULL, last_updated TEXT NOT NULL)"
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS listing_offsets (
+                id           INTEGER PRIMARY KEY,
+                page_id      INTEGER NOT NULL,
+                offset       INTEGER NOT NULL,
+                length       INTEGER NOT NULL,
+                last_updated TEXT    NOT NULL
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE VIEW IF NOT EXISTS listings AS
+            SELECT listing_offsets.id,
+                   CAST(SUBSTR(pages.body, listing_offsets.offset + 1, listing_offsets.length) AS TEXT) AS details,
+                   listing_offsets.last_updated
+              FROM listing_offsets
+              JOIN pages ON pages.id = listing_offsets.page_id
+            """
+        )
+        connection.commit()
+
+
+def write_page_to_db(connection: sqlite3.Connection, page: RawPage, scraped_date: str) -> int:
+    """
+    Stores the body of a page once along with where each of its listings is, listings that were already stored from
+    another page are kept as they were
+
+    :param connection:
+    :param page:
+    :param scraped_date:
+    :return: How many of the page's listings were new
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("INSERT INTO pages (body, last_updated) VALUES(?, ?)", [page.body, scraped_date])
+        page_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT OR IGNORE INTO listing_offsets (id, page_id, offset, length, last_updated) VALUES(?, ?, ?, ?, ?)",
+            [
+                (listing_id, page_id, offset, length, scraped_date)
+                for listing_id, offset, length in page.listing_offsets
+            ],
+        )
+        new_listings = cursor.rowcount
+        connection.commit()
+    return new_listings
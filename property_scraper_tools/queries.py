@@ -1,21 +1,37 @@
 """ Contains all queries to the Realtor.ca API and OpenStreetMap."""
 
+import asyncio
 import json
-from typing import Optional
+from pathlib import Path
+from typing import Callable, Optional
+from urllib.parse import urlparse
 
 import requests
+from cassette import Cassette
+from rate_governor import RateGovernor
+
+REALTOR_API_URL = "https://api2.realtor.ca"
 
 
 class RealtorAPI:
-    def __init__(self, cookies_file: str = "cookies.json"):
+    def __init__(
+        self, cookies_file: str = "cookies.json", base_url: str = REALTOR_API_URL, cassette: Optional[Cassette] = None
+    ):
+        """
+        :param cookies_file: JSON or cookie string file with the cookies of a real browser session
+        :param base_url: Where the Realtor.ca API is, can point to fake_realtor_server to test without realtor.ca
+        :param cassette: Records every response, or when replaying answers every request without sending it
+        """
         self.cookies_file = cookies_file
+        self.base_url = base_url.rstrip("/")
+        self.cassette = cassette
         self.session = requests.Session()
         cookies = self.load_cookies()
         requests.utils.add_dict_to_cookiejar(self.session.cookies, cookies)
         headers = {
             "Referer": "https://www.realtor.ca/",
             "Origin": "https://www.realtor.ca/",
-            "Host": "api2.realtor.ca",
+            "Host": urlparse(self.base_url).netloc,
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
         }
         self.session.headers.update(headers)
@@ -26,6 +42,10 @@ class RealtorAPI:
             json.dump(requests.utils.dict_from_cookiejar(self.session.cookies), f)
 
     def load_cookies(self) -> dict:
+        is_realtor = self.base_url == REALTOR_API_URL and not (self.cassette and self.cassette.is_replaying)
+        if not is_realtor and not Path(self.cookies_file).exists():
+            # Only realtor.ca needs the cookies of a real browser
+            return {}
         with open(self.cookies_file, "r") as f:
             try:
                 cookies_dict = json.load(f)
@@ -48,6 +68,33 @@ class RealtorAPI:
                 return response["boundingbox"]  # [latMin, latMax, lonMin, lonMax]
         return data
 
+    def request(self, method: str, path: str, params: dict) -> bytes:
+        """
+        Sends a request to the Realtor.ca API, or replays its recorded response when replaying a cassette
+
+        :param method: Either GET with the params as query parameters or POST with the params as a form
+        :param path: The API path such as /Listing.svc/PropertyDetails
+        :param params:
+        :return: The raw response body
+        """
+        if self.cassette and self.cassette.is_replaying:
+            return self.cassette.replay(method, path, params)
+
+        url = f"{self.base_url}{path}"
+        if method == "POST":
+            response = self.session.post(url=url, data=params, timeout=10)
+        else:
+            response = self.session.get(url=url, params=params, timeout=10)
+        if response.status_code == 403:
+            print("Error 403: Rate limited")
+        elif response.status_code != 200:
+            print("Error " + str(response.status_code))
+        response.raise_for_status()
+
+        if self.cassette:
+            self.cassette.record(method, path, params, response.content)
+        return response.content
+
     # pylint: disable=too-many-arguments
     def get_property_list(
         self,
@@ -66,7 +113,41 @@ class RealtorAPI:
     ):
         """Queries the Realtor.ca API to get a list of properties."""
 
-        url = "https://api2.realtor.ca/Listing.svc/PropertySearch_Post"
+        return json.loads(
+            self.get_property_list_body(
+                lat_min,
+                lat_max,
+                long_min,
+                long_max,
+                price_min=price_min,
+                price_max=price_max,
+                records_per_page=records_per_page,
+                culture_id=culture_id,
+                current_page=current_page,
+                application_id=application_id,
+                sort=sort,
+                bed_range=bed_range,
+            )
+        )
+
+    # pylint: disable=too-many-arguments
+    def get_property_list_body(
+        self,
+        lat_min,
+        lat_max,
+        long_min,
+        long_max,
+        price_min: int = 0,
+        price_max: int = 50000000,
+        records_per_page: int = 200,
+        culture_id: int = 1,
+        current_page: int = 1,
+        application_id: int = 1,
+        sort="6-D",
+        bed_range: Optional[str] = None,
+    ) -> bytes:
+        """Queries the Realtor.ca API to get a list of properties, without decoding the response."""
+
         form = {
             "LatitudeMin": lat_min,
             "LatitudeMax": lat_max,
@@ -89,28 +170,57 @@ class RealtorAPI:
         if bed_range:
             # This should be in the form of \d-\d where the second can be 0 for +
             form["BedRange"] = bed_range
-        response = self.session.post(url=url, data=form, timeout=10)
-        if response.status_code == 403:
-            print("Error 403: Rate limited")
-        elif response.status_code != 200:
-            print("Error " + str(response.status_code))
-        response.raise_for_status()
-        return response.json()
+        return self.request("POST", "/Listing.svc/PropertySearch_Post", form)
 
     def get_property_details(self, property_id, mls_reference_number):
         """Queries the Realtor.ca API to get details of a property."""
 
-        url = f"https://api2.realtor.ca/Listing.svc/PropertyDetails"
         params = {
             "ApplicationId": 1,
             "CultureId": 1,
             "PropertyID": property_id,
             "ReferenceNumber": mls_reference_number,
         }
-        response = self.session.get(url=url, params=params, timeout=10)
-        if response.status_code == 403:
-            print("Error 403: Rate limited")
-        elif response.status_code != 200:
-            print("Error " + str(response.status_code))
-        response.raise_for_status()
-        return response.json()
+        return json.loads(self.request("GET", "/Listing.svc/PropertyDetails", params))
+
+
+class AsyncRealtorAPI:
+    """
+    Asyncio wrapper around RealtorAPI which allows multiple requests to be in flight at once
+
+    The blocking requests themselves are run in worker threads, the number of requests in flight is bounded by
+    max_in_flight and the start of every request has to go through the rate governor so that the request rate is the
+    same no matter how many requests are waiting.
+    """
+
+    def __init__(
+        self,
+        api: Optional[RealtorAPI] = None,
+        max_in_flight: int = 4,
+        governor: Optional[RateGovernor] = None,
+    ):
+        self.api = api if api else RealtorAPI()
+        self.max_in_flight = max_in_flight
+        self.governor = governor if governor else RateGovernor()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def request(self, query: Callable, *args, **kwargs):
+        async with self.in_flight:
+            await asyncio.sleep(self.governor.reserve())
+            try:
+                response = await asyncio.to_thread(query, *args, **kwargs)
+            except Exception as e:
+                self.governor.record_failure(RateGovernor.status_code_from_exception(e))
+                raise
+            self.governor.record_success()
+            return response
+
+    async def get_property_list(self, *args, **kwargs):
+        """Queries the Realtor.ca API to get a list of properties, see RealtorAPI.get_property_list"""
+
+        return await self.request(self.api.get_property_list, *args, **kwargs)
+
+    async def get_property_details(self, property_id, mls_reference_number):
+        """Queries the Realtor.ca API to get details of a property, see RealtorAPI.get_property_details"""
+
+        return await self.request(self.api.get_property_details, property_id, mls_reference_number)
@@ -0,0 +1,147 @@
+""" Controls how fast we are allowed to send requests to the Realtor.ca API."""
+
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from random import uniform
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED_STATUS_CODES = [403, 429]
+
+
+class RateGovernor:
+    """
+    Token bucket whose refill rate is tuned with AIMD (additive increase, multiplicative decrease)
+
+    Every successful request nudges the rate up a little and every rate limited request (403/429) cuts it down by a
+    factor, so we end up hovering right under whatever the server currently tolerates instead of sleeping for a fixed
+    amount of time. The last rate is saved to a state file so the next run starts at the last rate that was safe.
+    """
+
+    def __init__(
+        self,
+        state_file: Optional[str] = "rate_governor.json",
+        rate_per_minute: float = 0.4,
+        min_rate_per_minute: float = 0.06,
+        max_rate_per_minute: float = 6,
+        additive_increase: float = 0.05,
+        multiplicative_decrease: float = 0.5,
+        burst: float = 1,
+        jitter: float = 0.1,
+    ):
+        """
+        :param state_file: JSON file the rate is loaded from and saved to, None to not persist anything
+        :param rate_per_minute: The starting rate if there is no saved rate
+        :param min_rate_per_minute: The rate will never be decreased below this
+        :param max_rate_per_minute: The rate will never be increased above this
+        :param additive_increase: How many requests per minute are added to the rate after every success
+        :param multiplicative_decrease: What the rate is multiplied by after we get rate limited
+        :param burst: How many requests can be sent back to back after being idle
+        :param jitter: Waits are randomly stretched by up to this fraction so requests don't look scheduled
+        """
+        self.state_file = state_file
+        self.min_rate_per_minute = min_rate_per_minute
+        self.max_rate_per_minute = max_rate_per_minute
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.burst = burst
+        self.jitter = jitter
+        self.lock = threading.Lock()
+
+        self.rate_per_minute = self.clamp_rate(self.load_rate() or rate_per_minute)
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+    def clamp_rate(self, rate_per_minute: float) -> float:
+        return min(self.max_rate_per_minute, max(self.min_rate_per_minute, rate_per_minute))
+
+    def load_rate(self) -> Optional[float]:
+        if not self.state_file or not Path(self.state_file).exists():
+            return None
+        with open(self.state_file, "r") as f:
+            try:
+                state = json.load(f)
+            except json.decoder.JSONDecodeError:
+                logger.warning(f"Could not read rate governor state from {self.state_file}, using default rate")
+                return None
+        logger.info(f"Starting at the last saved rate of {state['rate_per_minute']:.3f} requests/minute")
+        return state["rate_per_minute"]
+
+    def save_rate(self):
+        if not self.state_file:
+            return
+        with open(self.state_file, "w") as f:
+            json.dump({"rate_per_minute": self.rate_per_minute, "updated": datetime.now().isoformat()}, f)
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate_per_minute / 60)
+        self.last_refill = now
+
+    def reserve(self) -> float:
+        """
+        Takes a token from the bucket, going into debt if there are none left
+
+        :return: How many seconds the caller needs to wait before sending its request
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens * 60 / self.rate_per_minute * uniform(1, 1 + self.jitter)
+
+    def acquire(self):
+        """Blocks until we are allowed to send a request"""
+        wait_time = self.reserve()
+        if wait_time > 0:
+            logger.debug(f"Sleeping {wait_time:.1f} seconds")
+            time.sleep(wait_time)
+
+    def record_success(self):
+        with self.lock:
+            self.rate_per_minute = self.clamp_rate(self.rate_per_minute + self.additive_increase)
+            self.save_rate()
+
+    def record_failure(self, status_code: Optional[int] = None):
+        """
+        Empties the bucket so the next request waits for a full token, if we were rate limited the rate is also cut
+
+        :param status_code: The HTTP status code of the failed request if there was one
+        :return:
+        """
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0)
+            if status_code in RATE_LIMITED_STATUS_CODES:
+                self.rate_per_minute = self.clamp_rate(self.rate_per_minute * self.multiplicative_decrease)
+                logger.warning(
+                    f"Rate limited with {status_code}, slowing down to {self.rate_per_minute:.3f} requests/minute"
+                )
+                self.save_rate()
+
+    @staticmethod
+    def status_code_from_exception(exception: Exception) -> Optional[int]:
+        response = getattr(exception, "response", None)
+        return getattr(response, "status_code", None)
+
+
+class UnlimitedRateGovernor(RateGovernor):
+    """Never waits, for when no requests are actually sent such as when replaying a cassette"""
+
+    def __init__(self):
+        super().__init__(state_file=None)
+
+    def reserve(self) -> float:
+        return 0
+
+    def record_success(self):
+        pass
+
+    def record_failure(self, status_code: Optional[int] = None):
+        pass
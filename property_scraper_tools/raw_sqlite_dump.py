@@ -7,10 +7,10 @@ from datetime import date
 from math import ceil
 from pathlib import Path
 from pprint import pprint
-from random import randint
-from time import sleep
+from typing import Optional
 
 from queries import RealtorAPI
+from rate_governor import RateGovernor
 from requests import HTTPError
 from tqdm import tqdm
 from utils import CITIES
@@ -31,13 +31,13 @@ SORT_VALUES = {
 
 
 class RealtorRawScraper:
-    def __init__(self, city_name="city"):
+    def __init__(self, city_name="city", governor: Optional[RateGovernor] = None):
         self.city_name = city_name
         self.connection = sqlite3.connect(f"{city_name}_raw_{str(date.today())}.db")
-        self.min_sleep_time = 100
         self.total_parsed = 0
         self.parsed_mls_numbers = []
         self.api = RealtorAPI()
+        self.governor = governor if governor else RateGovernor()
 
         with closing(self.connection.cursor()) as cursor:
             cursor.execute(
@@ -49,14 +49,20 @@ class RealtorRawScraper:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.connection.close()
 
-    def cooldown(self, success: bool = True):
-        sleep_time = randint(
-            # WARN: If you set cookies from the browser this can be pretty low at 100s/page
-            self.min_sleep_time if success else self.min_sleep_time * 7,
-            self.min_sleep_time * 2 if success else self.min_sleep_time * 9,
-        )
-        logger.debug(f"Sleeping {sleep_time} seconds")
-        sleep(sleep_time)
+    def get_property_list(self, *args, **kwargs) -> dict:
+        """
+        Queries a page of listings once the rate governor allows it and reports back how the request went
+
+        :return: The raw response from realtor.ca
+        """
+        self.governor.acquire()
+        try:
+            response = self.api.get_property_list(*args, **kwargs)
+        except Exception as e:
+            self.governor.record_failure(RateGovernor.status_code_from_exception(e))
+            raise
+        self.governor.record_success()
+        return response
 
     def write_response_results_to_db(self, response, partition: str):
         """
@@ -101,9 +107,7 @@ class RealtorRawScraper:
 
         try:
             # Parse the first page because it contains details about how many pages there are
-            response = self.api.get_property_list(
-                latitude_min, latitude_max, longitude_min, longitude_max, current_page=1
-            )
+            response = self.get_property_list(latitude_min, latitude_max, longitude_min, longitude_max, current_page=1)
 
             total_pages = ceil(response["Paging"]["TotalRecords"] / response["Paging"]["RecordsPerPage"])
             self.write_response_results_to_db(response, current_date)
@@ -127,8 +131,6 @@ class RealtorRawScraper:
             (page_number, "Oldest") for page_number in range(1, parse_backward + 1)
         ]
 
-        self.cooldown()
-
         # WARN: We can't seem to go past 50 pages, when this happens we get back zero results
         for page_number, sort_name in tqdm(pages_to_parse):
             sort_value = SORT_VALUES[sort_name]
@@ -138,7 +140,7 @@ class RealtorRawScraper:
 
             while not success:
                 try:
-                    response = self.api.get_property_list(
+                    response = self.get_property_list(
                         latitude_min,
                         latitude_max,
                         longitude_min,
@@ -156,8 +158,6 @@ class RealtorRawScraper:
                     attempts += 1
                     if attempts > 4:
                         raise Exception("Too many failed attempts. Refresh cookies and try again")
-                finally:
-                    self.cooldown(success)
 
         logger.info(f"Completed while parsing {total_pages} pages and {len(self.parsed_mls_numbers)} listings")
         self.api.save_cookies()
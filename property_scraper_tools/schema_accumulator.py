@@ -0,0 +1,111 @@
+""" Folds JSON items into a tree of value type Counters one at a time so a schema can be inferred in a single pass."""
+
+from collections import Counter
+
+
+class SchemaAccumulator:
+    """
+    Merges items into a single item where every value is a Counter of the types it had, without having to keep the items
+    around. Lists are merged into a list of a single dict as they are added, only the dicts in them are kept.
+
+    When a key is a dict in some items and a value of another type in others, the dict is kept and the other values are
+    counted in it under the name of their type. When it is a list in some items, the list is kept and the other values
+    are dropped. Between a dict and a list, whichever was seen first is kept.
+    """
+
+    def __init__(self):
+        self.schema = {}
+
+    def add_item(self, item: dict):
+        """
+        :param item: An item that has already been through modify_dict, it is not modified
+        :return:
+        """
+        self.add_dict(self.schema, item)
+
+    @staticmethod
+    def is_subtree(value) -> bool:
+        """
+        :return: If the value is a dict or a list of a dict that other values for its key shouldn't replace
+        """
+        return type(value) is dict or (type(value) is list and len(value) > 0)
+
+    @staticmethod
+    def add_dict(schema: dict, item: dict):
+        for key, value in item.items():
+            existing = schema.get(key)
+            if isinstance(value, dict):
+                if type(existing) is Counter:
+                    # Keep counting the values that weren't dicts
+                    existing = schema[key] = dict(existing)
+                elif type(existing) is not dict:
+                    if SchemaAccumulator.is_subtree(existing):
+                        continue
+                    existing = schema[key] = {}
+                SchemaAccumulator.add_dict(existing, value)
+            elif isinstance(value, list):
+                if type(existing) is not list:
+                    # An empty list has nothing to replace the other values with
+                    if SchemaAccumulator.is_subtree(existing) or (existing is not None and not value):
+                        continue
+                    existing = schema[key] = []
+                for dict_in_list in value:
+                    if not existing:
+                        existing.append({})
+                    # The other types are unsupported, modify_dict has already warned about them
+                    if isinstance(dict_in_list, dict):
+                        SchemaAccumulator.add_dict(existing[0], dict_in_list)
+            elif type(existing) is dict:
+                type_name = type(value).__name__
+                existing[type_name] = existing.get(type_name, 0) + 1
+            elif type(existing) is Counter:
+                existing[type(value).__name__] += 1
+            elif not SchemaAccumulator.is_subtree(existing):
+                schema[key] = Counter([type(value).__name__])
+
+    def merge(self, other: "SchemaAccumulator") -> "SchemaAccumulator":
+        """
+        Adds the schema built by another accumulator to this one, merging the accumulators of consecutive chunks of
+        items gives the same schema as adding all the items to a single one, unless a key is a dict in some items and a
+        list in others
+
+        :param other: It is not modified but parts of its schema may end up shared with this one
+        :return: This accumulator
+        """
+        self.merge_dicts(self.schema, other.schema)
+        return self
+
+    @staticmethod
+    def merge_dicts(schema: dict, other_schema: dict):
+        for key, value in other_schema.items():
+            existing = schema.get(key)
+            if type(value) is dict:
+                if type(existing) is Counter:
+                    existing = schema[key] = dict(existing)
+                elif type(existing) is not dict:
+                    if SchemaAccumulator.is_subtree(existing):
+                        continue
+                    existing = schema[key] = {}
+                SchemaAccumulator.merge_dicts(existing, value)
+            elif type(value) is list:
+                if type(existing) is not list:
+                    if SchemaAccumulator.is_subtree(existing) or (existing is not None and not value):
+                        continue
+                    existing = schema[key] = []
+                if value:
+                    if not existing:
+                        existing.append({})
+                    SchemaAccumulator.merge_dicts(existing[0], value[0])
+            elif type(value) is Counter:
+                if type(existing) is dict:
+                    for type_name, count in value.items():
+                        existing[type_name] = existing.get(type_name, 0) + count
+                elif type(existing) is Counter:
+                    existing.update(value)
+                elif not SchemaAccumulator.is_subtree(existing):
+                    schema[key] = value.copy()
+            elif type(existing) is int:
+                # How many times the dict this is in was a value of another type
+                schema[key] = existing + value
+            elif existing is None:
+                schema[key] = value
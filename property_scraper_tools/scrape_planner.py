@@ -0,0 +1,407 @@
+""" Splits up a scrape into work units small enough that realtor.ca will let us page through all of their listings."""
+
+import logging
+import sqlite3
+from collections import Counter
+from contextlib import closing
+from datetime import datetime
+from math import ceil
+from typing import Callable, Optional
+
+from utils import SORT_VALUES
+
+logger = logging.getLogger(__name__)
+
+# Realtor.ca returns empty results for any page past this
+MAX_PAGES_PER_QUERY = 50
+
+# How many of the newest listings are looked at when probing a work unit for changes
+PROBE_RECORDS_PER_PAGE = 10
+
+
+def get_bounds(coordinates: dict) -> tuple[float, float, float, float]:
+    return (
+        float(coordinates["LatitudeMin"]),
+        float(coordinates["LatitudeMax"]),
+        float(coordinates["LongitudeMin"]),
+        float(coordinates["LongitudeMax"]),
+    )
+
+
+def get_total_pages(response: dict) -> int:
+    return ceil(response["Paging"]["TotalRecords"] / response["Paging"]["RecordsPerPage"])
+
+
+def split_tile(coordinates: dict) -> list[dict]:
+    """
+    Splits a lat/long box into 4 equal quadrants
+
+    :param coordinates: A dict in the same format as the CITIES entries, any other keys such as prices are kept
+    :return: The 4 quadrants, also in the CITIES format
+    """
+    latitude_min, latitude_max, longitude_min, longitude_max = get_bounds(coordinates)
+    latitude_mid = (latitude_min + latitude_max) / 2
+    longitude_mid = (longitude_min + longitude_max) / 2
+    return [
+        {
+            **coordinates,
+            "LatitudeMin": lat_min,
+            "LatitudeMax": lat_max,
+            "LongitudeMin": long_min,
+            "LongitudeMax": long_max,
+        }
+        for lat_min, lat_max in [(latitude_min, latitude_mid), (latitude_mid, latitude_max)]
+        for long_min, long_max in [(longitude_min, longitude_mid), (longitude_mid, longitude_max)]
+    ]
+
+
+def get_union_tiles(boxes: list[dict]) -> list[dict]:
+    """
+    Covers the union of possibly overlapping lat/long boxes with boxes that don't overlap
+
+    The edges of every box cut the area into a grid, the covered cells of each grid row are joined into strips along
+    the longitude and strips spanning the same longitudes in consecutive rows are stacked into a single box.
+
+    :param boxes: Dicts in the same format as the CITIES entries
+    :return: Boxes in the CITIES format covering the same area as the given boxes without overlapping
+    """
+    bounds = [get_bounds(x) for x in boxes]
+    latitudes = sorted({latitude for x in bounds for latitude in x[:2]})
+    longitudes = sorted({longitude for x in bounds for longitude in x[2:]})
+
+    def is_covered(lat_min: float, lat_max: float, long_min: float, long_max: float) -> bool:
+        return any(x[0] <= lat_min and lat_max <= x[1] and x[2] <= long_min and long_max <= x[3] for x in bounds)
+
+    tiles = []
+    # The strips of the previous rows that can still be stacked on, (long min, long max) -> (lat min, lat max)
+    open_strips = {}
+    for lat_min, lat_max in zip(latitudes, latitudes[1:]):
+        row_strips = []
+        for long_min, long_max in zip(longitudes, longitudes[1:]):
+            if not is_covered(lat_min, lat_max, long_min, long_max):
+                continue
+            if row_strips and row_strips[-1][1] == long_min:
+                row_strips[-1] = (row_strips[-1][0], long_max)
+            else:
+                row_strips.append((long_min, long_max))
+
+        stacked_strips = {}
+        for strip in row_strips:
+            stacked_strips[strip] = (open_strips.pop(strip)[0] if strip in open_strips else lat_min, lat_max)
+        tiles.extend(
+            {"LatitudeMin": x[0], "LatitudeMax": x[1], "LongitudeMin": strip[0], "LongitudeMax": strip[1]}
+            for strip, x in open_strips.items()
+        )
+        open_strips = stacked_strips
+
+    tiles.extend(
+        {"LatitudeMin": x[0], "LatitudeMax": x[1], "LongitudeMin": strip[0], "LongitudeMax": strip[1]}
+        for strip, x in open_strips.items()
+    )
+    return tiles
+
+
+def get_boxes_containing(latitude: float, longitude: float, boxes: dict[str, dict]) -> list[str]:
+    """
+    :param latitude:
+    :param longitude:
+    :param boxes: Boxes in the CITIES format by name
+    :return: The names of the boxes the point is in
+    """
+    names = []
+    for name, box in boxes.items():
+        latitude_min, latitude_max, longitude_min, longitude_max = get_bounds(box)
+        if latitude_min <= latitude <= latitude_max and longitude_min <= longitude <= longitude_max:
+            names.append(name)
+    return names
+
+
+def get_price_params(work_unit: dict) -> dict:
+    """
+    :param work_unit: A tile which may also be limited to a price band
+    :return: The get_property_list parameters for the price band of the work unit
+    """
+    price_params = {}
+    if "PriceMin" in work_unit:
+        price_params["price_min"] = work_unit["PriceMin"]
+    if "PriceMax" in work_unit:
+        price_params["price_max"] = work_unit["PriceMax"]
+    return price_params
+
+
+def get_work_unit_key(work_unit: dict, query_params: dict) -> str:
+    """
+    :param work_unit: A tile which may also be limited to a price band
+    :param query_params: The extra query parameters the work unit is searched with
+    :return: A string that identifies the work unit and its search across scrapes
+    """
+    price_params = {**query_params, **get_price_params(work_unit)}
+    bounds = ",".join(f"{x:.5f}" for x in get_bounds(work_unit))
+    return (
+        f"{bounds}|{price_params.get('price_min', 0)}-{price_params.get('price_max', 50000000)}"
+        f"|{query_params.get('bed_range', '')}"
+    )
+
+
+def summarize_probe(response: dict) -> dict:
+    """
+    Summarizes the newest listings of a work unit, if the summary is the same as the previous scrape's then it's
+    likely that nothing in the work unit changed
+
+    :param response: A page of listings going by "Newest" order, only the first PROBE_RECORDS_PER_PAGE are looked at
+    :return:
+    """
+    newest_listings = response["Results"][:PROBE_RECORDS_PER_PAGE]
+    price_change_dates = [
+        datetime.strptime(x["PriceChangeDateUTC"], "%Y-%m-%d %I:%M:%S %p").isoformat()
+        for x in newest_listings
+        if x.get("PriceChangeDateUTC")
+    ]
+    return {
+        "TotalRecords": response["Paging"]["TotalRecords"],
+        # These are C# DateTime ticks which all have the same number of digits
+        "NewestInsertedDateUTC": max(
+            (x["InsertedDateUTC"] for x in newest_listings if "InsertedDateUTC" in x), default=None
+        ),
+        "NewestPriceChangeDateUTC": max(price_change_dates, default=None),
+    }
+
+
+def build_price_histogram(prices: list[int], bucket_size: int = 10000) -> list[tuple[int, int, int]]:
+    """
+    :param prices: The prices of all the listings
+    :param bucket_size: The price range covered by each bucket
+    :return: The (price min, price max, number of listings) buckets ordered by price
+    """
+    buckets = Counter(price // bucket_size for price in prices)
+    return [
+        (bucket * bucket_size, (bucket + 1) * bucket_size - 1, listings) for bucket, listings in sorted(buckets.items())
+    ]
+
+
+def build_price_histogram_from_db(
+    db_file: str, coordinates: dict, bucket_size: int = 10000, last_updated_days_ago: int = 7
+) -> list[tuple[int, int, int]]:
+    """
+    Builds a price histogram from the listings of a full or minimal DB that were recently seen within a box
+
+    :param db_file: A full or minimal DB with a Listings table
+    :param coordinates: Only listings in this box are counted
+    :param bucket_size: The price range covered by each bucket
+    :param last_updated_days_ago: Only listings we've seen in these last days are counted
+    :return: The (price min, price max, number of listings) buckets ordered by price
+    """
+    latitude_min, latitude_max, longitude_min, longitude_max = get_bounds(coordinates)
+    with closing(sqlite3.connect(db_file)) as connection:
+        with closing(connection.cursor()) as cursor:
+            rows = cursor.execute(
+                f"""
+                SELECT CAST(Property_PriceUnformattedValue AS INTEGER) / {bucket_size} AS Bucket,
+                       COUNT(*)
+                  FROM Listings
+                 WHERE Property_PriceUnformattedValue IS NOT NULL AND
+                       Property_Address_Latitude BETWEEN ? AND ? AND
+                       Property_Address_Longitude BETWEEN ? AND ? AND
+                       DATE(ComputedLastUpdated) >= DATE('now', '-{last_updated_days_ago} day')
+                 GROUP BY Bucket
+                 ORDER BY Bucket
+                """,
+                [latitude_min, latitude_max, longitude_min, longitude_max],
+            ).fetchall()
+    return [(bucket * bucket_size, (bucket + 1) * bucket_size - 1, listings) for bucket, listings in rows]
+
+
+def cut_price_bands(
+    histogram: list[tuple[int, int, int]], price_min: int, price_max: int, max_listings: int
+) -> list[tuple[int, int]]:
+    """
+    Groups consecutive histogram buckets into price bands that each have at most max_listings listings
+
+    A single bucket with more than max_listings listings still ends up in a band of its own, it will have to be split
+    further once we see how many listings it really has.
+
+    :param histogram: The (price min, price max, number of listings) buckets ordered by price
+    :param price_min: The lowest price the bands need to cover
+    :param price_max: The highest price the bands need to cover
+    :param max_listings: How many listings a band should have at most
+    :return: The (price min, price max) of each band, together they cover the whole price range
+    """
+    bands = []
+    band_min = price_min
+    band_listings = 0
+    for bucket_min, bucket_max, listings in histogram:
+        if bucket_max < price_min or bucket_min > price_max:
+            continue
+        if band_listings and band_listings + listings > max_listings and bucket_min > band_min:
+            bands.append((band_min, bucket_min - 1))
+            band_min = bucket_min
+            band_listings = 0
+        band_listings += listings
+    bands.append((band_min, price_max))
+    return bands
+
+
+def find_price_split(histogram: list[tuple[int, int, int]], price_min: int, price_max: int) -> int:
+    """
+    Finds the price that splits a price band in two halves with about the same number of listings
+
+    :param histogram: The (price min, price max, number of listings) buckets ordered by price
+    :param price_min:
+    :param price_max:
+    :return: The highest price of the lower half
+    """
+    buckets = [x for x in histogram if price_min <= x[0] and x[1] <= price_max]
+    total_listings = sum(x[2] for x in buckets)
+    seen_listings = 0
+    for bucket_min, bucket_max, listings in buckets:
+        seen_listings += listings
+        if seen_listings * 2 >= total_listings and bucket_max < price_max:
+            return bucket_max
+    return (price_min + price_max) // 2
+
+
+class ScrapePlanner:
+    def __init__(
+        self,
+        get_property_list: Callable,
+        max_pages: int = MAX_PAGES_PER_QUERY,
+        records_per_page: int = 200,
+        min_tile_size: float = 0.001,
+        min_price_band: int = 1000,
+        fill_factor: float = 0.8,
+    ):
+        """
+        :param get_property_list: Function used to query a page of listings, see RealtorAPI.get_property_list
+        :param max_pages: How many "Newest" pages we can go through for a single query
+        :param records_per_page: How many listings we get per page
+        :param min_tile_size: Tiles with a side smaller than this many degrees will not be split any further
+        :param min_price_band: Price bands narrower than this will be split by area instead of by price
+        :param fill_factor: Price bands are cut from histograms to only be this full so they have room to grow
+        """
+        self.get_property_list = get_property_list
+        self.max_pages = max_pages
+        self.records_per_page = records_per_page
+        self.min_tile_size = min_tile_size
+        self.min_price_band = min_price_band
+        self.fill_factor = fill_factor
+
+    @property
+    def max_listings(self) -> int:
+        """How many listings can be reached in a single work unit going by "Newest" order"""
+        return self.max_pages * self.records_per_page
+
+    def probe_work_unit(self, work_unit: dict, query_params: dict) -> dict:
+        """
+        Gets a single small page of the newest listings in a work unit, enough to tell if anything changed
+
+        :param work_unit: A tile which may also be limited to a price band
+        :param query_params: Extra query parameters such as prices or bedrooms
+        :return: The raw response from realtor.ca
+        """
+        return self.get_property_list(
+            *get_bounds(work_unit),
+            **{
+                **query_params,
+                **get_price_params(work_unit),
+                "current_page": 1,
+                "records_per_page": PROBE_RECORDS_PER_PAGE,
+                "sort": SORT_VALUES["Newest"],
+            },
+        )
+
+    def plan_tiles(
+        self, coordinates: dict, query_params: dict, after_probe: Optional[Callable] = None
+    ) -> list[tuple[dict, dict]]:
+        """
+        Recursively splits the given box into quadrants until every tile has few enough listings to be fully paged
+        through going by "Newest"
+
+        :param coordinates: The box to cover, in the same format as the CITIES entries
+        :param query_params: Extra query parameters such as prices or bedrooms that all tiles are searched with
+        :param after_probe: See plan_work_units
+        :return: A list of the leaf tiles along with the first page response for each one
+        """
+        return self.plan_work_units([coordinates], query_params, after_probe=after_probe)
+
+    def plan_price_bands(
+        self,
+        coordinates: dict,
+        query_params: dict,
+        price_histogram: list[tuple[int, int, int]],
+        after_probe: Optional[Callable] = None,
+    ) -> list[tuple[dict, dict]]:
+        """
+        Cuts the price range into bands that should each fit under the page cap according to the price histogram
+
+        Bands that turn out to have more listings than the histogram said are split again by price, and once a band
+        is too narrow to split by price it is split by area instead.
+
+        :param coordinates: The box to cover, in the same format as the CITIES entries
+        :param query_params: Extra query parameters such as prices or bedrooms that all bands are searched with
+        :param price_histogram: The (price min, price max, number of listings) buckets ordered by price
+        :param after_probe: See plan_work_units
+        :return: A list of work units, tiles with a PriceMin and PriceMax, along with the first page response for each
+        """
+        price_min = query_params.get("price_min", 0)
+        price_max = query_params.get("price_max", 50000000)
+        bands = cut_price_bands(price_histogram, price_min, price_max, int(self.max_listings * self.fill_factor))
+        logger.info(f"Cut the price range {price_min}-{price_max} into {len(bands)} bands")
+
+        work_units = [{**coordinates, "PriceMin": band_min, "PriceMax": band_max} for band_min, band_max in bands]
+        return self.plan_work_units(work_units, query_params, price_histogram, after_probe=after_probe)
+
+    def plan_work_units(
+        self,
+        work_units: list[dict],
+        query_params: dict,
+        price_histogram: Optional[list[tuple[int, int, int]]] = None,
+        after_probe: Optional[Callable] = None,
+    ) -> list[tuple[dict, dict]]:
+        """
+        Probes every work unit and splits it until it has few enough listings to be fully paged through going by
+        "Newest". Work units with a price band are split by price first, everything else is split into quadrants.
+
+        Every work unit is probed by asking for its first page, the first page is kept for the leaf work units so that
+        it doesn't have to be requested a second time when we scrape them.
+
+        :param work_units: Tiles in the same format as the CITIES entries, optionally with a PriceMin and PriceMax
+        :param query_params: Extra query parameters such as prices or bedrooms that all work units are searched with
+        :param price_histogram: Used to split price bands where they have the same number of listings on both sides
+        :param after_probe: Called after every probe, probes wait on the rate governor so planning can take a while
+        :return: A list of the leaf work units along with the first page response for each one
+        """
+        planned_work_units = []
+        work_units_to_probe = list(reversed(work_units))
+        probes = 0
+
+        while work_units_to_probe:
+            work_unit = work_units_to_probe.pop()
+            response = self.get_property_list(
+                *get_bounds(work_unit),
+                **{**query_params, **get_price_params(work_unit), "current_page": 1, "sort": SORT_VALUES["Newest"]},
+            )
+            probes += 1
+            if after_probe:
+                after_probe()
+            total_pages = get_total_pages(response)
+            latitude_min, latitude_max, longitude_min, longitude_max = get_bounds(work_unit)
+
+            if total_pages <= self.max_pages:
+                planned_work_units.append((work_unit, response))
+            elif "PriceMin" in work_unit and work_unit["PriceMax"] - work_unit["PriceMin"] > self.min_price_band:
+                price_split = find_price_split(price_histogram or [], work_unit["PriceMin"], work_unit["PriceMax"])
+                logger.debug(f"Splitting price band {get_price_params(work_unit)} at {price_split}")
+                # Pushed in reverse so that the lower band is probed first
+                work_units_to_probe.append({**work_unit, "PriceMin": price_split + 1})
+                work_units_to_probe.append({**work_unit, "PriceMax": price_split})
+            elif min(latitude_max - latitude_min, longitude_max - longitude_min) / 2 < self.min_tile_size:
+                logger.warning(
+                    f"Tile {get_bounds(work_unit)} has {total_pages} pages but is too small to split any further"
+                )
+                planned_work_units.append((work_unit, response))
+            else:
+                logger.debug(f"Splitting tile {get_bounds(work_unit)} since it has {total_pages} pages")
+                work_units_to_probe.extend(split_tile(work_unit))
+
+        logger.info(f"Planned {len(planned_work_units)} work units after probing {probes} times")
+        return planned_work_units
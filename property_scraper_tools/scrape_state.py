@@ -0,0 +1,240 @@
+""" Keeps what we learned from previous scrapes so that the next ones can be planned with fewer requests."""
+
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from typing import Optional
+
+
+class ScrapeState:
+    def __init__(self, state_db: str = "scrape_state.sqlite"):
+        self.state_db = state_db
+
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS PriceHistograms (
+                        City     TEXT    NOT NULL,
+                        PriceMin INTEGER NOT NULL,
+                        PriceMax INTEGER NOT NULL,
+                        Listings INTEGER NOT NULL,
+                        Updated  TEXT    NOT NULL,
+                        PRIMARY KEY (City, PriceMin)
+                    )
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS TileProbes (
+                        TileKey                  TEXT PRIMARY KEY,
+                        TotalRecords             INTEGER NOT NULL,
+                        NewestInsertedDateUTC    TEXT,
+                        NewestPriceChangeDateUTC TEXT,
+                        Probed                   TEXT NOT NULL
+                    )
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS SeenListings (
+                        Id                 INTEGER PRIMARY KEY,
+                        InsertedDateUTC    TEXT,
+                        PriceChangeDateUTC TEXT,
+                        PhotoChangeDateUTC TEXT,
+                        LastSeen           TEXT NOT NULL
+                    )
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS Watermarks (
+                        TileKey               TEXT PRIMARY KEY,
+                        NewestInsertedDateUTC TEXT,
+                        LastFullSweep         TEXT
+                    )
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS WorkUnits (
+                        PlanKey  TEXT    NOT NULL,
+                        Position INTEGER NOT NULL,
+                        WorkUnit TEXT    NOT NULL,
+                        PRIMARY KEY (PlanKey, Position)
+                    )
+                    """
+                )
+            connection.commit()
+
+    def get_price_histogram(self, city: str) -> list[tuple[int, int, int]]:
+        """
+        :param city:
+        :return: The (price min, price max, number of listings) buckets of the city ordered by price
+        """
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                return cursor.execute(
+                    "SELECT PriceMin, PriceMax, Listings FROM PriceHistograms WHERE City = ? ORDER BY PriceMin",
+                    [city],
+                ).fetchall()
+
+    def save_price_histogram(self, city: str, histogram: list[tuple[int, int, int]], price_min: int, price_max: int):
+        """
+        Replaces the buckets of a city's histogram that were covered by a scrape
+
+        :param city:
+        :param histogram: The (price min, price max, number of listings) buckets
+        :param price_min: The lowest price the scrape covered, buckets saved from other price ranges are kept
+        :param price_max: The highest price the scrape covered
+        :return:
+        """
+        updated = datetime.now().isoformat()
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    "DELETE FROM PriceHistograms WHERE City = ? AND PriceMin >= ? AND PriceMax <= ?",
+                    [city, price_min, price_max],
+                )
+                cursor.executemany(
+                    "REPLACE INTO PriceHistograms (City, PriceMin, PriceMax, Listings, Updated) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (city, bucket_min, bucket_max, listings, updated)
+                        for bucket_min, bucket_max, listings in histogram
+                    ],
+                )
+            connection.commit()
+
+    def get_tile_probe(self, tile_key: str) -> Optional[dict]:
+        """
+        :param tile_key: See scrape_planner.get_work_unit_key
+        :return: The probe summary saved the last time the tile was fully parsed, see scrape_planner.summarize_probe
+        """
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            connection.row_factory = sqlite3.Row
+            with closing(connection.cursor()) as cursor:
+                row = cursor.execute(
+                    "SELECT TotalRecords, NewestInsertedDateUTC, NewestPriceChangeDateUTC FROM TileProbes WHERE TileKey = ?",
+                    [tile_key],
+                ).fetchone()
+                return dict(row) if row else None
+
+    def save_tile_probe(self, tile_key: str, probe_summary: dict):
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    REPLACE INTO TileProbes (TileKey, TotalRecords, NewestInsertedDateUTC, NewestPriceChangeDateUTC, Probed)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    [
+                        tile_key,
+                        probe_summary["TotalRecords"],
+                        probe_summary["NewestInsertedDateUTC"],
+                        probe_summary["NewestPriceChangeDateUTC"],
+                        datetime.now().isoformat(),
+                    ],
+                )
+            connection.commit()
+
+    def get_work_units(self, plan_key: str) -> list[dict]:
+        """
+        :param plan_key: Identifies the area and search that was planned
+        :return: The work units that were planned the last time, in the order they were scraped
+        """
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                rows = cursor.execute(
+                    "SELECT WorkUnit FROM WorkUnits WHERE PlanKey = ? ORDER BY Position", [plan_key]
+                ).fetchall()
+                return [json.loads(x[0]) for x in rows]
+
+    def save_work_units(self, plan_key: str, work_units: list[dict]):
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("DELETE FROM WorkUnits WHERE PlanKey = ?", [plan_key])
+                cursor.executemany(
+                    "INSERT INTO WorkUnits (PlanKey, Position, WorkUnit) VALUES (?, ?, ?)",
+                    [(plan_key, position, json.dumps(x)) for position, x in enumerate(work_units)],
+                )
+            connection.commit()
+
+    @staticmethod
+    def get_listing_change_dates(listing: dict) -> tuple:
+        return (
+            int(listing["Id"]),
+            listing.get("InsertedDateUTC"),
+            listing.get("PriceChangeDateUTC"),
+            listing.get("PhotoChangeDateUTC"),
+        )
+
+    def all_listings_seen(self, listings: list[dict]) -> bool:
+        """
+        :param listings: Raw listings from realtor.ca
+        :return: If every listing was already seen with the same inserted, price change and photo change dates
+        """
+        listing_change_dates = {self.get_listing_change_dates(x) for x in listings}
+        listing_ids = [x[0] for x in listing_change_dates]
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                rows = cursor.execute(
+                    f"""
+                    SELECT Id, InsertedDateUTC, PriceChangeDateUTC, PhotoChangeDateUTC
+                      FROM SeenListings
+                     WHERE Id IN ({", ".join(["?"] * len(listing_ids))})
+                    """,
+                    listing_ids,
+                ).fetchall()
+        return listing_change_dates.issubset(rows)
+
+    def mark_listings_seen(self, listings: list[dict]):
+        last_seen = datetime.now().isoformat()
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.executemany(
+                    """
+                    REPLACE INTO SeenListings (Id, InsertedDateUTC, PriceChangeDateUTC, PhotoChangeDateUTC, LastSeen)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    [(*self.get_listing_change_dates(x), last_seen) for x in listings],
+                )
+            connection.commit()
+
+    def get_watermark(self, tile_key: str, full_sweep_days: int) -> Optional[str]:
+        """
+        :param tile_key: See scrape_planner.get_work_unit_key
+        :param full_sweep_days: How many days we can go without fully paging through the tile
+        :return: The newest InsertedDateUTC of the tile's previous scrape, or None if the tile is due for a full sweep
+        """
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                row = cursor.execute(
+                    f"""
+                    SELECT NewestInsertedDateUTC
+                      FROM Watermarks
+                     WHERE TileKey = ? AND DATETIME(LastFullSweep) >= DATETIME('now', 'localtime', '-{full_sweep_days} day')
+                    """,
+                    [tile_key],
+                ).fetchone()
+                return row[0] if row else None
+
+    def save_watermark(self, tile_key: str, newest_inserted_date: Optional[str], full_sweep: bool):
+        """
+        :param tile_key: See scrape_planner.get_work_unit_key
+        :param newest_inserted_date: The newest InsertedDateUTC of the listings in the tile
+        :param full_sweep: If we paged through the whole tile, otherwise the date of the last full sweep is kept
+        :return:
+        """
+        with closing(sqlite3.connect(self.state_db)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO Watermarks (TileKey, NewestInsertedDateUTC, LastFullSweep) VALUES (?, ?, ?)
+                        ON CONFLICT (TileKey) DO UPDATE SET
+                           NewestInsertedDateUTC = excluded.NewestInsertedDateUTC,
+                           LastFullSweep = COALESCE(excluded.LastFullSweep, LastFullSweep)
+                    """,
+                    [tile_key, newest_inserted_date, datetime.now().isoformat() if full_sweep else None],
+                )
+            connection.commit()
@@ -0,0 +1,113 @@
+import json
+import re
+import sqlite3
+import subprocess
+import sys
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from fake_realtor_server import FakeRealtorServer, generate_listings
+from utils import CITIES
+
+CLI = Path(__file__).parent.parent / "property_scraper_tools" / "ScrapeRealtorCLI.py"
+
+
+def run_cli(cwd: Path, database: str, *args: str) -> str:
+    # Start from a saved rate that is fast enough to not wait on the rate governor
+    with open(cwd / "rate_governor.json", "w") as f:
+        json.dump({"rate_per_minute": 100000, "updated": datetime.now().isoformat()}, f)
+    (cwd / database).touch()
+    result = subprocess.run(
+        [sys.executable, CLI, database, "--max-requests-per-minute", "100000", *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stderr
+
+
+def get_replay_dir(log: str) -> Path:
+    return Path(re.search(r"Replaying .* with the jobs, scrape state and details in (.*)", log).group(1))
+
+
+def get_ids(db_file: Path) -> list[int]:
+    with closing(sqlite3.connect(db_file)) as connection:
+        return [x[0] for x in connection.execute("SELECT id FROM listings ORDER BY id").fetchall()]
+
+
+@pytest.mark.parametrize(
+    "scrape_args",
+    [
+        ["--tiled", "--skip-unchanged", "skip"],
+        ["--tiled", "--skip-unchanged", "first-page"],
+        ["--tiled", "--incremental"],
+        ["--price-banded"],
+    ],
+)
+@pytest.mark.parametrize("previous_scrape", [False, True])
+def test_replay_uses_the_scrape_state_of_the_recording(tmp_path: Path, scrape_args: list[str], previous_scrape: bool):
+    scrape_args = ["--new-db", "--store", "raw", *scrape_args]
+    # Enough listings that the price range has to be cut into several bands
+    with FakeRealtorServer(generate_listings(CITIES["montreal"], 12000), latency=0) as server:
+        if previous_scrape:
+            # Leaves saved tiles, watermarks, seen listings and histograms behind for the recording to start from
+            run_cli(tmp_path, "previous.sqlite", "--api-url", server.url, *scrape_args)
+        run_cli(tmp_path, "recorded.sqlite", "--api-url", server.url, "--record-cassette", "cassette", *scrape_args)
+
+    log = run_cli(tmp_path, "replayed.sqlite", "--replay-cassette", "cassette", *scrape_args)
+
+    assert get_ids(tmp_path / "replayed.sqlite") == get_ids(tmp_path / "recorded.sqlite")
+    assert get_replay_dir(log).parent != tmp_path
+
+
+def test_replay_fetches_the_details_of_the_recording(tmp_path: Path):
+    listings = generate_listings(CITIES["montreal"], 20)
+    with closing(sqlite3.connect(tmp_path / "listings.sqlite")) as connection:
+        connection.execute(
+            """
+            CREATE TABLE Listings (
+                Id                            INTEGER,
+                MlsNumber                     INTEGER,
+                Property_Address_Latitude     REAL,
+                Property_Address_Longitude    REAL,
+                Property_Address_AddressText  TEXT,
+                Property_PriceUnformattedValue INTEGER,
+                Property_ZoningType           TEXT,
+                Property_Type                 TEXT,
+                Building_StoriesTotal         TEXT,
+                ComputedNewBuild              INTEGER,
+                ComputedLastUpdated           TEXT
+            )
+            """
+        )
+        connection.executemany(
+            "INSERT INTO Listings VALUES (?, ?, ?, ?, ?, ?, NULL, 'Single Family', NULL, 0, ?)",
+            [
+                (
+                    x["Id"],
+                    x["MlsNumber"],
+                    x["Property"]["Address"]["Latitude"],
+                    x["Property"]["Address"]["Longitude"],
+                    x["Property"]["Address"]["AddressText"],
+                    # Within the default price range of the CLI
+                    500000,
+                    datetime.now().isoformat(),
+                )
+                for x in listings
+            ],
+        )
+        connection.commit()
+
+    with FakeRealtorServer(listings, latency=0) as server:
+        run_cli(tmp_path, "listings.sqlite", "--api-url", server.url, "--raw-details", "--record-cassette", "cassette")
+
+    log = run_cli(tmp_path, "listings.sqlite", "--raw-details", "--replay-cassette", "cassette")
+
+    # The details fetched when recording are fresh, the replay still has to fetch them all from the cassette
+    assert get_ids(get_replay_dir(log) / "listing_details_raw.sqlite") == get_ids(
+        tmp_path / "listing_details_raw.sqlite"
+    )
+    assert len(get_ids(tmp_path / "listing_details_raw.sqlite")) == len(listings)
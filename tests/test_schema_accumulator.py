@@ -0,0 +1,71 @@
+import json
+import sqlite3
+from collections import Counter
+from contextlib import closing
+from pathlib import Path
+
+import pytest
+from JSONtoSQLAnalyzer import JSONtoSQLAnalyzer
+from schema_accumulator import SchemaAccumulator
+
+# Land is a dict, then null, then a dict again
+LAND_ITEMS = [
+    {"Id": 1, "Land": {"Size": "1", "Front": "2"}},
+    {"Id": 2, "Land": None},
+    {"Id": 3, "Land": {"Size": "3"}},
+]
+LAND_SCHEMA = {
+    "Id": Counter({"int": 3}),
+    "Land": {"Size": Counter({"str": 2}), "Front": Counter({"str": 1}), "NoneType": 1},
+}
+
+# Rooms is null, then a list of dicts, then null again
+ROOMS_ITEMS = [
+    {"Id": 1, "Rooms": None},
+    {"Id": 2, "Rooms": [{"Type": "a"}]},
+    {"Id": 3, "Rooms": None},
+    {"Id": 4, "Rooms": [{"Type": "b", "Size": "1"}]},
+]
+ROOMS_SCHEMA = {
+    "Id": Counter({"int": 4}),
+    "Rooms": [{"Type": Counter({"str": 2}), "Size": Counter({"str": 1})}],
+}
+
+
+def make_raw_db(db_file: Path, items: list[dict]) -> str:
+    with closing(sqlite3.connect(db_file)) as connection:
+        connection.execute("CREATE TABLE listings (id INTEGER PRIMARY KEY, details TEXT NOT NULL, last_updated TEXT)")
+        connection.executemany(
+            "INSERT INTO listings (id, details, last_updated) VALUES (?, ?, '2024-01-01')",
+            [(x["Id"], json.dumps(x)) for x in items],
+        )
+        connection.commit()
+    return str(db_file)
+
+
+@pytest.mark.parametrize("items, schema", [(LAND_ITEMS, LAND_SCHEMA), (ROOMS_ITEMS, ROOMS_SCHEMA)])
+def test_type_conflicts_keep_the_subtree(items: list[dict], schema: dict):
+    accumulator = SchemaAccumulator()
+    for item in items:
+        accumulator.add_item(item)
+    assert accumulator.schema == schema
+
+    # Every way of splitting the items into consecutive chunks gives the same schema once merged
+    for split in range(1, len(items)):
+        first, second = SchemaAccumulator(), SchemaAccumulator()
+        for item in items[:split]:
+            first.add_item(item)
+        for item in items[split:]:
+            second.add_item(item)
+        assert first.merge(second).schema == schema
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_type_conflicts_keep_the_columns(tmp_path: Path, jobs: int):
+    analyzer = JSONtoSQLAnalyzer(make_raw_db(tmp_path / "raw.sqlite", LAND_ITEMS), jobs=jobs)
+
+    assert analyzer.convert_raw_db_to_json_and_merge_to_get_raw_schema() == LAND_SCHEMA
+    (create_statement,) = analyzer.get_sqlite_sql_for_dbschema_from_raw_items()
+    assert "Land_Size TEXT" in create_statement
+    assert "Land_Front TEXT" in create_statement
+    assert "NoneType" not in create_statement